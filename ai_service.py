@@ -1,19 +1,23 @@
 """
 Сервис для работы с AI
 """
-from openai import AsyncOpenAI
-from typing import List, Dict, Any, Optional, Tuple
-import json
+from openai import RateLimitError
+from typing import List, Dict, Callable
+import asyncio
 import re
+import time
 from config import config
-from loguru import logger
-import random
-
-# Настраиваем асинхронный OpenAI клиент для OpenRouter.ai
-client = AsyncOpenAI(
-    api_key=config.openai_api_key,
-    base_url="https://openrouter.ai/api/v1"
+from intents import intent_engine
+from llm_backends import Completion, create_backend
+from llm_pool import LLMWorkerPool, LLMPoolOverloaded, LLMDeadlineExceeded, Priority, classify_priority
+from response_cache import ResponseCache
+from prompt_builder import prompt_builder
+from rate_limiter import CircuitBreaker, RateLimitedError, CircuitOpenError
+from structured_output import StructuredOutputError, output_parser
+from metrics import (
+    ai_fallback_total, ai_results_total, llm_errors_total, llm_request_seconds, llm_tokens_total, registry
 )
+from loguru import logger
 
 
 class AIService:
@@ -21,191 +25,211 @@ class AIService:
     
     def __init__(self):
         self.personality = config.bot_personality
+        self.pool = LLMWorkerPool(
+            concurrency=config.llm_concurrency,
+            max_queue=config.llm_queue_size
+        )
+        # Упоминания бота, поднимающие приоритет запроса
+        self.mentions = {config.bot_name.lower()}
+        
+        # OpenAI-совместимый провайдер, заглушка или маршрутизатор (LLM_BACKENDS)
+        self.backend = create_backend()
+        self.prompts = prompt_builder
+        self.cache = ResponseCache(
+            tokenize=self.tokenize_keywords,
+            max_entries=config.response_cache_max_entries,
+            ttl=config.response_cache_ttl,
+            scope=config.response_cache_scope,
+            similarity=config.response_cache_similarity,
+            context_size=config.response_cache_context
+        ) if config.response_cache_enabled else None
         
-        # Простые fallback ответы для случаев без OpenAI
-        self.fallback_responses = [
-            "Интересная мысль! 🤔",
-            "А что вы об этом думаете? 💭",
-            "Хорошая тема для обсуждения! 💬", 
-            "Согласен, это важно 👍",
-            "Понятно, расскажите больше 🗣️",
-            "Интересно! А как это работает? 🔍",
-            "Да, это стоит обсудить 📝",
-            "Хороший вопрос! 🤷‍♂️",
-            "Мне тоже интересно это узнать 📚",
-            "Давайте разберемся вместе! 🤝"
-        ]
+        # Интенты fallback режима для случаев без LLM (intents.json)
+        self.intents = intent_engine
+        
+        # Терпимый разбор JSON ответов модели со счетчиком потерь
+        self.output_parser = output_parser
         
         logger.info("✅ AIService инициализирован")
 
     def _get_fallback_response(self, context_messages: List[str], topic: str = None) -> Dict:
         """Fallback ответы когда OpenAI недоступен"""
-        
-        # Простая логика на основе ключевых слов
-        last_message = context_messages[-1].lower() if context_messages else ""
-        
-        # Определяем тип сообщения
-        if any(word in last_message for word in ['привет', 'здравствуй', 'добро', 'утро', 'день', 'вечер']):
-            responses = ["Привет! Как дела? 👋", "Здравствуйте! Рад всех видеть! 😊", "Привет! Что нового? 🌟"]
-            topic = "приветствие"
-            should_respond = True
-        elif any(word in last_message for word in ['как дела', 'как ты', 'как жизнь', 'как настроение']):
-            responses = ["Всё отлично! А у вас как? 😊", "Хорошо! Работаю, помогаю в чате 🤖", "Замечательно! Спасибо что спросили 💙"]
-            topic = "самочувствие"
-            should_respond = True
-        elif any(word in last_message for word in ['что делаешь', 'чем занят', 'что нового']):
-            responses = ["Слежу за интересными разговорами в чате! 👀", "Анализирую контекст беседы 🔍", "Участвую в обсуждении 💬"]
-            topic = "деятельность"
-            should_respond = True
-        elif any(word in last_message for word in ['узбекистан', 'узбекский', 'ташкент', 'самарканд']):
-            responses = [
-                "Узбекистан - удивительная страна с богатой историей! 🇺🇿 Знаменит Великим шелковым путем, архитектурой Самарканда и гостеприимством людей. Что именно вас интересует?",
-                "Узбекистан - центр Центральной Азии! Ташкент - современная столица, а Самарканд и Бухара - города с тысячелетней историей. Хотите узнать что-то конкретное? 🏛️",
-                "Узбекистан богат культурой и традициями! От древних городов до современных достижений. Могу рассказать больше о том, что вас интересует! 📚"
-            ]
-            topic = "география_узбекистан"
-            should_respond = True
-        elif any(word in last_message for word in ['что ты знаешь', 'расскажи', 'что можешь', 'информация']):
-            responses = [
-                "Я могу помочь с различными вопросами! Расскажу о странах, истории, науке, технологиях. О чем конкретно хотите узнать? 🤔",
-                "У меня есть знания по многим темам - география, история, культура, наука. Задавайте конкретные вопросы, и я постараюсь дать полезную информацию! 📖",
-                "Готов поделиться информацией по разным областям! Что именно вас интересует? Страны, наука, история, технологии? 🧠"
-            ]
-            topic = "информационный_запрос"
-            should_respond = True
-        elif any(word in last_message for word in ['спасибо', 'благодарю', 'thanks']):
-            responses = ["Пожалуйста! 😊", "Всегда рад помочь! 🤝", "Не за что! 💙"]
-            topic = "благодарность"
-            should_respond = True
-        elif any(word in last_message for word in ['хорошо', 'отлично', 'супер', 'класс', 'круто']):
-            responses = ["Рад это слышать! 😊", "Здорово! 👍", "Отличные новости! 🎉"]
-            topic = "позитив"
-            should_respond = True
-        elif any(word in last_message for word in ['плохо', 'грустно', 'печально', 'проблем']):
-            responses = ["Сочувствую 😔", "Надеюсь, всё наладится! 💪", "Держитесь! 🤗"]
-            topic = "поддержка"
-            should_respond = True
-        elif '?' in last_message:
-            responses = [
-                "Интересный вопрос! 🤔 Могу попробовать ответить более подробно, если уточните детали.",
-                "Хорошо спрашиваете! 💭 Что именно вас интересует больше всего?",
-                "Попробую помочь с ответом! 🧠 Можете конкретизировать вопрос?"
-            ]
-            topic = "вопрос"
-            should_respond = True
-        else:
-            # Увеличиваем вероятность ответа до 80% для демонстрации
-            should_respond = random.random() < 0.8
-            responses = self.fallback_responses
-            topic = topic or "общение"
-        
-        if should_respond:
-            response = random.choice(responses)
-            sentiment = 0.7  # Позитивный
-        else:
-            response = None
-            sentiment = 0.5  # Нейтральный
-        
+        return self.intents.fallback(context_messages[-1] if context_messages else "", topic)
+    
+    def _fallback(self, reason: str, context_messages: List[str]) -> Dict:
+        """Локальный ответ с учетом причины в метриках"""
+        ai_fallback_total.labels(reason).inc()
+        ai_results_total.labels("fallback").inc()
+        return self._get_fallback_response(context_messages)
+
+    def add_mention(self, mention: str):
+        """Регистрирует упоминание бота (например, @username)"""
+        if mention:
+            self.mentions.add(mention.lower())
+    
+    def _get_silent_response(self, topic: str = None) -> Dict:
+        """Результат без ответа для сброшенных фоновых запросов"""
         return {
             "detected_topic": topic or "общение",
-            "sentiment": sentiment,
-            "should_respond": should_respond,
-            "response": response
+            "sentiment": 0.5,
+            "should_respond": False,
+            "response": None
         }
+    
+    async def _request_completion(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        timeout: float,
+        on_partial: Callable[[str], None] = None,
+        estimated_tokens: int = 0,
+        max_tokens: int = None
+    ) -> Completion:
+        """
+        Запрашивает ответ у бэкенда LLM и учитывает расход токенов
+        
+        Фактический расход из ответа провайдера сверяется с оценкой
+        `estimated_tokens` сборщика промптов.
+        
+        Returns:
+            Ответ модели с расходом токенов и причиной остановки
+        """
+        started = time.perf_counter()
+        try:
+            completion = await self.backend.complete(system_prompt, user_prompt, timeout, on_partial, max_tokens)
+        except Exception as e:
+            llm_request_seconds.labels(self.backend.name, type(e).__name__).observe(time.perf_counter() - started)
+            llm_errors_total.labels(type(e).__name__).inc()
+            raise
+        llm_request_seconds.labels(completion.backend or self.backend.name, "ok").observe(time.perf_counter() - started)
+        if completion.prompt_tokens:
+            llm_tokens_total.labels("prompt").inc(completion.prompt_tokens)
+            llm_tokens_total.labels("completion").inc(completion.completion_tokens)
+            self.prompts.record_usage(estimated_tokens, completion.prompt_tokens, completion.completion_tokens)
+        return completion
+    
+    async def complete(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        timeout: float,
+        max_tokens: int = None,
+        priority: Priority = Priority.BACKGROUND
+    ) -> str:
+        """Произвольный запрос к LLM через общий пул (для служебных задач)"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        completion = await self.pool.submit(
+            lambda remaining: self._request_completion(
+                system_prompt, user_prompt, remaining, max_tokens=max_tokens
+            ),
+            priority=priority,
+            deadline=deadline
+        )
+        return completion.text
 
     async def analyze_context_and_generate_response(
         self, 
         context_messages: List[str], 
-        chat_title: str = None
+        chat_title: str = None,
+        deadline: float = None,
+        chat_id: str = None,
+        on_partial: Callable[[str], None] = None,
+        summary: str = None,
+        on_start: Callable[[], None] = None
     ) -> Dict:
         """
         Анализирует контекст и генерирует ответ
         
+        Args:
+            context_messages: Последние сообщения чата
+            chat_title: Название чата
+            deadline: Момент loop.time(), после которого ответ уже не нужен
+            chat_id: ID чата для кэша ответов
+            on_partial: Неблокирующий колбэк для потоковой выдачи текста ответа
+            summary: Краткое содержание более ранней части обсуждения
+            on_start: Вызывается, когда запрос к LLM начинает выполняться
+        
         Returns:
             Dict с полями: detected_topic, sentiment, should_respond, response
         """
         try:
             logger.info(f"🧠 Анализируем {len(context_messages)} сообщений...")
             
-            # Подготавливаем контекст для OpenAI
-            context_text = "\n".join([f"- {msg}" for msg in context_messages[-5:]])
+            if self.cache is not None:
+                cached = self.cache.get(context_messages, chat_id)
+                if cached is not None:
+                    logger.info("⚡ Ответ найден в кэше")
+                    ai_results_total.labels("cache").inc()
+                    return cached
             
-            system_prompt = f"""
-Ты умный и полезный помощник в групповом чате "{chat_title or 'Группа'}".
-
-Твоя задача:
-1. Проанализировать последние сообщения
-2. Определить тему разговора
-3. Оценить эмоциональный тон (sentiment от -1 до 1)
-4. Решить, стоит ли отвечать (should_respond: true/false)
-5. Если да - сгенерировать полезный и информативный ответ
-
-ВАЖНО: На прямые вопросы (особенно с "?" или "что ты знаешь", "расскажи") отвечай подробно и по существу.
-Для вопросов о странах, фактах, истории давай содержательные ответы.
-
-Отвечай естественно, как умный участник беседы. Будь полезным и информативным.
-Отвечай на русском языке.
-
-Верни ответ в JSON формате:
-{{
-    "detected_topic": "тема разговора",
-    "sentiment": число_от_-1_до_1,
-    "should_respond": true/false,
-    "response": "твой подробный и полезный ответ или null"
-}}
-"""
-
-            user_prompt = f"""
-Последние сообщения в чате:
-{context_text}
+            # Промпт по бюджету токенов: свежие сообщения, длинные - сокращены
+            prompt = self.prompts.build(context_messages, chat_title, self.personality, summary)
+            logger.info(
+                f"📏 Промпт ~{prompt.prompt_tokens} токенов: сообщений {prompt.messages_used}, "
+                f"не вошло {prompt.messages_dropped}, сокращено {prompt.truncated}"
+            )
 
-Проанализируй контекст и реши, стоит ли отвечать.
-"""
-
-            # Пробуем OpenAI API
+            # Пробуем OpenAI API через общий пул воркеров
+            priority = classify_priority(context_messages[-1] if context_messages else "", self.mentions)
+            if deadline is None:
+                deadline = asyncio.get_running_loop().time() + config.llm_request_timeout
+            
             try:
-                response = await client.chat.completions.create(
-                    model="meta-llama/llama-3.1-8b-instruct:free",  # Бесплатная модель через OpenRouter.ai
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    max_tokens=500,
-                    temperature=0.7,
-                    timeout=10,  # Таймаут 10 секунд
-                    extra_headers={
-                        "HTTP-Referer": "https://github.com/smartgroupbot",  # Необходимо для OpenRouter.ai
-                        "X-Title": "SmartGroupBot"  # Название приложения
-                    }
+                stream_callback = on_partial if config.stream_responses else None
+                completion = await self.pool.submit(
+                    lambda remaining: self._request_completion(
+                        prompt.system, prompt.user, remaining, stream_callback, prompt.prompt_tokens
+                    ),
+                    priority=priority,
+                    deadline=deadline,
+                    on_start=on_start
                 )
-                
-                content = response.choices[0].message.content.strip()
+                content = completion.text
+
                 logger.info(f"✅ Получен ответ от OpenAI: {content[:100]}...")
                 
-                # Парсим JSON ответ
+                # Разбираем JSON ответ (markdown, проза вокруг, мелкие ошибки - допустимы)
                 try:
-                    result = json.loads(content)
+                    parsed = self.output_parser.parse(content, truncated=completion.finish_reason == "length")
+                    result = parsed.to_dict()
                     logger.info(f"🎯 AI результат: {result}")
+                    # Оборванный по max_tokens ответ не закрепляется в кэше
+                    if self.cache is not None and not parsed.truncated:
+                        self.cache.put(context_messages, result, chat_id)
+                    ai_results_total.labels("llm").inc()
                     return result
-                except json.JSONDecodeError:
-                    logger.warning("⚠️ Не удалось распарсить JSON от OpenAI, используем fallback")
-                    return self._get_fallback_response(context_messages)
+                except StructuredOutputError:
+                    logger.warning("⚠️ Не удалось разобрать ответ LLM, используем fallback")
+                    return self._fallback("parse_error", context_messages)
+                    
+            except (LLMPoolOverloaded, LLMDeadlineExceeded) as pool_error:
+                logger.warning(f"🚦 LLM пул перегружен: {pool_error}")
+                
+                # Прямые вопросы получают локальный ответ, фоновая болтовня - тишину
+                if priority == Priority.DIRECT:
+                    return self._fallback("overloaded", context_messages)
+                ai_results_total.labels("silent").inc()
+                return self._get_silent_response()
+                    
+            except (RateLimitedError, CircuitOpenError) as limit_error:
+                logger.info(f"💡 Лимиты провайдера: {limit_error}, используем fallback режим")
+                return self._fallback("rate_limited", context_messages)
                     
             except Exception as openai_error:
                 logger.error(f"❌ Ошибка OpenAI API: {openai_error}")
                 
                 # Если ошибка квоты - используем fallback
-                if "429" in str(openai_error) or "quota" in str(openai_error).lower():
+                if isinstance(openai_error, RateLimitError):
                     logger.info("💡 Квота OpenAI исчерпана, используем fallback режим")
-                    return self._get_fallback_response(context_messages)
+                    return self._fallback("quota", context_messages)
                 else:
                     # Для других ошибок тоже fallback
                     logger.info("💡 OpenAI недоступен, используем fallback режим")
-                    return self._get_fallback_response(context_messages)
+                    return self._fallback("provider_error", context_messages)
                 
         except Exception as e:
             logger.error(f"❌ Ошибка AI сервиса: {e}")
-            return self._get_fallback_response(context_messages)
+            return self._fallback("error", context_messages)
     
     def should_respond_based_on_frequency(
         self, 
@@ -232,15 +256,59 @@ class AIService:
         
         return response_ratio < target_ratio
     
-    def extract_topic_keywords(self, text: str) -> List[str]:
-        """Извлекает ключевые слова из текста"""
+    def tokenize_keywords(self, text: str) -> List[str]:
+        """Возвращает все значимые слова текста"""
         # Простая реализация - можно улучшить
         words = re.findall(r'\b\w{4,}\b', text.lower())
         # Фильтруем стоп-слова
         stop_words = {'это', 'того', 'этого', 'такой', 'такая', 'такие', 'очень', 'более', 'самый'}
-        keywords = [word for word in words if word not in stop_words]
-        return keywords[:5]  # Топ 5 ключевых слов
+        return [word for word in words if word not in stop_words]
+    
+    def extract_topic_keywords(self, text: str) -> List[str]:
+        """Извлекает ключевые слова из текста"""
+        return self.tokenize_keywords(text)[:5]  # Топ 5 ключевых слов
 
 
 # Глобальный экземпляр сервиса
-ai_service = AIService() 
\ No newline at end of file
+ai_service = AIService() 
+
+registry.gauge("smartbot_llm_queue_depth", "Requests waiting in the LLM worker pool", function=lambda: ai_service.pool.queue_depth)
+registry.gauge("smartbot_llm_active", "LLM requests in flight", function=lambda: ai_service.pool.active)
+registry.stats("smartbot_llm_pool_jobs_total", "LLM worker pool jobs by result", lambda: ai_service.pool.stats, "result")
+registry.stats("smartbot_llm_parse_total", "LLM JSON replies by parse result", lambda: ai_service.output_parser.stats, "result")
+
+
+def _llm_backends():
+    """Конечные бэкенды LLM (у роутера - его список, иначе сам бэкенд)"""
+    backend = ai_service.backend
+    return getattr(backend, 'backends', None) or [backend]
+
+
+def _per_backend(component: str, attribute: str = 'stats'):
+    """Счетчики компонента каждого бэкенда: {(бэкенд, событие): значение}"""
+    return {
+        (backend.name, event): value
+        for backend in _llm_backends() if getattr(backend, component, None) is not None
+        for event, value in getattr(getattr(backend, component), attribute).items()
+    }
+
+
+def _circuit_states():
+    """Текущее состояние предохранителей: 1 у действующего состояния, 0 у остальных"""
+    states = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN)
+    return {
+        (backend.name, state): float(backend.circuit_breaker.state == state)
+        for backend in _llm_backends() for state in states
+    }
+
+
+registry.stats(
+    "smartbot_llm_rate_limiter_total", "LLM client-side rate limiter events", lambda: _per_backend('rate_limiter'), ("backend", "event")
+)
+registry.stats(
+    "smartbot_llm_circuit_total", "LLM circuit breaker openings and rejected calls", lambda: _per_backend('circuit_breaker'), ("backend", "event")
+)
+registry.stats("smartbot_llm_circuit_state", "LLM circuit breaker state", _circuit_states, ("backend", "state"), "gauge")
+if ai_service.cache is not None:
+    registry.stats("smartbot_response_cache_total", "Response cache lookups and maintenance", lambda: ai_service.cache.stats, "event")
+    registry.gauge("smartbot_response_cache_entries", "Entries in the response cache", function=lambda: len(ai_service.cache))
@@ -0,0 +1,294 @@
+"""
+Пакетная аналитика истории: тональность и ключевые слова по TF-IDF
+"""
+import re
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from loguru import logger
+from sqlalchemy import delete, insert, select, update
+
+from models import (
+    ChatInteraction, ChatKeyword, InteractionMessage, StoredMessage, db_manager, decode_message_body
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_WORD = re.compile(r'[^\W\d_]+')
+KEYWORD_MIN_LENGTH = 4
+STOP_WORDS = frozenset({
+    'это', 'того', 'этого', 'такой', 'такая', 'такие', 'очень', 'более', 'самый',
+    'если', 'когда', 'только', 'тоже', 'чтобы', 'потому', 'просто', 'вообще', 'можно', 'нужно',
+    'сейчас', 'какой', 'какая', 'какие', 'будет', 'было', 'есть', 'всем', 'всех', 'меня', 'тебя',
+    'него', 'нему', 'свой', 'своих', 'там', 'тут', 'here', 'there', 'this', 'that', 'with', 'have',
+})
+NEGATIONS = frozenset({'не', 'нет', 'ни', 'not', 'no'})
+
+# Оценочная лексика: основы из 4-5 первых букв слова или короткие слова целиком
+SENTIMENT_STEMS = {
+    **dict.fromkeys((
+        'хорош', 'отлич', 'супер', 'класс', 'крут', 'спаси', 'благо', 'рад', 'радос', 'люблю',
+        'нрави', 'прекр', 'здоро', 'ура', 'кайф', 'лучши', 'умниц', 'отпад',
+        'good', 'great', 'thank', 'love', 'nice', 'cool',
+    ), 1.0),
+    **dict.fromkeys((
+        'плох', 'груст', 'печал', 'пробл', 'ужас', 'беда', 'устал', 'ненав', 'злой', 'злюсь',
+        'бесит', 'отсто', 'кошма', 'обидн', 'жаль', 'слома', 'хуже', 'тоска', 'страш',
+        'bad', 'sad', 'hate', 'awful', 'broke',
+    ), -1.0),
+}
+
+
+def _polarity(word: str) -> float:
+    for stem in (word[:5], word[:4], word):
+        if stem in SENTIMENT_STEMS:
+            return SENTIMENT_STEMS[stem]
+    return 0.0
+
+
+class Chunk:
+    """
+    Пачка взаимодействий в виде плоских массивов NumPy.
+
+    Документ - контекст взаимодействия. Слова всех документов лежат
+    подряд: `docs` - номер документа каждого слова, `tokens` - номер
+    слова в словаре пачки. Соседние контексты состоят из одних и тех же
+    сообщений, поэтому каждое сообщение разбирается на слова один раз,
+    а признаки слов (хеш, ключевое ли, оценка) считаются один раз на
+    словарь и разворачиваются на все вхождения индексированием.
+    """
+
+    def __init__(self, contexts: List[List[int]], bodies: Dict[int, str], bits: int):
+        vocabulary: Dict[str, int] = {}
+        messages = {
+            message_id: numpy.array(
+                [vocabulary.setdefault(word, len(vocabulary)) for word in _WORD.findall(text.lower().replace('ё', 'е'))],
+                dtype=numpy.int64
+            )
+            for message_id, text in bodies.items()
+        }
+        parts = [messages[message_id] for context in contexts for message_id in context]
+        lengths = [sum(len(messages[message_id]) for message_id in context) for context in contexts]
+        self.size = len(contexts)
+        self.words = list(vocabulary)
+        mask = (1 << bits) - 1
+        self.buckets = numpy.fromiter(
+            (zlib.crc32(word.encode('utf-8')) & mask for word in self.words), dtype=numpy.int64, count=len(self.words)
+        )
+        self.is_keyword = numpy.fromiter(
+            (len(word) >= KEYWORD_MIN_LENGTH and word not in STOP_WORDS for word in self.words),
+            dtype=bool, count=len(self.words)
+        )
+        self.polarity = numpy.fromiter((_polarity(word) for word in self.words), dtype=numpy.float64, count=len(self.words))
+        self.is_negation = numpy.fromiter((word in NEGATIONS for word in self.words), dtype=bool, count=len(self.words))
+        self.docs = numpy.repeat(numpy.arange(self.size), lengths)
+        self.tokens = numpy.concatenate(parts) if parts else numpy.zeros(0, dtype=numpy.int64)
+
+    def keyword_pairs(self) -> Tuple[Any, Any, Any]:
+        """Уникальные пары (документ, ключевое слово) и число вхождений"""
+        keep = self.is_keyword[self.tokens]
+        width = max(len(self.words), 1)
+        keys, counts = numpy.unique(self.docs[keep] * width + self.tokens[keep], return_counts=True)
+        return keys // width, keys % width, counts
+
+    def sentiment(self):
+        """
+        Тональность документов от -1 до 1
+
+        Сумма оценок слов с учетом отрицания перед словом ("не плохо"),
+        сжатая tanh; документы без оценочных слов получают 0.
+        """
+        polarity = self.polarity[self.tokens]
+        negated = numpy.zeros(len(self.tokens), dtype=bool)
+        if len(self.tokens) > 1:
+            negated[1:] = self.is_negation[self.tokens[:-1]] & (self.docs[1:] == self.docs[:-1])
+        polarity = numpy.where(negated, -polarity, polarity)
+        return numpy.tanh(numpy.bincount(self.docs, weights=polarity, minlength=self.size))
+
+
+class AnalyticsEngine:
+    """
+    Офлайн аналитика всей истории chat_interactions двумя проходами.
+
+    Первый проход считает документную частоту слов в хешированном
+    массиве из 2**bits счетчиков, второй - TF-IDF слов каждого
+    взаимодействия и лексиконную тональность. Пустые detected_topic и
+    sentiment заполняются (с overwrite - перезаписываются), а главные
+    слова каждого чата накапливаются в таблицу chat_keywords. История
+    читается пачками по возрастанию id, поэтому память ограничена
+    размером пачки, массивом частот и `keywords_per_chat` словами на чат.
+    """
+
+    def __init__(
+        self,
+        bits: int = 20,
+        chunk_size: int = 2000,
+        top_keywords: int = 5,
+        keywords_per_chat: int = 50,
+        overwrite: bool = False,
+    ):
+        if numpy is None:
+            raise RuntimeError("numpy is required for batch analytics")
+        self.bits = bits
+        self.chunk_size = chunk_size
+        self.top_keywords = top_keywords
+        self.keywords_per_chat = keywords_per_chat
+        self.overwrite = overwrite
+        self.document_frequency = numpy.zeros(1 << bits, dtype=numpy.int32)
+        self.documents = 0
+        self.stats = {'rows': 0, 'topics_filled': 0, 'sentiments_filled': 0, 'chats': 0}
+
+    async def stream(self) -> AsyncIterator[Tuple[List[Tuple[int, int, datetime, Optional[str], Optional[float]]], Chunk]]:
+        """Пачки строк (id, chat_id, время, тема, тональность) с их контекстами, keyset по id"""
+        await db_manager.init_models()
+        last_id = 0
+        while True:
+            async with db_manager.get_session() as session:
+                rows = (await session.execute(
+                    select(
+                        ChatInteraction.id, ChatInteraction.chat_id, ChatInteraction.timestamp,
+                        ChatInteraction.detected_topic, ChatInteraction.sentiment
+                    )
+                    .where(ChatInteraction.id > last_id)
+                    .order_by(ChatInteraction.id)
+                    .limit(self.chunk_size)
+                )).all()
+                if not rows:
+                    return
+                contexts: Dict[int, List[int]] = defaultdict(list)
+                links = await session.execute(
+                    select(InteractionMessage.interaction_id, InteractionMessage.message_id)
+                    .where(InteractionMessage.interaction_id.between(rows[0].id, rows[-1].id))
+                    .order_by(InteractionMessage.interaction_id, InteractionMessage.position)
+                )
+                for interaction_id, message_id in links:
+                    contexts[interaction_id].append(message_id)
+                # Соседние контексты делят сообщения: каждый текст читается один раз
+                message_ids = list({message_id for context in contexts.values() for message_id in context})
+                bodies: Dict[int, str] = {}
+                for start in range(0, len(message_ids), 500):
+                    result = await session.execute(
+                        select(StoredMessage.id, StoredMessage.body, StoredMessage.codec)
+                        .where(StoredMessage.id.in_(message_ids[start:start + 500]))
+                    )
+                    for message_id, body, codec in result:
+                        bodies[message_id] = decode_message_body(body, codec)
+            yield [tuple(row) for row in rows], Chunk([contexts[row.id] for row in rows], bodies, self.bits)
+            last_id = rows[-1].id
+
+    async def count_frequencies(self):
+        """Проход 1: в скольких взаимодействиях встречается каждое слово (по хешу)"""
+        self.document_frequency[:] = 0
+        self.documents = 0
+        async for rows, chunk in self.stream():
+            _, words, _ = chunk.keyword_pairs()
+            numpy.add.at(self.document_frequency, chunk.buckets[words], 1)
+            self.documents += len(rows)
+
+    def _keywords(self, chunk: Chunk) -> List[List[Tuple[str, float]]]:
+        """Главные по TF-IDF слова каждого документа пачки"""
+        docs, words, counts = chunk.keyword_pairs()
+        idf = numpy.log((1 + self.documents) / (1 + self.document_frequency[chunk.buckets[words]])) + 1
+        scores = (1 + numpy.log(counts)) * idf
+        order = numpy.lexsort((-scores, docs))
+        docs, words, scores = docs[order], words[order], scores[order]
+        # Место слова внутри своего документа после сортировки
+        starts = numpy.searchsorted(docs, docs, side='left')
+        rank = numpy.arange(len(docs)) - starts
+        keep = rank < self.top_keywords
+        result: List[List[Tuple[str, float]]] = [[] for _ in range(chunk.size)]
+        for doc, word, score in zip(docs[keep].tolist(), words[keep].tolist(), scores[keep].tolist()):
+            result[doc].append((chunk.words[word], score))
+        return result
+
+    async def backfill(self, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Проход 2: тональность и темы взаимодействий, ключевые слова чатов
+
+        Каждая пачка исправлений вместе со сдвигом накопительной
+        статистики на разницу старых и новых значений пишется одной
+        транзакцией; статистика удаленной очисткой истории не теряется.
+        """
+        chat_keywords: Dict[int, Dict[str, List[float]]] = defaultdict(dict)
+        async for rows, chunk in self.stream():
+            keywords = self._keywords(chunk)
+            sentiment = numpy.round(chunk.sentiment(), 3).tolist()
+            updates, changes = [], []
+            for (interaction_id, chat_id, timestamp, topic, old_sentiment), top, score in zip(rows, keywords, sentiment):
+                values = {}
+                if top and (self.overwrite or not topic):
+                    values['detected_topic'] = top[0][0][:255]
+                if self.overwrite or old_sentiment is None:
+                    values['sentiment'] = score
+                if values:
+                    self.stats['topics_filled'] += 'detected_topic' in values
+                    self.stats['sentiments_filled'] += 'sentiment' in values
+                    updates.append({'id': interaction_id, 'detected_topic': values.get('detected_topic', topic),
+                                    'sentiment': values.get('sentiment', old_sentiment)})
+                    changes.append({'chat_id': chat_id, 'timestamp': timestamp,
+                                    'old_topic': topic, 'new_topic': updates[-1]['detected_topic'],
+                                    'old_sentiment': old_sentiment, 'new_sentiment': updates[-1]['sentiment']})
+                self._accumulate(chat_keywords[chat_id], top)
+            if updates and not dry_run:
+                async with db_manager.get_session() as session:
+                    # Сначала строки: на SQLite это берет блокировку записи до чтения счетчиков
+                    await session.execute(update(ChatInteraction), updates)
+                    await db_manager.adjust_rollups(session, changes)
+                    await session.commit()
+            self.stats['rows'] += len(rows)
+
+        self.stats['chats'] = len(chat_keywords)
+        if not dry_run:
+            await self._save_keywords(chat_keywords)
+        return self.stats
+
+    def _accumulate(self, totals: Dict[str, List[float]], top: List[Tuple[str, float]]):
+        for word, score in top:
+            entry = totals.setdefault(word, [0.0, 0])
+            entry[0] += score
+            entry[1] += 1
+        # Слабые слова отбрасываются, чтобы память не росла с историей чата
+        if len(totals) > self.keywords_per_chat * 4:
+            strongest = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:self.keywords_per_chat * 2]
+            totals.clear()
+            totals.update(strongest)
+
+    async def _save_keywords(self, chat_keywords: Dict[int, Dict[str, List[float]]]):
+        now = datetime.utcnow()
+        async with db_manager.get_session() as session:
+            await session.execute(delete(ChatKeyword))
+            for chat_id, totals in chat_keywords.items():
+                strongest = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:self.keywords_per_chat]
+                if strongest:
+                    await session.execute(insert(ChatKeyword), [
+                        {'chat_id': chat_id, 'keyword': word[:64], 'score': round(score, 4),
+                         'documents': documents, 'updated_at': now}
+                        for word, (score, documents) in strongest
+                    ])
+            await session.commit()
+
+    async def run(self, dry_run: bool = False, rebuild_stats: bool = False) -> Dict[str, Any]:
+        """
+        Оба прохода
+
+        rebuild_stats пересчитывает chat_stats с нуля по оставшейся истории:
+        счетчики удаленных очисткой взаимодействий при этом пропадают.
+        """
+        started = time.monotonic()
+        await self.count_frequencies()
+        logger.info(f"📚 Частоты слов: {self.documents} взаимодействий, занято корзин {int((self.document_frequency > 0).sum())}")
+        stats = await self.backfill(dry_run)
+        if rebuild_stats and not dry_run and (stats['topics_filled'] or stats['sentiments_filled']):
+            await db_manager.rebuild_stats()
+        stats['elapsed'] = time.monotonic() - started
+        logger.info(
+            f"📈 Аналитика: {stats['rows']} взаимодействий, тем заполнено {stats['topics_filled']}, "
+            f"тональностей {stats['sentiments_filled']}, чатов {stats['chats']} за {stats['elapsed']:.1f} с"
+        )
+        return stats
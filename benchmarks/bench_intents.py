@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Пропускная способность fallback классификатора: цепочка подстрок против IntentEngine
+
+Генерирует два корпуса синтетических реплик чата с долей триггеров
+интентов: обычная болтовня и болтовня со словами-ловушками вроде
+"бездельник", "денька", "добротный", на которых цепочка подстрок
+ошибается (и поэтому рано выходит). Оба корпуса классифицируются
+обеими реализациями:
+
+    python benchmarks/bench_intents.py --lines 200000
+
+Обе реализации вызываются напрямую, имя интента берется уже после
+замера; время - лучший из --repeat прогонов, чтобы шум соседних
+процессов не решал исход сравнения.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+CHATTER = (
+    "ну вот опять релиз отложили код завтра сервер лежит погода нормальная два коллеги обсуждаем "
+    "продакт менеджер спринт задача баг картошка python docker ссылку кинь смотрите понедельник "
+    "сегодня вчера ревью тесты упали деплой ночью база логи мы они тут там уже"
+).split()
+TRAPS = (
+    "ну вот опять релиз отложили бездельник выдержка проблемный код завтра вечеринка сервер "
+    "лежит погода отличная денька два коллеги обсуждаем продакт менеджер спринт задача баг "
+    "картошка python docker утроба преддверие ссылку кинь смотрите добротный понедельник"
+).split()
+PHRASES = (
+    "привет всем", "добрый день", "как дела", "что делаешь", "был в самарканде", "расскажи про ташкент",
+    "спасибо большое", "это супер", "все плохо", "проблема с сетью", "кто знает?", "доброе утро",
+)
+
+
+def legacy_classify(text: str) -> str:
+    """Цепочка подстрочных проверок из прежнего AIService._get_fallback_response"""
+    last_message = text.lower()
+    if any(word in last_message for word in ['привет', 'здравствуй', 'добро', 'утро', 'день', 'вечер']):
+        return "приветствие"
+    elif any(word in last_message for word in ['как дела', 'как ты', 'как жизнь', 'как настроение']):
+        return "самочувствие"
+    elif any(word in last_message for word in ['что делаешь', 'чем занят', 'что нового']):
+        return "деятельность"
+    elif any(word in last_message for word in ['узбекистан', 'узбекский', 'ташкент', 'самарканд']):
+        return "география_узбекистан"
+    elif any(word in last_message for word in ['что ты знаешь', 'расскажи', 'что можешь', 'информация']):
+        return "информационный_запрос"
+    elif any(word in last_message for word in ['спасибо', 'благодарю', 'thanks']):
+        return "благодарность"
+    elif any(word in last_message for word in ['хорошо', 'отлично', 'супер', 'класс', 'круто']):
+        return "позитив"
+    elif any(word in last_message for word in ['плохо', 'грустно', 'печально', 'проблем']):
+        return "поддержка"
+    elif '?' in last_message:
+        return "вопрос"
+    return "общение"
+
+
+def synthetic_corpus(lines: int, trigger_share: float, seed: int = 1, filler=TRAPS):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(lines):
+        words = [rng.choice(filler) for _ in range(rng.randint(3, 20))]
+        if rng.random() < trigger_share:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(PHRASES))
+        line = " ".join(words)
+        corpus.append(line.capitalize() + rng.choice(("", ".", "!", "?", " 🙂")))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк fallback классификатора интентов")
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--trigger-share", type=float, default=0.3, help="Доля реплик с триггером")
+    parser.add_argument("--repeat", type=int, default=3, help="Прогонов на реализацию, берется лучший")
+    args = parser.parse_args()
+
+    from intents import intent_engine
+
+    for corpus_title, filler in (("болтовня", CHATTER), ("ловушки", TRAPS)):
+        print(f"Корпус: {corpus_title}")
+        corpus = synthetic_corpus(args.lines, args.trigger_share, filler=filler)
+        results = {}
+        for title, classify, name in (
+            ("подстроки", legacy_classify, str),
+            ("IntentEngine", intent_engine.classify, lambda intent: intent.name),
+        ):
+            elapsed = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                labels = [classify(line) for line in corpus]
+                elapsed = min(elapsed, time.perf_counter() - started)
+            results[title] = [name(label) for label in labels]
+            print(f"  {title:<13} {args.lines / elapsed:12,.0f} строк/с   {elapsed / args.lines * 1e6:6.2f} мкс/строка")
+
+        disagreements = Counter(
+            (old, new) for old, new in zip(results["подстроки"], results["IntentEngine"]) if old != new
+        )
+        print(f"  Расхождений: {sum(disagreements.values()):,}")
+        for (old, new), count in disagreements.most_common(3):
+            example = next(
+                line for line, a, b in zip(corpus, results["подстроки"], results["IntentEngine"]) if (a, b) == (old, new)
+            )
+            print(f"    {old} -> {new}: {count:,}, например «{example}»")
+
+if __name__ == "__main__":
+    main()
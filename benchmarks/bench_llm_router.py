@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Стратегии маршрутизатора LLM на локальных заглушках (без сети)
+
+Два бэкенда-заглушки с логнормальной задержкой и долей ошибок; для
+каждой стратегии --clients параллельных клиентов отправляют --requests
+запросов, печатаются p50/p99 задержки и распределение по бэкендам:
+
+    python benchmarks/bench_llm_router.py --requests 2000 --clients 16
+    python benchmarks/bench_llm_router.py --primary-sigma 1.0 --hedge-delay 0.15
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] if ordered else 0.0
+
+
+async def run_strategy(strategy, args):
+    from llm_backends import LLMRouter, StubBackend
+
+    primary = StubBackend(
+        "primary", latency=args.primary_latency, latency_sigma=args.primary_sigma,
+        errors={"503": args.primary_errors}, seed=1, cost=0.0, failure_threshold=10 ** 6,
+    )
+    secondary = StubBackend(
+        "secondary", latency=args.secondary_latency, latency_sigma=0.3, seed=2, cost=1.0,
+    )
+    router = LLMRouter([primary, secondary], strategy, args.hedge_delay)
+    latencies, failures = [], 0
+    ids = iter(range(args.requests))
+
+    async def client():
+        nonlocal failures
+        for index in ids:
+            started = time.perf_counter()
+            try:
+                await router.complete('"should_respond"', f"- сообщение {index}?", args.deadline)
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+    print(
+        f"{strategy:<9} p50 {statistics.median(latencies) * 1000:7.1f} ms   p99 {percentile(latencies, 0.99) * 1000:7.1f} ms"
+        f"   ошибок {failures:4d}   primary {primary.stats['succeeded']:5d}   secondary {secondary.stats['succeeded']:5d}"
+        f"   дублей {router.stats['hedged']}"
+    )
+
+
+async def run(args):
+    from llm_backends import LLMRouter
+
+    for strategy in LLMRouter.STRATEGIES:
+        await run_strategy(strategy, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк стратегий маршрутизатора LLM")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--primary-latency", type=float, default=0.05, help="Медиана задержки основного, сек")
+    parser.add_argument("--primary-sigma", type=float, default=0.8, help="Разброс (хвост) основного")
+    parser.add_argument("--primary-errors", type=float, default=0.02, help="Доля ответов 503 основного")
+    parser.add_argument("--secondary-latency", type=float, default=0.08)
+    parser.add_argument("--hedge-delay", type=float, default=0.0, help="0 - по средней задержке")
+    parser.add_argument("--deadline", type=float, default=5.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк MessageBuffer: прежняя реализация против кольцевой
+
+Имитирует поток сообщений в --chats чатах (активность по закону Ципфа)
+и на каждое сообщение выполняет то же, что BotService.process_message:
+add_message, get_recent_messages и should_respond_by_frequency.
+
+    python benchmarks/bench_message_buffer.py --chats 10000 --messages 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+
+class LegacyMessageBuffer:
+    """Реализация до перехода на кольцевые буферы (для сравнения)"""
+
+    def __init__(self, max_messages: int = 20):
+        self.max_messages = max_messages
+        self.chat_messages = defaultdict(lambda: deque(maxlen=max_messages))
+        self.bot_response_counts = defaultdict(int)
+        self.last_response_time = defaultdict(lambda: datetime.min)
+
+    def add_message(self, chat_id: str, message: str, is_bot: bool = False):
+        self.chat_messages[chat_id].append({'text': message, 'timestamp': datetime.now(), 'is_bot': is_bot})
+        if is_bot:
+            self.bot_response_counts[chat_id] += 1
+            self.last_response_time[chat_id] = datetime.now()
+
+    def get_recent_messages(self, chat_id: str, limit: int = 10):
+        messages = list(self.chat_messages[chat_id])[-limit:]
+        return [msg['text'] for msg in messages if not msg['is_bot']]
+
+    def should_respond_by_frequency(self, chat_id: str) -> bool:
+        from ai_service import ai_service
+        recent_messages = len([
+            msg for msg in self.chat_messages[chat_id]
+            if not msg['is_bot'] and datetime.now() - msg['timestamp'] < timedelta(minutes=10)
+        ])
+        if datetime.now() - self.last_response_time[chat_id] < timedelta(seconds=30):
+            return False
+        bot_responses_recent = len([
+            msg for msg in self.chat_messages[chat_id]
+            if msg['is_bot'] and datetime.now() - msg['timestamp'] < timedelta(minutes=10)
+        ])
+        return ai_service.should_respond_based_on_frequency(recent_messages, bot_responses_recent)
+
+
+def workload(chats: int, messages: int, bot_share: float, seed: int = 7):
+    rng = random.Random(seed)
+    ids = [str(-1000000000000 - i) for i in range(chats)]
+    weights = [1.0 / (rank + 1) for rank in range(chats)]
+    texts = [f"сообщение номер {i} с каким-то текстом" for i in range(256)]
+    chosen = rng.choices(ids, weights, k=messages)
+    return [(chat_id, texts[i & 255], rng.random() < bot_share) for i, chat_id in enumerate(chosen)]
+
+
+def run(buffer, events, context: int) -> float:
+    started = time.perf_counter()
+    for chat_id, text, is_bot in events:
+        buffer.add_message(chat_id, text, is_bot)
+        if not is_bot:
+            buffer.get_recent_messages(chat_id, context)
+            buffer.should_respond_by_frequency(chat_id)
+    return time.perf_counter() - started
+
+
+def retained_memory(factory, events) -> int:
+    """Память, занятая буфером после прогона (замер отдельно от времени)"""
+    tracemalloc.start()
+    buffer = factory()
+    for chat_id, text, is_bot in events:
+        buffer.add_message(chat_id, text, is_bot)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк MessageBuffer")
+    parser.add_argument("--chats", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--bot-share", type=float, default=0.1, help="Доля ответов бота в потоке")
+    parser.add_argument("--context", type=int, default=10)
+    args = parser.parse_args()
+
+    from message_buffer import MessageBuffer
+
+    events = workload(args.chats, args.messages, args.bot_share)
+    print(f"{args.messages:,} сообщений в {args.chats:,} чатах, контекст {args.context}")
+    implementations = (("legacy", LegacyMessageBuffer), ("ring", lambda: MessageBuffer(idle_ttl=0)))
+    for name, factory in implementations:
+        elapsed = run(factory(), events, args.context)
+        memory = retained_memory(factory, events)
+        print(
+            f"  {name:<7} {args.messages / elapsed:>12,.0f} msg/s   "
+            f"{elapsed / args.messages * 1e6:6.2f} us/msg   память {memory / 2 ** 20:7.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
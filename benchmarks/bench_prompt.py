@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Размер и время сборки промпта: прежняя сборка против PromptBuilder
+
+Генерирует поток сообщений, где часть - длинные простыни (до 4000
+символов), и на каждое сообщение собирает промпт по скользящему окну
+контекста; сравнивает оценку токенов промпта и время сборки:
+
+    python benchmarks/bench_prompt.py --windows 2000 --long-share 0.2
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+WORDS = "привет как дела что думаете про новый релиз вчера сломалось опять python api бот 2024 ?".split()
+
+
+def legacy_prompt(context_messages, chat_title):
+    """Сборка промпта до PromptBuilder (для сравнения)"""
+    from prompt_builder import SYSTEM_BODY
+    context_text = "\n".join([f"- {msg}" for msg in context_messages[-5:]])
+    system_prompt = f'\nТы умный и полезный помощник в групповом чате "{chat_title or "Группа"}".\n{SYSTEM_BODY}'
+    user_prompt = f"\nПоследние сообщения в чате:\n{context_text}\n\nПроанализируй контекст и реши, стоит ли отвечать.\n"
+    return system_prompt, user_prompt
+
+
+def synthetic_stream(rng, size, long_share):
+    messages = []
+    for _ in range(size):
+        length = rng.randint(300, 700) if rng.random() < long_share else rng.randint(3, 25)
+        messages.append(" ".join(rng.choice(WORDS) for _ in range(length))[:4000])
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сборки промптов")
+    parser.add_argument("--windows", type=int, default=2000)
+    parser.add_argument("--context", type=int, default=10, help="Сообщений в окне (MAX_CONTEXT_MESSAGES)")
+    parser.add_argument("--long-share", type=float, default=0.2)
+    parser.add_argument("--budget", type=int, default=1500)
+    parser.add_argument("--max-message-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    from prompt_builder import PromptBuilder, estimate_tokens
+
+    rng = random.Random(1)
+    # Как в чате: каждое новое сообщение сдвигает окно контекста на одно
+    stream = synthetic_stream(rng, args.windows + args.context, args.long_share)
+    windows = [stream[index:index + args.context] for index in range(args.windows)]
+    titles = [f"Чат {index % 50}" for index in range(args.windows)]
+    builder = PromptBuilder(budget=args.budget, max_message_tokens=args.max_message_tokens)
+
+    for title, build in (
+        ("прежняя", lambda window, chat: legacy_prompt(window, chat)),
+        ("PromptBuilder", lambda window, chat: builder.build(window, chat)),
+    ):
+        estimate_tokens.cache_clear()
+        sizes = []
+        started = time.perf_counter()
+        for window, chat in zip(windows, titles):
+            result = build(window, chat)
+            sizes.append(result)
+        elapsed = time.perf_counter() - started
+        tokens = [
+            result.prompt_tokens if hasattr(result, 'prompt_tokens') else estimate_tokens(result[0] + result[1])
+            for result in sizes
+        ]
+        print(
+            f"{title:<14} сборка {elapsed / args.windows * 1e6:7.1f} мкс   токенов: "
+            f"среднее {statistics.mean(tokens):7.0f}   p99 {sorted(tokens)[int(len(tokens) * 0.99)]:6d}   max {max(tokens):6d}"
+        )
+    print(f"  PromptBuilder: {builder.report()}")
+
+
+if __name__ == "__main__":
+    main()
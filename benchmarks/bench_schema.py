@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк схемы chat_interactions до и после миграций
+
+Создает SQLite базу со старой схемой (chat_id строкой, sentiment строкой,
+контекст JSON колонкой, одиночный индекс по chat_id), заполняет ее
+синтетической историей с перекрывающимися окнами контекста, замеряет
+размер базы и запросы истории и статистики, применяет миграции и
+повторяет замеры на новой схеме:
+
+    python benchmarks/bench_schema.py --rows 10000000 --chats 2000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+LEGACY_SCHEMA = """
+CREATE TABLE chat_interactions (
+    id INTEGER NOT NULL,
+    timestamp DATETIME NOT NULL,
+    chat_id VARCHAR(50) NOT NULL,
+    chat_title VARCHAR(255),
+    context_messages JSON NOT NULL,
+    detected_topic VARCHAR(255),
+    sentiment VARCHAR(20),
+    bot_response TEXT,
+    response_generated BOOLEAN NOT NULL,
+    participants_count INTEGER NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE INDEX ix_chat_interactions_chat_id ON chat_interactions (chat_id);
+"""
+
+TOPICS = ["общение", "работа", "погода", "игры", "технологии", "еда", "спорт", None]
+WORDS = "привет как дела кто идет сегодня вечером погода отличная работа проект встреча игра матч обед".split()
+
+# Те же запросы, что выполняет DatabaseManager, в двух вариантах схемы
+QUERIES = {
+    "history (50 последних)": (
+        "SELECT * FROM chat_interactions WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 50",
+        "SELECT * FROM chat_interactions WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 50",
+    ),
+    "stats (count/responses/avg)": (
+        "SELECT count(*), sum(response_generated), avg(CAST(sentiment AS REAL)) "
+        "FROM chat_interactions WHERE chat_id = ?",
+        "SELECT count(*), sum(response_generated), avg(sentiment) "
+        "FROM chat_interactions WHERE chat_id = ?",
+    ),
+    "bot responses (20 последних)": (
+        "SELECT * FROM chat_interactions WHERE chat_id = ? AND response_generated = 1 "
+        "ORDER BY timestamp DESC LIMIT 20",
+        "SELECT * FROM chat_interactions WHERE chat_id = ? AND response_generated IS 1 "
+        "ORDER BY timestamp DESC LIMIT 20",
+    ),
+}
+
+
+def chat_ids(count: int):
+    return [-1000000000000 - i for i in range(count)]
+
+
+def populate(path: str, rows: int, chats: int, context: int, batch: int = 50000):
+    connection = sqlite3.connect(path)
+    connection.executescript(LEGACY_SCHEMA)
+    rng = random.Random(42)
+    ids = chat_ids(chats)
+    # Неравномерная активность: часть чатов пишет гораздо чаще остальных
+    weights = [1.0 / (rank + 1) ** 0.8 for rank in range(chats)]
+    started = datetime(2024, 1, 1)
+    step = timedelta(days=365) / rows
+    # Как в MessageBuffer: каждое взаимодействие хранит скользящее окно чата
+    windows = {chat_id: deque(maxlen=context) for chat_id in ids}
+
+    def generate():
+        for offset in range(0, rows, batch):
+            chosen = rng.choices(ids, weights, k=min(batch, rows - offset))
+            for i, chat_id in enumerate(chosen):
+                responded = rng.random() < 0.15
+                windows[chat_id].append(" ".join(rng.choices(WORDS, k=rng.randint(3, 25))) + f" #{offset + i}")
+                yield (
+                    (started + step * (offset + i)).isoformat(sep=" "),
+                    str(chat_id),
+                    f"Чат {chat_id}",
+                    json.dumps(list(windows[chat_id]), ensure_ascii=False),
+                    rng.choice(TOPICS),
+                    f"{rng.uniform(-1, 1):.2f}",
+                    "Ответ бота" if responded else None,
+                    int(responded),
+                    rng.randint(1, 10),
+                )
+
+    connection.executemany(
+        "INSERT INTO chat_interactions (timestamp, chat_id, chat_title, context_messages, "
+        "detected_topic, sentiment, bot_response, response_generated, participants_count) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        generate(),
+    )
+    connection.commit()
+    connection.close()
+
+
+def measure(path: str, legacy: bool, probes, repeat: int):
+    connection = sqlite3.connect(path)
+    results = {}
+    for name, (legacy_sql, sql) in QUERIES.items():
+        query = legacy_sql if legacy else sql
+        timings = []
+        for _ in range(repeat):
+            for chat_id in probes:
+                started = time.perf_counter()
+                connection.execute(query, (str(chat_id) if legacy else chat_id,)).fetchall()
+                timings.append(time.perf_counter() - started)
+        plan = connection.execute("EXPLAIN QUERY PLAN " + query, (probes[0],)).fetchall()
+        results[name] = (statistics.median(timings), max(timings), plan[-1][-1])
+    connection.close()
+    return results
+
+
+def migrate(path: str) -> float:
+    from sqlalchemy import create_engine
+    from migrations import upgrade
+
+    engine = create_engine(f"sqlite:///{path}")
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        upgrade(connection)
+    engine.dispose()
+    connection = sqlite3.connect(path)
+    connection.execute("VACUUM")
+    connection.close()
+    return time.perf_counter() - started
+
+
+def table_sizes(path: str):
+    """Размер базы и основных таблиц в МБ (через dbstat, если доступен)"""
+    connection = sqlite3.connect(path)
+    sizes = {"total": os.path.getsize(path) / 2 ** 20}
+    try:
+        for name, size in connection.execute(
+            "SELECT name, sum(pgsize) FROM dbstat WHERE name IN "
+            "('chat_interactions', 'messages', 'interaction_messages') GROUP BY name"
+        ):
+            sizes[name] = size / 2 ** 20
+    except sqlite3.OperationalError:
+        pass
+    connection.close()
+    return ", ".join(f"{name} {size:.1f} MB" for name, size in sizes.items())
+
+
+def report(title: str, results):
+    print(f"\n{title}")
+    for name, (median, worst, plan) in results.items():
+        print(f"  {name:<30} median {median * 1000:8.2f} ms   max {worst * 1000:8.2f} ms   {plan}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк схемы chat_interactions")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--context", type=int, default=10, help="Размер окна контекста")
+    parser.add_argument("--probes", type=int, default=20, help="Сколько чатов опрашивать")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--path", default="benchmarks/bench_schema.db")
+    parser.add_argument("--keep", action="store_true", help="Не удалять базу после замеров")
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        os.remove(args.path)
+
+    started = time.perf_counter()
+    populate(args.path, args.rows, args.chats, args.context)
+    print(f"Сгенерировано {args.rows:,} строк за {time.perf_counter() - started:.1f}s")
+    print(f"Размер до миграции: {table_sizes(args.path)}")
+
+    # Самые активные чаты - худший случай для сортировки без составного индекса
+    probes = chat_ids(args.chats)[:args.probes]
+    report("До миграции (v1):", measure(args.path, True, probes, args.repeat))
+    print(f"\nМиграция до последней версии заняла {migrate(args.path):.1f}s")
+    print(f"Размер после миграции: {table_sizes(args.path)}")
+    report("После миграций:", measure(args.path, False, probes, args.repeat))
+
+    if not args.keep:
+        os.remove(args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк шардирования: равномерность кольца, доля переездов и масштабирование по ядрам
+
+Маршрутизация та же, что у ShardSupervisor (HashRing + очередь на процесс),
+обработка обновления заменена CPU-нагрузкой, сравнимой с разбором JSON,
+работой буфера и подготовкой промпта в BotService:
+
+    python benchmarks/bench_sharding.py --updates 200000 --workers 1 2 4
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+
+def handle(inbox, done, work):
+    """Имитация обработчика: буфер чата и немного вычислений на сообщение"""
+    buffers = collections.defaultdict(lambda: collections.deque(maxlen=20))
+    handled = 0
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        for raw in batch:
+            update = json.loads(raw)
+            chat = buffers[update["message"]["chat"]["id"]]
+            chat.append(update["message"]["text"])
+            for _ in range(work):
+                " ".join(chat).lower().split()
+            handled += 1
+    done.put(handled)
+
+
+def updates(count: int, chats: int):
+    return [
+        json.dumps({"update_id": i, "message": {"chat": {"id": -1000000000000 - i % chats}, "text": f"сообщение {i}"}})
+        for i in range(count)
+    ]
+
+
+def run(workers: int, raw_updates, chats: int, work: int, batch: int) -> float:
+    from sharding import HashRing
+
+    context = multiprocessing.get_context("spawn")
+    ring = HashRing([f"shard-{i}" for i in range(workers)])
+    inboxes = {name: context.Queue() for name in ring.nodes}
+    done = context.Queue()
+    processes = [context.Process(target=handle, args=(inboxes[name], done, work)) for name in ring.nodes]
+    for process in processes:
+        process.start()
+    owners = {chat: ring.node_for(str(-1000000000000 - chat)) for chat in range(chats)}
+
+    started = time.perf_counter()
+    pending = {name: [] for name in ring.nodes}
+    for i, raw in enumerate(raw_updates):
+        name = owners[i % chats]
+        pending[name].append(raw)
+        if len(pending[name]) >= batch:
+            inboxes[name].put(pending[name])
+            pending[name] = []
+    for name, inbox in inboxes.items():
+        if pending[name]:
+            inbox.put(pending[name])
+        inbox.put(None)
+    handled = sum(done.get() for _ in processes)
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    assert handled == len(raw_updates)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк шардирования по chat_id")
+    parser.add_argument("--updates", type=int, default=200_000)
+    parser.add_argument("--chats", type=int, default=5000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--work", type=int, default=20, help="Условная CPU-нагрузка на сообщение")
+    parser.add_argument("--batch", type=int, default=64, help="Обновлений в одной передаче в очередь")
+    args = parser.parse_args()
+
+    from sharding import HashRing
+
+    keys = [str(-1000000000000 - i) for i in range(100_000)]
+    for workers in args.workers:
+        ring = HashRing([f"shard-{i}" for i in range(workers)])
+        grown = HashRing([f"shard-{i}" for i in range(workers + 1)])
+        load = collections.Counter(ring.node_for(key) for key in keys)
+        moved = sum(ring.node_for(key) != grown.node_for(key) for key in keys) / len(keys)
+        print(f"{workers} процесс(ов): нагрузка max/avg {max(load.values()) / (len(keys) / workers):.2f}, "
+              f"при добавлении процесса переезжает {moved:.1%} чатов")
+
+    raw_updates = updates(args.updates, args.chats)
+    baseline = None
+    for workers in args.workers:
+        elapsed = run(workers, raw_updates, args.chats, args.work, args.batch)
+        baseline = baseline or elapsed
+        print(f"  {workers} процесс(ов): {args.updates / elapsed:>10,.0f} upd/s   ускорение x{baseline / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк снимков буфера сообщений: запись, инкрементальная запись и теплый старт
+
+    python benchmarks/bench_snapshot.py --chats 10000 --messages 20 --eager-share 0.1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+
+async def run(args):
+    from buffer_snapshot import BufferSnapshotter
+    from message_buffer import MessageBuffer
+
+    path = os.path.join(tempfile.mkdtemp(), "buffer.snapshot")
+    buffer = MessageBuffer(idle_ttl=0, memory_budget=0)
+    for chat in range(args.chats):
+        for i in range(args.messages):
+            buffer.add_message(str(-1000000000000 - chat), f"сообщение {i} в чате {chat} с каким-то текстом")
+
+    snapshotter = BufferSnapshotter(buffer, path)
+    started = time.perf_counter()
+    await snapshotter.snapshot()
+    full = time.perf_counter() - started
+    print(f"Полный снимок {args.chats:,} чатов: {full * 1000:.0f} ms, {os.path.getsize(path) / 2 ** 20:.1f} MB")
+
+    active = max(1, int(args.chats * args.eager_share))
+    for chat in range(active):
+        buffer.add_message(str(-1000000000000 - chat), "новое сообщение")
+    started = time.perf_counter()
+    await snapshotter.snapshot()
+    print(f"Инкрементальный снимок {active:,} чатов: {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    # Старт, когда недавно писали все чаты, против старта с ленивой загрузкой
+    for eager_window, title in ((float('inf'), "все сразу"), (0.0, "лениво")):
+        started = time.perf_counter()
+        restored = BufferSnapshotter(MessageBuffer(idle_ttl=0, memory_budget=0), path, eager_window=eager_window)
+        restored.load()
+        print(f"Теплый старт ({title}): {(time.perf_counter() - started) * 1000:.0f} ms, "
+              f"в памяти {len(restored.buffer.chats):,} чатов, по требованию {len(restored.lazy):,}")
+
+    started = time.perf_counter()
+    for chat in range(active):
+        await restored.buffer.ensure_loaded(str(-1000000000000 - chat))
+    print(f"Ленивая подгрузка: {(time.perf_counter() - started) / active * 1e6:.1f} us/чат")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк снимков буфера сообщений")
+    parser.add_argument("--chats", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=20, help="Сообщений в буфере каждого чата")
+    parser.add_argument("--eager-share", type=float, default=0.1, help="Доля чатов, изменившихся между снимками")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Разбор JSON ответов LLM: строгий json.loads против StructuredOutputParser
+
+Корпус синтетических ответов модели: корректный JSON и типичные поломки
+(markdown блок, текст вокруг, висячая запятая, Python литералы, обрыв по
+max_tokens). Печатает время на ответ и сколько ответов каждый способ
+спасает, с orjson и без него:
+
+    python benchmarks/bench_structured_output.py --replies 100000 --broken-share 0.1
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+RESPONSES = (
+    "Привет! Как дела?",
+    "Ташкент - столица Узбекистана, город с двухтысячелетней историей и отличной кухней. Стоит съездить весной.",
+    "Попробуйте перезапустить сервер и посмотреть логи \"worker\" - там обычно видно причину.",
+    None,
+)
+
+
+def breakages(rng, reply):
+    text = json.dumps(reply, ensure_ascii=False, indent=rng.choice((None, 4)))
+    return rng.choice((
+        lambda: f"```json\n{text}\n```",
+        lambda: f"Вот мой анализ:\n{text}\nНадеюсь, это поможет!",
+        lambda: text[:-1].rstrip() + ",\n}",
+        lambda: text.replace("true", "True").replace("false", "False").replace("null", "None"),
+        lambda: text[:len(text) * 3 // 4],
+    ))()
+
+
+def synthetic_replies(count, broken_share, seed=1):
+    rng = random.Random(seed)
+    replies = []
+    for _ in range(count):
+        response = rng.choice(RESPONSES)
+        reply = {
+            "detected_topic": rng.choice(("общение", "работа", "путешествия")),
+            "sentiment": round(rng.uniform(-1, 1), 2),
+            "should_respond": response is not None,
+            "response": response,
+        }
+        broken = rng.random() < broken_share
+        replies.append(breakages(rng, reply) if broken else json.dumps(reply, ensure_ascii=False))
+    return replies
+
+
+def strict(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора JSON ответов LLM")
+    parser.add_argument("--replies", type=int, default=100_000)
+    parser.add_argument("--broken-share", type=float, default=0.1, help="Доля испорченных ответов")
+    args = parser.parse_args()
+
+    import structured_output
+    from structured_output import StructuredOutputError, StructuredOutputParser
+
+    replies = synthetic_replies(args.replies, args.broken_share)
+
+    def tolerant(text, output_parser):
+        try:
+            return output_parser.parse(text)
+        except StructuredOutputError:
+            return None
+
+    backends = [("json.loads", None)]
+    if structured_output.orjson is not None:
+        backends.insert(0, ("orjson", structured_output.orjson))
+    structured_output.logger.remove()
+
+    started = time.perf_counter()
+    parsed = sum(strict(text) is not None for text in replies)
+    elapsed = time.perf_counter() - started
+    print(f"{'json.loads строго':<28} {elapsed / args.replies * 1e6:6.2f} мкс/ответ   разобрано {parsed / args.replies:7.2%}")
+
+    for title, backend in backends:
+        structured_output.orjson = backend
+        output_parser = StructuredOutputParser()
+        started = time.perf_counter()
+        for text in replies:
+            tolerant(text, output_parser)
+        elapsed = time.perf_counter() - started
+        stats = output_parser.stats
+        print(
+            f"{'Parser (' + title + ')':<28} {elapsed / args.replies * 1e6:6.2f} мкс/ответ   "
+            f"разобрано {stats['parsed'] / args.replies:7.2%}   восстановлено {stats['repaired']:,}   "
+            f"потеряно {stats['failed']:,}"
+        )
+
+
+if __name__ == "__main__":
+    main()
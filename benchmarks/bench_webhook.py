@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Генератор нагрузки на вебхук: синтетические обновления Telegram по HTTP
+
+Без --url поднимает в этом же процессе HttpServer с WebhookIngress и
+замеряет, помимо подтверждения HTTP, сквозную задержку до передачи
+обновления дальше (sink). С --url нагружает уже запущенного бота
+(WEBHOOK_SECRET должен совпадать с --secret), замеряется только ответ:
+
+    python benchmarks/bench_webhook.py --requests 50000 --connections 50
+    python benchmarks/bench_webhook.py --url http://127.0.0.1:8443/telegram --secret ...
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+
+def synthetic_update(update_id: int, chats: int) -> dict:
+    chat_id = -1000000000000 - update_id % chats
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Чат {chat_id}"},
+            "from": {"id": 1000 + update_id % 977, "is_bot": False, "first_name": "Тест"},
+            "text": f"синтетическое сообщение {update_id}",
+        },
+        # Время отправки для сквозной задержки (Telegram это поле не шлет)
+        "sent_at": time.perf_counter(),
+    }
+
+
+async def client(host, port, path, secret, ids, chats, ack_latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for update_id in ids:
+            body = json.dumps(synthetic_update(update_id, chats), ensure_ascii=False).encode()
+            request = (
+                f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n"
+            ).encode() + body
+            started = time.perf_counter()
+            writer.write(request)
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b""):
+                    break
+                name, _, value = header.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            if length:
+                await reader.readexactly(length)
+            ack_latencies.append(time.perf_counter() - started)
+            status = int(status_line.split()[1])
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] if ordered else 0.0
+
+
+async def run(args):
+    end_to_end = []
+    ingress = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port, path = parts.hostname, parts.port or 80, parts.path or "/"
+    else:
+        from http_server import HttpServer, WebhookIngress
+
+        async def sink(update):
+            end_to_end.append(time.perf_counter() - update["sent_at"])
+
+        server = HttpServer("127.0.0.1", 0)
+        ingress = WebhookIngress(sink, args.secret, "/telegram", queue_size=args.queue_size)
+        ingress.attach(server)
+        ingress.start()
+        await server.start()
+        host, port, path = "127.0.0.1", server.port, "/telegram"
+
+    ack_latencies, statuses = [], {}
+    ids = list(range(args.requests))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(host, port, path, args.secret, ids[index::args.connections], args.chats, ack_latencies, statuses)
+        for index in range(args.connections)
+    ))
+    if ingress is not None:
+        await ingress.stop()
+        await server.stop()
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.requests:,} обновлений, {args.connections} соединений: {args.requests / elapsed:,.0f} upd/s")
+    print(f"  статусы: {statuses}")
+    for title, values in (("ответ HTTP", ack_latencies), ("сквозная", end_to_end)):
+        if values:
+            print(
+                f"  {title:<11} p50 {statistics.median(values) * 1000:7.2f} ms   "
+                f"p99 {percentile(values, 0.99) * 1000:7.2f} ms   max {max(values) * 1000:7.2f} ms"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузка на вебхук SmartGroupBot")
+    parser.add_argument("--url", help="Адрес запущенного бота; без него сервер поднимается локально")
+    parser.add_argument("--secret", default="benchmark-secret")
+    parser.add_argument("--requests", type=int, default=50_000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--queue-size", type=int, default=10_000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
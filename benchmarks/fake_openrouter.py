@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Локальный фейковый OpenRouter для проверки слоя ограничения частоты
+
+Сервер принимает POST /api/v1/chat/completions, пропускает не больше
+--limit запросов за --window секунд и отвечает 429 с Retry-After сверх
+лимита. Дополнительно можно задать сценарий статусов (--script 200,429,503),
+который проигрывается по кругу поверх лимита.
+
+Драйвер гоняет OpenAICompatibleBackend с N параллельными клиентами и сравнивает достигнутую пропускную способность с лимитом:
+
+    python benchmarks/fake_openrouter.py --limit 10 --window 1 --duration 10 --clients 8
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+COMPLETION = {
+    "id": "fake",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "fake",
+    "choices": [{
+        "index": 0,
+        "finish_reason": "stop",
+        "message": {
+            "role": "assistant",
+            "content": json.dumps({
+                "detected_topic": "тест",
+                "sentiment": 0.5,
+                "should_respond": False,
+                "response": None
+            })
+        }
+    }]
+}
+
+
+class FakeOpenRouter:
+    """Сервер со скользящим окном лимита и сценарием ошибок"""
+
+    def __init__(self, limit: int, window: float, script=None):
+        self.limit = limit
+        self.window = window
+        self.script = itertools.cycle(script) if script else None
+        self.accepted = deque()
+        self.stats = {'requests': 0, 'ok': 0, '429': 0, 'errors': 0}
+
+    def _status(self) -> int:
+        now = time.monotonic()
+        while self.accepted and now - self.accepted[0] >= self.window:
+            self.accepted.popleft()
+        scripted = next(self.script) if self.script else 200
+        if scripted != 200:
+            return scripted
+        if len(self.accepted) >= self.limit:
+            return 429
+        self.accepted.append(now)
+        return 200
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value.strip())
+                if length:
+                    await reader.readexactly(length)
+
+                self.stats['requests'] += 1
+                status = self._status()
+                headers = {
+                    "content-type": "application/json",
+                    "x-ratelimit-limit": str(self.limit),
+                    "x-ratelimit-remaining": str(max(0, self.limit - len(self.accepted))),
+                }
+                if status == 200:
+                    self.stats['ok'] += 1
+                    body = json.dumps(COMPLETION).encode()
+                else:
+                    self.stats['429' if status == 429 else 'errors'] += 1
+                    oldest = self.accepted[0] if self.accepted else time.monotonic()
+                    retry_after = max(0.0, self.window - (time.monotonic() - oldest))
+                    headers["retry-after"] = f"{retry_after:.3f}"
+                    body = json.dumps({"error": {"message": "rate limited", "code": status}}).encode()
+
+                headers["content-length"] = str(len(body))
+                head = f"HTTP/1.1 {status} X\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+                writer.write(head.encode() + b"\r\n" + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+async def run(args):
+    from llm_backends import OpenAICompatibleBackend
+
+    fake = FakeOpenRouter(args.limit, args.window, [int(x) for x in args.script.split(",")] if args.script else None)
+    server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    service = OpenAICompatibleBackend(
+        "fake", "fake", f"http://127.0.0.1:{port}/api/v1", "benchmark", rpm=args.limit * 60.0 / args.window
+    )
+
+    results = {'ok': 0, 'failed': 0}
+    latencies = []
+    started_at = time.monotonic()
+    stop_at = started_at + args.duration
+
+    async def client_loop():
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            try:
+                await service.complete("system", "user", args.deadline)
+                results['ok'] += 1
+                latencies.append(time.monotonic() - started)
+            except Exception:
+                results['failed'] += 1
+                await asyncio.sleep(0.05)
+
+    await asyncio.gather(*[client_loop() for _ in range(args.clients)])
+    elapsed = time.monotonic() - started_at
+    await service.close()
+    server.close()
+    await server.wait_closed()
+
+    latencies.sort()
+    achieved = results['ok'] / elapsed
+    target = args.limit / args.window
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+    print(f"Лимит провайдера:     {target:.2f} req/s")
+    print(f"Достигнуто:           {achieved:.2f} req/s ({achieved / target:.0%} лимита)")
+    print(f"Успешных / ошибок:    {results['ok']} / {results['failed']}")
+    print(f"Ответов 429 сервера:  {fake.stats['429']} из {fake.stats['requests']}")
+    print(f"p99 латентность:      {p99 * 1000:.0f} ms")
+    print(f"Лимитер: {service.rate_limiter.stats}, предохранитель: {service.circuit_breaker.stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый OpenRouter с лимитами")
+    parser.add_argument("--limit", type=int, default=10, help="Запросов за окно")
+    parser.add_argument("--window", type=float, default=1.0, help="Окно лимита, сек")
+    parser.add_argument("--script", default="", help="Сценарий статусов по кругу, например 200,429,503")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--deadline", type=float, default=15.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,80 +1,52 @@
 """
 Основной сервис Telegram бота
 """
-from typing import List, Dict, Any, Optional
-from datetime import datetime, timedelta
-from collections import defaultdict, deque
+from typing import List, Dict, Any, Optional, Callable
 import asyncio
+import time
 from loguru import logger
 
-from models import db_manager, ChatInteraction
+from models import db_manager
 from ai_service import ai_service
+from chat_scheduler import ChatScheduler
+from message_buffer import MessageBuffer
+from buffer_snapshot import create_snapshotter
+from summarizer import create_summarizer
+from relevance import create_relevance_gate
+from persistence import interaction_writer
+from metrics import messages_total, registry, stage_seconds
 from config import config
 
 
-class MessageBuffer:
-    """Буфер для хранения последних сообщений по чатам"""
-    
-    def __init__(self, max_messages: int = 20):
-        self.max_messages = max_messages
-        self.chat_messages = defaultdict(lambda: deque(maxlen=max_messages))
-        self.bot_response_counts = defaultdict(int)
-        self.last_response_time = defaultdict(lambda: datetime.min)
-    
-    def add_message(self, chat_id: str, message: str, is_bot: bool = False):
-        """Добавляет сообщение в буфер"""
-        self.chat_messages[chat_id].append({
-            'text': message,
-            'timestamp': datetime.now(),
-            'is_bot': is_bot
-        })
-        
-        if is_bot:
-            self.bot_response_counts[chat_id] += 1
-            self.last_response_time[chat_id] = datetime.now()
-    
-    def get_recent_messages(self, chat_id: str, limit: int = None) -> List[str]:
-        """Получает последние сообщения из чата"""
-        limit = limit or config.max_context_messages
-        messages = list(self.chat_messages[chat_id])[-limit:]
-        return [msg['text'] for msg in messages if not msg['is_bot']]
-    
-    def get_participants_count(self, chat_id: str) -> int:
-        """Подсчитывает количество уникальных участников (упрощенная версия)"""
-        # В реальной реализации здесь был бы анализ пользователей
-        return min(len(self.chat_messages[chat_id]), 10)
-    
-    def should_respond_by_frequency(self, chat_id: str) -> bool:
-        """Проверяет, можно ли отвечать по частоте"""
-        recent_messages = len([
-            msg for msg in self.chat_messages[chat_id] 
-            if not msg['is_bot'] and 
-            datetime.now() - msg['timestamp'] < timedelta(minutes=10)
-        ])
-        
-        # Проверяем, не отвечал ли бот недавно
-        time_since_last_response = datetime.now() - self.last_response_time[chat_id]
-        if time_since_last_response < timedelta(seconds=30):
-            return False
-        
-        # Логика частоты ответов
-        bot_responses_recent = len([
-            msg for msg in self.chat_messages[chat_id] 
-            if msg['is_bot'] and 
-            datetime.now() - msg['timestamp'] < timedelta(minutes=10)
-        ])
-        
-        return ai_service.should_respond_based_on_frequency(
-            recent_messages, bot_responses_recent
-        )
-
-
 class BotService:
     """Основной сервис бота"""
     
     def __init__(self):
         self.message_buffer = MessageBuffer()
+        # Теплый старт: недавние чаты сразу, остальные - при первом сообщении
+        self.snapshots = create_snapshotter(self.message_buffer)
+        if self.snapshots:
+            try:
+                self.snapshots.load()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось загрузить снимок буфера: {e}")
+        self.scheduler = ChatScheduler(coalesce_window=config.coalesce_window)
+        self.summarizer = create_summarizer(self.message_buffer)
+        self.relevance = create_relevance_gate()
+        self._register_metrics()
         logger.info("✅ BotService инициализирован")
+
+    def _register_metrics(self):
+        """Счетчики компонентов в /metrics (читаются только при сборе)"""
+        registry.stats(
+            "smartbot_buffer", "Message buffer memory state", lambda: self.message_buffer.gauges, "field", "gauge"
+        )
+        registry.stats("smartbot_buffer_events_total", "Message buffer evictions and spills", lambda: self.message_buffer.stats, "event")
+        if self.relevance:
+            registry.stats("smartbot_relevance_total", "Local relevance gate decisions", lambda: self.relevance.stats, "decision")
+        registry.stats("smartbot_scheduler_total", "Per-chat analysis scheduling events", lambda: self.scheduler.stats, "event")
+        if self.summarizer:
+            registry.stats("smartbot_summaries_total", "Rolling chat summaries by result", lambda: self.summarizer.stats, "result")
     
     async def process_message(
         self, 
@@ -82,61 +54,73 @@ class BotService:
         chat_title: str, 
         message_text: str,
         user_id: str = None,
-        username: str = None
+        username: str = None,
+        on_partial: Callable[[str], None] = None
     ) -> Optional[str]:
         """
         Обрабатывает входящее сообщение и решает, нужно ли отвечать
+        
+        on_partial получает промежуточный текст ответа при потоковой генерации
         """
+        started = time.perf_counter()
         try:
             # Валидация входных данных
             if not chat_id or not message_text:
                 logger.warning("⚠️ Некорректные данные сообщения")
-                return None
+                return self._finish("invalid", started)
                 
             # Ограничиваем длину сообщения
             if len(message_text) > 4000:
                 message_text = message_text[:4000] + "..."
                 logger.info("✂️ Обрезано длинное сообщение")
             
-            # Добавляем сообщение в буфер
+            # Добавляем сообщение в буфер (вытесненный ранее буфер подгружается из БД)
+            await self.message_buffer.ensure_loaded(chat_id)
             self.message_buffer.add_message(chat_id, message_text, is_bot=False)
+            if self.summarizer:
+                self.summarizer.note(chat_id)
             
             # Получаем историю сообщений для анализа
             context_messages = self.message_buffer.get_recent_messages(chat_id, config.max_context_messages)
+            buffered = time.perf_counter()
+            stage_seconds.labels("buffer").observe(buffered - started)
             
             if len(context_messages) < config.min_context_messages:
                 logger.debug(f"⏳ Недостаточно контекста для анализа ({len(context_messages)}/{config.min_context_messages})")
-                return None
+                return self._finish("no_context", started)
             
             # Проверяем частоту ответов
             if not self.message_buffer.should_respond_by_frequency(chat_id):
                 logger.debug("⏭️ Пропуск - частота ответов")
-                return None
+                return self._finish("frequency_gate", started)
+            
+            # Локальная модель отсекает контексты, на которые LLM почти наверняка не ответит
+            if self.relevance:
+                escalate = self.relevance.should_escalate(context_messages)
+                stage_seconds.labels("relevance").observe(time.perf_counter() - buffered)
+                if not escalate:
+                    return self._finish("relevance_gate", started)
+            
+            # Один активный анализ на чат, свежие сообщения сворачиваются
+            analysis_started = time.perf_counter()
+            scheduled = await self.scheduler.run(
+                chat_id, lambda on_start: self._analyze_context(chat_id, chat_title, on_partial, on_start)
+            )
+            stage_seconds.labels("analysis").observe(time.perf_counter() - analysis_started)
+            if scheduled is None:
+                logger.debug("🧺 Анализ свернут в более свежий запрос")
+                return self._finish("coalesced", started)
             
-            logger.info(f"🤔 Анализируем контекст в '{chat_title}' ({len(context_messages)} сообщений)")
-            
-            # Анализируем контекст с таймаутом
-            ai_result = None
-            try:
-                ai_result = await asyncio.wait_for(
-                    ai_service.analyze_context_and_generate_response(context_messages, chat_title),
-                    timeout=15  # Таймаут 15 секунд
-                )
-            except asyncio.TimeoutError:
-                logger.warning("⏰ Таймаут AI анализа, используем fallback")
-                ai_result = {"should_respond": True, "response": None}
-            except Exception as e:
-                logger.error(f"❌ Ошибка AI анализа: {e}")
-                ai_result = {"should_respond": True, "response": None}
+            context_messages, ai_result = scheduled
             
             # Проверяем результат
             if not ai_result or not isinstance(ai_result, dict):
                 logger.warning("⚠️ Некорректный результат AI анализа")
-                return None
+                return self._finish("invalid_result", started)
                 
             should_respond = ai_result.get("should_respond", False)
             ai_response = ai_result.get("response", "")
-            detected_topic = ai_result.get("topic", "")
+            detected_topic = ai_result.get("detected_topic", "")
             sentiment = ai_result.get("sentiment", "")
             
             logger.info(f"🎯 AI решение: respond={should_respond}, topic={detected_topic}, sentiment={sentiment}")
@@ -146,19 +130,64 @@ class BotService:
                 bot_response = ai_response
                 logger.info(f"💬 Генерируем ответ: {bot_response[:100]}...")
             
-            # Сохраняем взаимодействие асинхронно
-            asyncio.create_task(self._save_interaction(
+            # Ставим взаимодействие в очередь пакетной записи
+            self._save_interaction(
                 chat_id, chat_title, context_messages, 
                 detected_topic, sentiment, bot_response, bool(bot_response)
-            ))
+            )
             
+            self._finish("responded" if bot_response else "declined", started)
             return bot_response
                 
         except Exception as e:
             logger.error(f"❌ Ошибка обработки сообщения: {e}", exc_info=True)
-            return None
+            return self._finish("error", started)
     
-    async def _save_interaction(
+    @staticmethod
+    def _finish(outcome: str, started: float) -> None:
+        """Учитывает исход обработки сообщения и ее полное время"""
+        messages_total.labels(outcome).inc()
+        stage_seconds.labels("total").observe(time.perf_counter() - started)
+        return None
+    
+    def record_bot_reply(self, chat_id: str, text: str):
+        """Учитывает отправленный ответ бота в буфере (пауза и частота ответов)"""
+        self.message_buffer.add_message(chat_id, text, is_bot=True)
+    
+    async def _analyze_context(
+        self,
+        chat_id: str,
+        chat_title: str,
+        on_partial: Callable[[str], None] = None,
+        on_start: Callable[[], None] = None
+    ):
+        """Анализирует актуальный контекст чата с таймаутом"""
+        context_messages = self.message_buffer.get_recent_messages(chat_id, config.max_context_messages)
+        summary = self.message_buffer.get_summary(chat_id)
+        
+        logger.info(f"🤔 Анализируем контекст в '{chat_title}' ({len(context_messages)} сообщений)")
+        
+        ai_result = None
+        timeout = config.llm_request_timeout
+        deadline = asyncio.get_running_loop().time() + timeout
+        try:
+            ai_result = await asyncio.wait_for(
+                ai_service.analyze_context_and_generate_response(
+                    context_messages, chat_title, deadline, chat_id=chat_id, on_partial=on_partial,
+                    summary=summary, on_start=on_start
+                ),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("⏰ Таймаут AI анализа, используем fallback")
+            ai_result = {"should_respond": True, "response": None}
+        except Exception as e:
+            logger.error(f"❌ Ошибка AI анализа: {e}")
+            ai_result = {"should_respond": True, "response": None}
+        
+        return context_messages, ai_result
+    
+    def _save_interaction(
         self,
         chat_id: str,
         chat_title: str,
@@ -168,7 +197,7 @@ class BotService:
         bot_response: str = None,
         response_generated: bool = False
     ):
-        """Сохраняет взаимодействие в базу данных"""
+        """Ставит взаимодействие в очередь записи в базу данных"""
         try:
             interaction_data = {
                 'chat_id': chat_id,
@@ -181,45 +210,26 @@ class BotService:
                 'participants_count': self.message_buffer.get_participants_count(chat_id)
             }
             
-            # Сохраняем в фоновом режиме
-            await asyncio.get_event_loop().run_in_executor(
-                None, db_manager.save_interaction, interaction_data
-            )
-            
-            logger.debug("💾 Взаимодействие сохранено в БД")
+            # Запись выполнит фоновый писатель одной пачкой
+            interaction_writer.submit(interaction_data)
             
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения в БД: {e}")
     
-    def get_chat_stats(self, chat_id: str) -> Dict[str, Any]:
-        """Получает статистику по чату"""
+    async def get_chat_stats(self, chat_id: str) -> Dict[str, Any]:
+        """Получает статистику по чату из накопительной таблицы chat_stats"""
         try:
-            history = db_manager.get_chat_history(chat_id, limit=100)
-            
-            total_interactions = len(history)
-            responses_generated = len([h for h in history if h.response_generated])
-            
-            # Анализ настроений
-            sentiments = [h.sentiment for h in history if h.sentiment]
-            sentiment_stats = {
-                'positive': sentiments.count('positive'),
-                'neutral': sentiments.count('neutral'),
-                'negative': sentiments.count('negative')
-            }
-            
-            # Популярные темы
-            topics = [h.detected_topic for h in history if h.detected_topic]
-            topic_counts = {}
-            for topic in topics:
-                topic_counts[topic] = topic_counts.get(topic, 0) + 1
-            
-            return {
-                'total_interactions': total_interactions,
-                'responses_generated': responses_generated,
-                'response_rate': responses_generated / max(total_interactions, 1),
-                'sentiment_distribution': sentiment_stats,
-                'popular_topics': sorted(topic_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-            }
+            stats = await db_manager.get_chat_stats(chat_id)
+            if stats is None:
+                return {
+                    'total_interactions': 0,
+                    'responses_generated': 0,
+                    'response_rate': 0.0,
+                    'avg_sentiment': None,
+                    'sentiment_distribution': {'positive': 0, 'neutral': 0, 'negative': 0},
+                    'popular_topics': []
+                }
+            return stats.to_dict()
             
         except Exception as e:
             logger.error(f"❌ Ошибка получения статистики: {e}")
@@ -0,0 +1,313 @@
+"""
+Снимки буфера сообщений на диск для быстрого теплого старта
+"""
+import asyncio
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from config import config
+from message_buffer import ChatBuffer, MessageBuffer
+
+# Формат файла: заголовок, затем записи "длина, crc32, тело".
+# Тело: chat_id, время последнего сообщения (unix), время последнего ответа
+# бота (NaN - не было), число ответов, число сообщений и сами сообщения.
+# После сообщений - резюме обсуждения и число несведенных в него сообщений,
+# затем номер последнего сообщения людей (в старых записях этих блоков нет).
+# Файл только дописывается; для чата действует последняя запись.
+MAGIC = b"SGBS"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sH")
+RECORD_HEADER = struct.Struct("<II")
+CHAT_HEADER = struct.Struct("<qddIH")
+MESSAGE_HEADER = struct.Struct("<dBI")
+SUMMARY_HEADER = struct.Struct("<II")
+SEQ_BLOCK = struct.Struct("<Q")
+
+
+def encode_chat(chat_id: str, state: Dict[str, Any]) -> bytes:
+    """Кодирует ChatBuffer.export() в запись снимка"""
+    times = state['times']
+    last_response = state['last_response_at']
+    parts = [CHAT_HEADER.pack(
+        int(chat_id),
+        times[-1] if times else 0.0,
+        last_response if last_response is not None else math.nan,
+        state['bot_responses'],
+        len(times),
+    )]
+    for text, at, is_bot in zip(state['texts'], times, state['flags']):
+        body = text.encode('utf-8')
+        parts.append(MESSAGE_HEADER.pack(at, is_bot, len(body)))
+        parts.append(body)
+    summary = state.get('summary', '').encode('utf-8')
+    parts.append(SUMMARY_HEADER.pack(state.get('unsummarized', 0), len(summary)))
+    parts.append(summary)
+    parts.append(SEQ_BLOCK.pack(state.get('human_seq', 0)))
+    payload = b"".join(parts)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_chat(payload) -> Tuple[str, Dict[str, Any]]:
+    """Обратное к encode_chat (без заголовка записи)"""
+    chat_id, _, last_response, bot_responses, count = CHAT_HEADER.unpack_from(payload, 0)
+    offset = CHAT_HEADER.size
+    texts, times, flags = [], [], []
+    for _ in range(count):
+        at, is_bot, length = MESSAGE_HEADER.unpack_from(payload, offset)
+        offset += MESSAGE_HEADER.size
+        texts.append(bytes(payload[offset:offset + length]).decode('utf-8'))
+        offset += length
+        times.append(at)
+        flags.append(is_bot)
+    state = {
+        'texts': texts,
+        'times': times,
+        'flags': flags,
+        'bot_responses': bot_responses,
+        'last_response_at': None if math.isnan(last_response) else last_response,
+    }
+    if offset < len(payload):
+        state['unsummarized'], length = SUMMARY_HEADER.unpack_from(payload, offset)
+        offset += SUMMARY_HEADER.size
+        state['summary'] = bytes(payload[offset:offset + length]).decode('utf-8')
+        offset += length
+    if offset < len(payload):
+        state['human_seq'], = SEQ_BLOCK.unpack_from(payload, offset)
+    return str(chat_id), state
+
+
+class BufferSnapshotter:
+    """
+    Периодические инкрементальные снимки MessageBuffer.
+
+    В файл дописываются только чаты, изменившиеся с прошлого снимка;
+    когда устаревших записей становится много, файл переписывается
+    целиком (через временный файл и os.replace). При старте недавно
+    активные чаты восстанавливаются сразу, остальные остаются в
+    отображенном в память файле и подгружаются при первом сообщении.
+    """
+
+    def __init__(
+        self,
+        buffer: MessageBuffer,
+        path: str,
+        eager_window: float = 3600.0,
+        max_age: float = 86400.0,
+        compact_ratio: float = 4.0,
+        compact_min_bytes: int = 1024 * 1024,
+    ):
+        self.buffer = buffer
+        self.path = Path(path)
+        self.eager_window = eager_window    # Моложе - восстанавливаются сразу (сек)
+        self.max_age = max_age              # Старше - не восстанавливаются вовсе (сек)
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.lazy: Dict[str, Tuple[int, int]] = {}   # chat_id -> (смещение тела, длина) в _map
+        self.record_sizes: Dict[str, int] = {}       # Размер актуальной записи чата
+        self.file_size = 0
+        self._map: Optional[mmap.mmap] = None
+        self._lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            'snapshots': 0,
+            'records_written': 0,
+            'bytes_written': 0,
+            'compactions': 0,
+            'restored_eager': 0,
+            'restored_lazy': 0,
+            'skipped_old': 0,
+            'errors': 0,
+        }
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self.file_size > FILE_HEADER.size:
+            with open(self.path, 'rb') as snapshot:
+                self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load(self) -> int:
+        """Читает снимок: недавние чаты - в буфер, остальные - в ленивый индекс"""
+        if not self.path.exists():
+            return 0
+        self.file_size = self.path.stat().st_size
+        self._remap()
+        data = self._map
+        if data is None or FILE_HEADER.unpack_from(data, 0) != (MAGIC, VERSION):
+            logger.warning(f"⚠️ Снимок буфера {self.path} пуст или несовместим, пропускаем")
+            self.file_size = 0
+            return 0
+
+        latest: Dict[str, Tuple[int, int]] = {}
+        offset = FILE_HEADER.size
+        while offset + RECORD_HEADER.size <= self.file_size:
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > self.file_size or zlib.crc32(data[start:start + length]) != crc:
+                break
+            chat_id = str(CHAT_HEADER.unpack_from(data, start)[0])
+            latest[chat_id] = (start, length)
+            offset = start + length
+        if offset < self.file_size:
+            # Оборванная при аварии запись: отрезаем, чтобы дописывать после целых
+            logger.warning(f"⚠️ Снимок буфера поврежден с позиции {offset}, хвост отброшен")
+            os.truncate(self.path, offset)
+            self.file_size = offset
+
+        now_wall = time.time()
+        eager = []
+        for chat_id, (start, length) in latest.items():
+            last_activity = CHAT_HEADER.unpack_from(data, start)[1]
+            age = now_wall - last_activity
+            if self.max_age and age > self.max_age:
+                self.stats['skipped_old'] += 1
+            elif age <= self.eager_window:
+                eager.append((last_activity, chat_id, start, length))
+            else:
+                self.lazy[chat_id] = (start, length)
+            self.record_sizes[chat_id] = RECORD_HEADER.size + length
+
+        # В порядке активности, чтобы LRU буфера совпал с исходным
+        now = time.monotonic()
+        for _, chat_id, start, length in sorted(eager):
+            _, state = decode_chat(data[start:start + length])
+            self.buffer.restore_chat(chat_id, ChatBuffer.restore(state, self.buffer.max_messages, now, now_wall))
+        self.stats['restored_eager'] += len(eager)
+        self.buffer.dirty.clear()
+        self.buffer.lazy_loader = self.take
+        logger.info(
+            f"♻️ Буфер восстановлен из снимка: {len(eager)} чатов сразу, "
+            f"{len(self.lazy)} по требованию, {self.stats['skipped_old']} устарели"
+        )
+        return len(eager)
+
+    def take(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        """Забирает состояние чата из ленивого индекса"""
+        location = self.lazy.pop(chat_id, None)
+        if location is None or self._map is None:
+            return None
+        start, length = location
+        _, state = decode_chat(self._map[start:start + length])
+        if self.max_age and time.time() - state['times'][-1] > self.max_age:
+            return None
+        self.stats['restored_lazy'] += 1
+        return state
+
+    def _collect(self, chat_ids) -> List[Tuple[str, bytes]]:
+        records = []
+        now, now_wall = time.monotonic(), time.time()
+        for chat_id in chat_ids:
+            chat = self.buffer.chats.get(chat_id)
+            if chat is not None and chat.size:
+                records.append((chat_id, encode_chat(chat_id, chat.export(now, now_wall))))
+        return records
+
+    def _append(self, records: List[Tuple[str, bytes]]):
+        with open(self.path, 'ab') as snapshot:
+            if snapshot.tell() == 0:
+                snapshot.write(FILE_HEADER.pack(MAGIC, VERSION))
+            for _, record in records:
+                snapshot.write(record)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+            return snapshot.tell()
+
+    def _rewrite(self, records: List[Tuple[str, bytes]]) -> Dict[str, Tuple[int, int]]:
+        temporary = self.path.with_suffix(self.path.suffix + '.tmp')
+        offsets = {}
+        with open(temporary, 'wb') as snapshot:
+            snapshot.write(FILE_HEADER.pack(MAGIC, VERSION))
+            for chat_id, record in records:
+                offsets[chat_id] = (snapshot.tell() + RECORD_HEADER.size, len(record) - RECORD_HEADER.size)
+                snapshot.write(record)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.path)
+        return offsets
+
+    async def snapshot(self) -> int:
+        """Дописывает изменившиеся чаты; при необходимости переписывает файл"""
+        async with self._lock:
+            dirty = self.buffer.dirty
+            self.buffer.dirty = set()
+            records = self._collect(dirty)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                if records:
+                    self.file_size = await asyncio.to_thread(self._append, records)
+                    for chat_id, record in records:
+                        self.record_sizes[chat_id] = len(record)
+                    self.stats['records_written'] += len(records)
+                    self.stats['bytes_written'] += sum(len(record) for _, record in records)
+                self.stats['snapshots'] += 1
+                live = sum(self.record_sizes.values())
+                if self.file_size > max(self.compact_min_bytes, live * self.compact_ratio):
+                    await self._compact()
+            except Exception as e:
+                # Изменения не потеряны: чаты попадут в следующий снимок
+                self.buffer.dirty |= dirty
+                self.stats['errors'] += 1
+                logger.error(f"❌ Ошибка записи снимка буфера: {e}")
+            return len(records)
+
+    async def _compact(self):
+        records = self._collect(list(self.buffer.chats))
+        in_memory = {chat_id for chat_id, _ in records}
+        for chat_id, (start, length) in list(self.lazy.items()):
+            if chat_id not in in_memory:
+                records.append((chat_id, bytes(self._map[start - RECORD_HEADER.size:start + length])))
+        offsets = await asyncio.to_thread(self._rewrite, records)
+
+        self.record_sizes = {chat_id: len(record) for chat_id, record in records}
+        self.file_size = FILE_HEADER.size + sum(self.record_sizes.values())
+        self._remap()
+        # Чаты, забранные из индекса во время записи, в нем не восстанавливаем
+        self.lazy = {chat_id: offsets[chat_id] for chat_id in self.lazy if chat_id in offsets}
+        self.stats['compactions'] += 1
+        logger.info(f"🗜️ Снимок буфера переписан: {len(records)} чатов, {self.file_size / 1024:.0f} КБ")
+
+    async def _run_forever(self, interval: float):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.snapshot()
+
+    def start(self, interval: float):
+        """Запускает периодические снимки в текущем event loop"""
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run_forever(interval))
+            logger.info(f"📸 Снимки буфера сообщений: раз в {interval:.0f}с в {self.path}")
+
+    async def stop(self):
+        """Делает последний снимок и останавливает периодическую запись"""
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        else:
+            await self.snapshot()
+
+
+def create_snapshotter(buffer: MessageBuffer) -> Optional[BufferSnapshotter]:
+    """Создает снимки буфера по настройкам (None - снимки выключены)"""
+    if not config.buffer_snapshot_path:
+        return None
+    return BufferSnapshotter(
+        buffer,
+        config.buffer_snapshot_path,
+        eager_window=config.buffer_snapshot_eager_window,
+        max_age=config.buffer_snapshot_max_age,
+    )
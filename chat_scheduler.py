@@ -0,0 +1,119 @@
+"""
+Планировщик анализа контекста по чатам
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+from loguru import logger
+
+
+@dataclass
+class _ChatSlot:
+    """Состояние планирования одного чата"""
+    generation: int = 0
+    task: Optional[asyncio.Task] = None
+    # Анализ дошел до запроса к LLM: он оплачен и доводится до конца
+    committed: bool = False
+    last_arrival: float = float('-inf')
+
+
+class ChatScheduler:
+    """
+    Держит не более одного активного AI анализа на чат.
+
+    Начатый запрос к LLM не отменяется: сообщения, пришедшие во время
+    него, ждут его завершения и сворачиваются в один следующий анализ по
+    самому свежему контексту. Отменяется только анализ, еще не дошедший
+    до LLM (ждет в очереди пула). Окно сворачивания применяется лишь к
+    сообщениям, пришедшим в течение окна после предыдущего, - одиночное
+    сообщение анализируется сразу.
+    """
+
+    def __init__(self, coalesce_window: float = 1.0):
+        self.coalesce_window = coalesce_window
+        self._slots: Dict[str, _ChatSlot] = {}
+        self.stats = {
+            'scheduled': 0,
+            'started': 0,
+            'completed': 0,
+            'coalesced': 0,
+            'cancelled': 0,
+        }
+
+    @property
+    def in_flight(self) -> int:
+        """Количество чатов с активным анализом"""
+        return sum(1 for slot in self._slots.values() if slot.task and not slot.task.done())
+
+    def _superseded(self, slot: _ChatSlot, generation: int, chat_id: str) -> bool:
+        if slot.generation == generation:
+            return False
+        self.stats['coalesced'] += 1
+        logger.debug(f"🧺 Сообщение в чате {chat_id} свернуто в следующий анализ")
+        return True
+
+    async def run(self, chat_id: str, factory: Callable[[Callable[[], None]], Awaitable[Any]]) -> Optional[Any]:
+        """
+        Запускает анализ для чата, если его не вытеснит более свежее сообщение.
+
+        Args:
+            chat_id: ID чата
+            factory: Фабрика корутины анализа; вызывается непосредственно
+                перед запуском, поэтому должна сама читать актуальный
+                контекст. Получает колбэк, который вызывается в момент
+                начала запроса к LLM - после него анализ не отменяется
+
+        Returns:
+            Результат корутины или None, если вызов был свернут или отменен
+        """
+        slot = self._slots.setdefault(chat_id, _ChatSlot())
+        slot.generation += 1
+        generation = slot.generation
+        self.stats['scheduled'] += 1
+        now = asyncio.get_running_loop().time()
+        burst = now - slot.last_arrival < self.coalesce_window
+        slot.last_arrival = now
+
+        # Анализ, еще не дошедший до LLM, бесполезен при более свежем контексте
+        if slot.task and not slot.task.done() and not slot.committed:
+            slot.task.cancel()
+            slot.task = None
+            self.stats['cancelled'] += 1
+            logger.debug(f"🛑 Отменен устаревший анализ в чате {chat_id}")
+
+        try:
+            # Серия сообщений: ждем окно, вдруг придет еще
+            if burst and self.coalesce_window > 0:
+                await asyncio.sleep(self.coalesce_window)
+                if self._superseded(slot, generation, chat_id):
+                    return None
+
+            # Начатый анализ доводится до конца, следующий - по свежему контексту
+            while slot.task and not slot.task.done():
+                await asyncio.wait({slot.task})
+                if self._superseded(slot, generation, chat_id):
+                    return None
+
+            def mark_committed():
+                if slot.task is task:
+                    slot.committed = True
+
+            slot.committed = False
+            task = asyncio.ensure_future(factory(mark_committed))
+            slot.task = task
+            self.stats['started'] += 1
+
+            try:
+                await asyncio.wait({task})
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+
+            if task.cancelled():
+                return None
+
+            self.stats['completed'] += 1
+            return task.result()
+        finally:
+            if slot.generation == generation and self._slots.get(chat_id) is slot:
+                del self._slots[chat_id]
@@ -2,7 +2,7 @@
 Конфигурация приложения
 """
 import os
-from typing import Optional
+from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 from pydantic import field_validator
@@ -19,9 +19,15 @@ class Config(BaseSettings):
     
     # OpenAI
     openai_api_key: str
+    openai_base_url: str = "https://openrouter.ai/api/v1"  # OpenAI-совместимый провайдер
+    openai_model: str = "meta-llama/llama-3.1-8b-instruct:free"  # Бесплатная модель через OpenRouter.ai
     
     # Database
     database_url: str = "sqlite:///bot_database.db"
+    db_pool_size: int = 5  # Постоянных соединений в пуле (PostgreSQL)
+    db_max_overflow: int = 10  # Дополнительных соединений сверх пула
+    db_pool_timeout: float = 30.0  # Ожидание свободного соединения (сек)
+    db_pool_recycle: int = 1800  # Пересоздание соединений (сек)
     
     # Bot Settings
     bot_name: str = "SmartGroupBot"
@@ -29,6 +35,110 @@ class Config(BaseSettings):
     response_frequency: int = 2
     min_context_messages: int = 2
     max_context_messages: int = 10
+    fallback_intents_path: str = "intents.json"  # Интенты и ответы fallback режима
+    buffer_idle_ttl: float = 21600  # Чат без сообщений дольше забывается (сек), 0 - никогда
+    buffer_memory_budget_mb: float = 256  # Бюджет памяти буферов сообщений (МБ), 0 - без ограничения
+    buffer_spill_enabled: bool = False  # Сохранять вытесненные буферы в БД
+    buffer_spill_max_age: float = 604800  # Сколько хранить вытесненный буфер в БД (сек)
+    buffer_snapshot_path: str = "data/buffer.snapshot"  # Пусто - без снимков
+    buffer_snapshot_interval: float = 30  # Период инкрементальных снимков (сек)
+    buffer_snapshot_eager_window: float = 3600  # Чаты активнее - восстанавливаются при старте (сек)
+    buffer_snapshot_max_age: float = 86400  # Чаты старше не восстанавливаются (сек)
+    
+    # Webhook
+    webhook_url: str = ""  # Публичный HTTPS адрес бота; пусто - long polling
+    webhook_path: str = "/telegram"  # Путь вебхука на встроенном HTTP сервере
+    webhook_secret: str = ""  # Секрет X-Telegram-Bot-Api-Secret-Token; пусто - случайный при старте
+    webhook_queue_size: int = 10000  # Принятых, но не переданных обновлений в памяти
+    webhook_max_connections: int = 100  # Одновременных соединений Telegram (1-100)
+    webhook_max_body: int = 1048576  # Предел тела запроса (байт)
+    http_host: str = "0.0.0.0"  # Адрес встроенного HTTP сервера
+    http_port: int = 8443  # Порт встроенного HTTP сервера
+    
+    # Metrics
+    metrics_enabled: bool = False  # /metrics и в режиме long polling (с вебхуком - всегда)
+    metrics_path: str = "/metrics"  # Путь метрик Prometheus на встроенном HTTP сервере
+    
+    # Sharding (run_all.py --shards)
+    shard_workers: int = 0  # Процессов-обработчиков, 0 - по числу ядер
+    shard_vnodes: int = 64  # Точек на кольце консистентного хеширования на процесс
+    shard_health_interval: float = 5.0  # Период проверки пульса обработчиков (сек)
+    shard_health_timeout: float = 30.0  # Обработчик без пульса дольше перезапускается (сек)
+    
+    # Scheduling
+    coalesce_window: float = 1.0  # Окно сворачивания сообщений одного чата (сек)
+    
+    # LLM worker pool
+    llm_concurrency: int = 4  # Одновременных запросов к LLM на процесс
+    llm_queue_size: int = 100  # Максимальная глубина очереди запросов
+    llm_request_timeout: float = 15.0  # Дедлайн ответа AI (сек)
+    
+    # Prompt
+    llm_prompt_token_budget: int = 1500  # Предел токенов промпта (системный + контекст)
+    llm_max_message_tokens: int = 300  # Длинные сообщения сокращаются до этого размера
+    llm_max_response_tokens: int = 500  # max_tokens ответа модели
+    
+    # Summaries
+    summary_every: int = 10  # Обновлять резюме чата после стольких новых сообщений, 0 - без резюме
+    summary_max_tokens: int = 200  # Предел длины резюме
+    summary_input_tokens: int = 1200  # Предел новых сообщений в одном запросе резюме
+    summary_timeout: float = 60.0  # Дедлайн фонового запроса резюме (сек)
+    relevance_model_path: str = ""  # Модель уместности (run_relevance.py), пусто - все контексты идут в LLM
+    relevance_threshold: float = 0.2  # Контексты с меньшей оценкой не отправляются в LLM
+    relevance_explore: float = 0.05  # Доля отсеченных контекстов, которые все равно идут в LLM
+    
+    # LLM backends
+    llm_backends: List[Dict[str, Any]] = []  # [{"type": "openai", "model": "..."}, {"type": "stub", "latency": 0.5}]
+    llm_router_strategy: str = "fallback"  # fallback, fastest, cheapest или hedged
+    llm_hedge_delay: float = 0  # Через сколько дублировать запрос (hedged), 0 - по средней задержке
+    
+    # LLM rate limiting
+    llm_rate_limit_rpm: float = 20  # Запросов в минуту на API ключ и модель
+    llm_max_retries: int = 3
+    llm_backoff_base: float = 0.5  # Базовая задержка повтора (сек)
+    llm_backoff_max: float = 8.0  # Максимальная задержка повтора (сек)
+    llm_circuit_failure_threshold: int = 5  # Ошибок подряд до размыкания
+    llm_circuit_cooldown: float = 30.0  # Пауза после размыкания (сек)
+    
+    # Response cache
+    response_cache_enabled: bool = True
+    response_cache_ttl: float = 3600  # Время жизни ответа (сек)
+    response_cache_max_entries: int = 5000
+    response_cache_scope: str = "chat"  # chat или global
+    response_cache_similarity: float = 0.8  # Порог сходства для почти-дубликатов
+    response_cache_context: int = 1  # Сколько последних сообщений входит в ключ
+    
+    # Streaming
+    stream_responses: bool = False  # Отправлять ответ рано и дописывать правками
+    stream_edit_interval: float = 1.5  # Минимальный интервал между правками (сек)
+    
+    # Outbound send queue
+    send_global_rate: float = 30  # Сообщений в секунду на бота
+    send_chat_rate_per_min: float = 20  # Сообщений в минуту на группу
+    send_chat_burst: float = 3  # Сколько сообщений в группу можно отправить подряд
+    send_stale_messages: int = 5  # Ответ выбрасывается, если после вопроса пришло больше сообщений; 0 - не проверять
+    send_stale_seconds: float = 120  # Ответ старше выбрасывается (сек); 0 - не проверять
+    send_max_attempts: int = 3  # Попыток при сетевых ошибках
+    send_concurrency: int = 8  # Одновременных запросов sendMessage
+    
+    # Persistence
+    persistence_batch_size: int = 200  # Записей в одном bulk INSERT
+    persistence_flush_interval: float = 1.0  # Максимальная задержка записи (сек)
+    persistence_queue_size: int = 10000  # Предел очереди записи в памяти
+    persistence_spool_path: str = "data/interactions.spool.jsonl"  # Пусто - без спула
+    message_compression: str = "zlib"  # none, zlib или zstd (нужен пакет zstandard)
+    message_compression_min_bytes: int = 512  # Тексты короче хранятся без сжатия
+    
+    # Retention
+    retention_enabled: bool = False  # Фоновая чистка истории внутри бота (удаляет данные - включать явно)
+    retention_interval: float = 3600  # Пауза между проходами (сек)
+    retention_max_age_days: int = 90  # 0 - без ограничения по возрасту
+    retention_max_rows_per_chat: int = 0  # 0 - без ограничения по количеству
+    retention_chat_overrides: Dict[str, Dict[str, int]] = {}  # {"chat_id": {"max_age_days": 30, "max_rows": 1000}}
+    retention_archive_dir: str = "data/archive"  # Пусто - удалять без архива
+    retention_archive_format: str = "auto"  # auto, parquet (нужен pyarrow) или jsonl
+    retention_batch_size: int = 500  # Строк в одной транзакции удаления
+    retention_hourly_days: int = 30  # Почасовые счетчики старше сворачиваются в дневные
     
     # Logging
     log_level: str = "INFO"
@@ -0,0 +1,281 @@
+"""
+Встроенный асинхронный HTTP сервер: прием вебхуков Telegram
+"""
+import asyncio
+import hmac
+import json
+import secrets
+from dataclasses import dataclass
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from loguru import logger
+
+from config import config
+from metrics import registry
+
+
+@dataclass
+class Request:
+    """Разобранный HTTP запрос"""
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+
+
+Response = Tuple[int, bytes, str]  # Статус, тело, Content-Type
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class HttpServer:
+    """
+    Минимальный HTTP/1.1 сервер на asyncio.start_server.
+
+    Поддерживает keep-alive и запросы с Content-Length; маршруты
+    задаются точным совпадением метода и пути. Этого достаточно для
+    вебхука Telegram и служебных эндпоинтов без внешних зависимостей.
+    """
+
+    MAX_HEADERS = 100  # Предел числа заголовков в запросе
+    MAX_HEADER_BYTES = 64 * 1024  # Предел суммарного размера заголовков
+
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = 8443,
+        max_body: int = 1024 * 1024,
+        idle_timeout: float = 75.0,
+    ):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        self.routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.stats = {
+            'connections': 0,
+            'requests': 0,
+            'errors': 0,
+        }
+
+    def route(self, method: str, path: str, handler: Handler):
+        self.routes[(method.upper(), path)] = handler
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    async def start(self):
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            logger.info(f"🌐 HTTP сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @staticmethod
+    def _encode(status: int, body: bytes, content_type: str, keep_alive: bool) -> bytes:
+        head = (
+            f"HTTP/1.1 {int(status)} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        return head.encode('latin-1') + body
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        if not line:
+            return None
+        method, target, version = line.decode('latin-1').split()
+        headers = await asyncio.wait_for(self._read_headers(reader), self.idle_timeout)
+        if version == "HTTP/1.0" and headers.get('connection', '').lower() != 'keep-alive':
+            headers['connection'] = 'close'
+        return Request(method.upper(), target.split("?", 1)[0], headers, b"")
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> Dict[str, str]:
+        """Читает заголовки до пустой строки; превышение лимитов - ValueError"""
+        headers = {}
+        count = size = 0
+        while True:
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                return headers
+            count += 1
+            size += len(header)
+            if count > self.MAX_HEADERS or size > self.MAX_HEADER_BYTES:
+                raise ValueError("слишком большие заголовки запроса")
+            name, _, value = header.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    def _content_length(headers: Dict[str, str]) -> int:
+        """Content-Length как неотрицательное целое; иначе ValueError"""
+        value = headers.get('content-length') or "0"
+        if not (value.isascii() and value.isdigit()):
+            raise ValueError(f"некорректный Content-Length: {value!r}")
+        return int(value)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, ValueError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+
+                if 'transfer-encoding' in request.headers:
+                    status, body, content_type = HTTPStatus.NOT_IMPLEMENTED, b"", "text/plain"
+                    keep_alive = False
+                else:
+                    try:
+                        length = self._content_length(request.headers)
+                    except ValueError:
+                        length = None
+                    if length is None:
+                        status, body, content_type = HTTPStatus.BAD_REQUEST, b"", "text/plain"
+                        keep_alive = False
+                    elif length > self.max_body:
+                        status, body, content_type = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b"", "text/plain"
+                        keep_alive = False
+                    else:
+                        request.body = (
+                            await asyncio.wait_for(reader.readexactly(length), self.idle_timeout) if length else b""
+                        )
+                        status, body, content_type = await self._dispatch(request)
+
+                self.stats['requests'] += 1
+                writer.write(self._encode(status, body, content_type, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            allowed = any(path == request.path for _, path in self.routes)
+            status = HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND
+            return status, b"", "text/plain"
+        try:
+            return await handler(request)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"❌ Ошибка обработки {request.method} {request.path}: {e}")
+            return HTTPStatus.INTERNAL_SERVER_ERROR, b"", "text/plain"
+
+
+class WebhookIngress:
+    """
+    Прием обновлений Telegram через вебхук.
+
+    HTTP обработчик только сверяет секретный токен и кладет тело запроса
+    в ограниченную очередь, сразу отвечая 200. Разбор JSON и передача
+    обновления дальше (`sink`) выполняются отдельной задачей по порядку
+    поступления. Если очередь полна, Telegram получает 503 и повторит
+    доставку позже.
+    """
+
+    SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+    def __init__(
+        self,
+        sink: Callable[[Dict[str, Any]], Awaitable[None]],
+        secret: str,
+        path: str = "/telegram",
+        queue_size: int = 10000,
+    ):
+        self.sink = sink
+        self.secret = secret
+        self.path = path
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            'received': 0,
+            'delivered': 0,
+            'rejected': 0,
+            'queue_full': 0,
+            'invalid': 0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def attach(self, server: HttpServer):
+        server.route("POST", self.path, self.receive)
+
+    async def receive(self, request: Request) -> Response:
+        token = request.headers.get(self.SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            self.stats['rejected'] += 1
+            return HTTPStatus.FORBIDDEN, b"", "text/plain"
+        try:
+            self._queue.put_nowait(request.body)
+        except asyncio.QueueFull:
+            self.stats['queue_full'] += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE, b"", "text/plain"
+        self.stats['received'] += 1
+        return HTTPStatus.OK, b"", "text/plain"
+
+    async def _drain(self):
+        while True:
+            body = await self._queue.get()
+            if body is None:
+                break
+            try:
+                update = json.loads(body)
+            except ValueError:
+                self.stats['invalid'] += 1
+                continue
+            try:
+                await self.sink(update)
+                self.stats['delivered'] += 1
+            except Exception as e:
+                logger.error(f"❌ Ошибка передачи обновления {update.get('update_id')}: {e}")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+
+    async def stop(self):
+        """Передает уже принятые обновления и останавливается"""
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+
+
+def webhook_url() -> str:
+    """Полный адрес вебхука для setWebhook"""
+    return config.webhook_url.rstrip("/") + config.webhook_path
+
+
+def create_webhook_ingress(sink: Callable[[Dict[str, Any]], Awaitable[None]]) -> WebhookIngress:
+    """Создает прием вебхука по настройкам (секрет генерируется, если не задан)"""
+    ingress = WebhookIngress(
+        sink,
+        secret=config.webhook_secret or secrets.token_urlsafe(32),
+        path=config.webhook_path,
+        queue_size=config.webhook_queue_size,
+    )
+    registry.gauge("smartbot_webhook_queue_depth", "Accepted webhook updates not yet delivered", function=lambda: ingress.queue_depth)
+    registry.stats("smartbot_webhook_updates_total", "Webhook updates by result", lambda: ingress.stats, "result")
+    return ingress
+
+
+# Глобальный экземпляр HTTP сервера
+http_server = HttpServer(config.http_host, config.http_port, max_body=config.webhook_max_body)
+registry.stats("smartbot_http_total", "Embedded HTTP server connections, requests and handler errors", lambda: http_server.stats, "event")
@@ -0,0 +1,182 @@
+"""
+Распознавание интентов для fallback ответов без LLM
+"""
+import json
+import random
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from config import config
+
+_NON_WORD = re.compile(r'[\W_]+')
+_STEM = '*'   # Ключ узла префиксного дерева: любое окончание слова
+_END = ''     # Ключ узла: здесь заканчивается триггер
+_MATCHED_LIMIT = 4096  # Сколько совпавших фрагментов помнить до сброса
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё -> е, пунктуация и пробелы схлопываются в один пробел"""
+    return _NON_WORD.sub(' ', text.lower().replace('ё', 'е')).strip()
+
+
+def _atoms(trigger: str) -> List[str]:
+    atoms: List[str] = []
+    for word in trigger.split():
+        if atoms:
+            atoms.append(' ')
+        stem = word.endswith(_STEM)
+        atoms.extend(normalize(word.rstrip(_STEM)))
+        if stem:
+            atoms.append(_STEM)
+    return atoms
+
+
+def _letter(atom: str) -> str:
+    """Буква триггера в любом регистре (е - еще и ё), чтобы не приводить текст к нижнему"""
+    variants = {atom, atom.upper()} | ({'ё', 'Ё'} if atom == 'е' else set())
+    if len(variants) == 1:
+        return re.escape(atom)
+    return '[' + ''.join(sorted(variants)) + ']'
+
+
+def _emit(node: Dict[str, Any]) -> str:
+    branches = [
+        ({_STEM: r'\w*', ' ': r'[\W_]+'}.get(atom) or _letter(atom)) + _emit(child)
+        for atom, child in sorted(node.items()) if atom != _END
+    ]
+    if not branches:
+        return ''
+    if len(branches) == 1 and _END not in node:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')' + ('?' if _END in node else '')
+
+
+def _grow(node: Dict[str, Any], atoms: List[str]) -> None:
+    for atom in atoms:
+        node = node.setdefault(atom, {})
+    node[_END] = {}
+
+
+def trie_pattern(triggers: List[str]) -> str:
+    """
+    Регулярное выражение по префиксному дереву триггеров
+
+    Общие префиксы вынесены за скобки, поэтому движок не перебирает
+    триггеры по одному, а проходит дерево.
+    """
+    root: Dict[str, Any] = {}
+    for trigger in triggers:
+        _grow(root, _atoms(trigger))
+    return _emit(root)
+
+
+@dataclass(frozen=True)
+class Intent:
+    """Интент и варианты ответа на него"""
+    name: str
+    responses: Tuple[str, ...]
+    respond_probability: float = 1.0
+
+
+class IntentEngine:
+    """
+    Классификатор последнего сообщения по триггерам из файла интентов.
+
+    При загрузке все триггеры компилируются в одно регулярное выражение:
+    ветвление по первой букве, внутри - по группе на интент в порядке
+    файла, остаток каждого триггера - префиксное дерево; буквы заданы
+    в обоих регистрах, так что текст не копируется через lower().
+    Выражение начинается с разделителя (\\W), поэтому движок пробегает
+    буквы внутри слов без попыток сопоставления, а "день" не срабатывает
+    внутри "бездельник". Сообщение сканируется один раз (findall без
+    групп), интент совпавшего фрагмента берется из словаря, а при первой
+    встрече - по номеру группы того же выражения. Из нескольких
+    совпадений побеждает интент, стоящий в файле раньше.
+    """
+
+    def __init__(self, intents: List[Dict[str, Any]], default: Dict[str, Any]):
+        self.intents = [
+            Intent(spec['name'], tuple(spec['responses']), spec.get('respond_probability', 1.0))
+            for spec in intents
+        ]
+        self.default = Intent(default['name'], tuple(default['responses']), default.get('respond_probability', 1.0))
+        self._marks = [(index, tuple(spec['marks'])) for index, spec in enumerate(intents) if spec.get('marks')]
+        # Первая буква триггера -> интент -> дерево остатка триггера
+        heads: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        for index, spec in enumerate(intents):
+            for trigger in spec.get('triggers', ()):
+                atoms = _atoms(trigger)
+                _grow(heads.setdefault(atoms[0], {}).setdefault(index, {}), atoms[1:])
+        # Номер группы совпадения -> индекс интента (группа 0 - все совпадение)
+        self._group_intent: List[int] = [len(self.intents)]
+        grouped, plain = [], []
+        letters = ''
+        for head, by_intent in sorted(heads.items()):
+            bodies = []
+            for index, node in sorted(by_intent.items()):
+                bodies.append(_emit(node))
+                self._group_intent.append(index)
+            grouped.append(_letter(head) + '(?:' + '|'.join('(' + body + ')' for body in bodies) + ')')
+            plain.append(_letter(head) + '(?:' + '|'.join(bodies) + ')')
+            letters += _letter(head).strip('[]')
+        # Опережающая проверка первой буквы одним классом отсекает остальные слова сразу
+        frame = r'\W(?=[' + letters + r'])(?:{})(?!\w)'
+        self._scan = re.compile(frame.format('|'.join(plain))) if plain else None
+        self._resolve = re.compile(frame.format('|'.join(grouped))) if grouped else None
+        # Совпавший текст -> интент: триггеров мало, поэтому словарь почти всегда попадает
+        self._matched: Dict[str, int] = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> 'IntentEngine':
+        """Загружает интенты из JSON (относительный путь - от каталога бота)"""
+        location = Path(path)
+        if not location.is_absolute():
+            location = Path(__file__).resolve().parent / location
+        with open(location, encoding='utf-8') as source:
+            data = json.load(source)
+        engine = cls(data['intents'], data['default'])
+        logger.info(f"🗂️ Загружено интентов fallback режима: {len(engine.intents)} из {location.name}")
+        return engine
+
+    def classify(self, text: str) -> Intent:
+        """Интент сообщения (default, если ни один не подошел)"""
+        best = len(self.intents)
+        for index, marks in self._marks:
+            if index < best:
+                for mark in marks:
+                    if mark in text:
+                        best = index
+                        break
+        if best and self._scan:
+            # Пробел в начале - разделитель перед первым словом
+            for found in self._scan.findall(' ' + text):
+                index = self._matched.get(found)
+                if index is None:
+                    if len(self._matched) >= _MATCHED_LIMIT:
+                        self._matched.clear()
+                    index = self._matched[found] = self._group_intent[self._resolve.match(found).lastindex]
+                best = min(best, index)
+        return self.intents[best] if best < len(self.intents) else self.default
+
+    def fallback(self, text: str, topic: Optional[str] = None) -> Dict[str, Any]:
+        """Ответ в формате анализа контекста без обращения к LLM"""
+        intent = self.classify(text or "")
+        should_respond = intent.respond_probability >= 1.0 or random.random() < intent.respond_probability
+        if intent is self.default:
+            topic = topic or intent.name
+        else:
+            topic = intent.name
+        return {
+            "detected_topic": topic or "общение",
+            "sentiment": 0.7 if should_respond else 0.5,
+            "should_respond": should_respond,
+            "response": random.choice(intent.responses) if should_respond else None
+        }
+
+
+# Глобальный экземпляр классификатора интентов
+intent_engine = IntentEngine.from_file(config.fallback_intents_path)
@@ -0,0 +1,535 @@
+"""
+Бэкенды LLM: OpenAI-совместимый HTTP, локальная заглушка и маршрутизатор
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI, APIStatusError, APIConnectionError
+
+from config import config
+from rate_limiter import (
+    RateLimiter, CircuitBreaker, CircuitOpenError,
+    backoff_delay, parse_retry_after
+)
+from streaming import IncrementalResponseParser
+
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "https://github.com/smartgroupbot",  # Необходимо для OpenRouter.ai
+    "X-Title": "SmartGroupBot"  # Название приложения
+}
+
+
+@dataclass
+class Completion:
+    """Ответ модели и расход токенов (0 - провайдер не сообщил)"""
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    backend: str = ""
+    finish_reason: str = ""  # "length" - ответ оборван по max_tokens
+
+
+class BackendError(Exception):
+    """Ошибка бэкенда со статусом в духе HTTP (заглушка, маршрутизатор)"""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status
+
+
+class LLMBackend:
+    """
+    Базовый бэкенд: учет задержки и здоровья.
+
+    Наследник реализует `_complete`; `complete` замеряет задержку
+    (экспоненциальное скользящее среднее) для маршрутизатора.
+    Здоровье определяется предохранителем бэкенда.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        cost: float = 0.0,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+    ):
+        self.name = name
+        self.cost = cost                  # Цена 1000 токенов, для выбора по цене
+        self.circuit_breaker = CircuitBreaker(failure_threshold=failure_threshold, cooldown=cooldown)
+        self.latency: Optional[float] = None
+        self.stats = {'requests': 0, 'succeeded': 0, 'failed': 0}
+
+    @property
+    def available(self) -> bool:
+        return self.circuit_breaker.available
+
+    async def complete(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        timeout: float,
+        on_partial: Callable[[str], None] = None,
+        max_tokens: int = None,
+    ) -> Completion:
+        """
+        Запрашивает ответ модели не дольше timeout секунд
+
+        С `on_partial` ответ читается потоком, и колбэк получает уже
+        сгенерированную часть поля response.
+        """
+        self.stats['requests'] += 1
+        started = time.monotonic()
+        try:
+            completion = await self._complete(
+                system_prompt, user_prompt, timeout, on_partial, max_tokens or config.llm_max_response_tokens
+            )
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        elapsed = time.monotonic() - started
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        self.stats['succeeded'] += 1
+        completion.backend = completion.backend or self.name
+        return completion
+
+    async def _complete(self, system_prompt, user_prompt, timeout, on_partial, max_tokens) -> Completion:
+        raise NotImplementedError
+
+    def scale_limits(self, factor: float):
+        """Меняет лимиты запросов в factor раз (доля процесса при шардировании)"""
+
+    async def close(self):
+        pass
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Провайдер с OpenAI-совместимым API (OpenRouter.ai, vLLM, OpenAI).
+
+    Token bucket на API ключ и модель, повторы 429, 5xx и сетевых
+    ошибок с экспоненциальной задержкой, пока следующая попытка
+    укладывается в оставшееся время, и предохранитель от сбоев.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        base_url: str,
+        api_key: str,
+        rpm: float = 20,
+        cost: float = 0.0,
+        extra_headers: Dict[str, str] = None,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+    ):
+        super().__init__(name, cost, failure_threshold, cooldown)
+        self.model = model
+        # Повторы выполняет собственный слой ретраев с учетом лимитов
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.rate_limiter = RateLimiter(default_rpm=rpm)
+        self.extra_headers = extra_headers if extra_headers is not None else OPENROUTER_HEADERS
+
+    def scale_limits(self, factor: float):
+        self.rate_limiter.scale(factor)
+
+    def _rate_limit_keys(self) -> List[str]:
+        """Ключи token bucket'ов: API ключ и модель"""
+        key_digest = hashlib.sha1((self.client.api_key or "").encode()).hexdigest()[:8]
+        return [f"key:{key_digest}", f"model:{self.model}"]
+
+    async def _read_stream(self, stream, on_partial: Callable[[str], None]) -> Completion:
+        """
+        Читает потоковый ответ, отдавая текст по мере готовности
+
+        Поток закрывается при любом исходе, включая отмену, чтобы не держать
+        HTTP соединение до сборки мусора. Обрыв соединения посреди ответа
+        превращается в APIConnectionError и повторяется как сетевая ошибка.
+        """
+        parser = IncrementalResponseParser()
+        parts = []
+        completion = Completion("")
+        try:
+            async for chunk in stream:
+                # Расход токенов приходит последним фрагментом без choices (include_usage)
+                usage = getattr(chunk, 'usage', None)
+                if usage:
+                    completion.prompt_tokens = _usage_value(usage, 'prompt_tokens')
+                    completion.completion_tokens = _usage_value(usage, 'completion_tokens')
+                if not chunk.choices:
+                    continue
+                completion.finish_reason = chunk.choices[0].finish_reason or completion.finish_reason
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if parser.feed(delta) and parser.visible_text:
+                    on_partial(parser.visible_text)
+        except httpx.TransportError as error:
+            raise APIConnectionError(request=stream.response.request) from error
+        finally:
+            await stream.close()
+        completion.text = "".join(parts)
+        return completion
+
+    async def _complete(self, system_prompt, user_prompt, timeout, on_partial, max_tokens) -> Completion:
+        deadline = time.monotonic() + timeout
+        keys = self._rate_limit_keys()
+        attempt = 0
+
+        while True:
+            if not self.circuit_breaker.available:
+                self.circuit_breaker.before_call()  # Разомкнут: отказ без ожидания лимита
+            await self.rate_limiter.acquire(keys, deadline)
+            # После получения слота: пробный запрос полуоткрытого предохранителя уходит сразу
+            self.circuit_breaker.before_call()
+
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    max_tokens=max_tokens,
+                    temperature=0.7,
+                    timeout=min(10, deadline - time.monotonic()),  # Таймаут 10 секунд, но не дольше дедлайна
+                    stream=on_partial is not None,
+                    # Без этого потоковый ответ не сообщает расход токенов
+                    extra_body={"stream_options": {"include_usage": True}} if on_partial is not None else None,
+                    extra_headers=self.extra_headers
+                )
+                self.rate_limiter.observe(keys, raw.headers)
+                if on_partial is not None:
+                    completion = await self._read_stream(raw.parse(), on_partial)
+                else:
+                    completion = Completion("")
+                    parsed = raw.parse()
+                    completion.text = parsed.choices[0].message.content or ""
+                    completion.finish_reason = parsed.choices[0].finish_reason or ""
+                    if parsed.usage is not None:
+                        completion.prompt_tokens = parsed.usage.prompt_tokens
+                        completion.completion_tokens = parsed.usage.completion_tokens
+                self.circuit_breaker.record_success()
+                completion.text = completion.text.strip()
+                return completion
+
+            except (APIStatusError, APIConnectionError) as error:
+                status = getattr(error, 'status_code', None)
+                retryable = status is None or status == 429 or status >= 500
+                if retryable and status != 429:
+                    self.circuit_breaker.record_failure()
+                else:
+                    # 4xx и 429 - провайдер отвечает, для предохранителя это не сбой
+                    self.circuit_breaker.record_success()
+                if not retryable:
+                    raise
+
+                retry_after = None
+                if isinstance(error, APIStatusError):
+                    retry_after = parse_retry_after(error.response.headers)
+                    self.rate_limiter.observe(keys, error.response.headers)
+                if status == 429:
+                    self.rate_limiter.throttle(keys, retry_after or backoff_delay(attempt, 1.0, config.llm_backoff_max))
+
+                delay = max(retry_after or 0.0, backoff_delay(attempt, config.llm_backoff_base, config.llm_backoff_max))
+                if attempt >= config.llm_max_retries or time.monotonic() + delay >= deadline:
+                    raise
+
+                logger.info(
+                    f"🔁 Повтор запроса к {self.name} через {delay:.1f}с (статус {status}, попытка {attempt + 1})"
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+            except asyncio.CancelledError:
+                self.circuit_breaker.record_cancelled()
+                raise
+            except BaseException:
+                # Обрыв потока и прочие ошибки: пробный запрос не должен остаться без исхода
+                self.circuit_breaker.record_failure()
+                raise
+
+    async def close(self):
+        await self.client.close()
+
+
+def _usage_value(usage: Any, name: str) -> int:
+    """Поле usage из фрагмента потока: объект SDK или словарь (поле вне схемы SDK)"""
+    value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+    return int(value or 0)
+
+
+def _stub_reply(system_prompt: str, user_prompt: str) -> str:
+    """Детерминированный ответ заглушки в формате анализа контекста"""
+    lines = [line[2:] for line in user_prompt.splitlines() if line.startswith("- ")]
+    last = lines[-1] if lines else user_prompt.strip()
+    if '"should_respond"' not in system_prompt:
+        # Служебный запрос (например, резюме): простой текст
+        return "Обсуждают: " + "; ".join(lines[-3:])[:300]
+    words = re.findall(r'\w{4,}', last.lower())
+    return json.dumps({
+        "detected_topic": words[0] if words else "общение",
+        "sentiment": 0.0,
+        "should_respond": '?' in last,
+        "response": f"Ответ на «{last[:100]}»" if '?' in last else None,
+    }, ensure_ascii=False)
+
+
+class StubBackend(LLMBackend):
+    """
+    Локальная заглушка LLM для нагрузочных тестов без сети.
+
+    Задержка распределена логнормально с медианой `latency` и разбросом
+    `latency_sigma`; `errors` задает доли ошибок по статусам, например
+    {"429": 0.05, "503": 0.02, "timeout": 0.01}. Генератор случайных чисел
+    с фиксированным `seed` дает воспроизводимую последовательность.
+    """
+
+    def __init__(
+        self,
+        name: str = "stub",
+        latency: float = 0.5,
+        latency_sigma: float = 0.3,
+        errors: Dict[str, float] = None,
+        seed: int = 1,
+        cost: float = 0.0,
+        reply: Callable[[str, str], str] = _stub_reply,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+    ):
+        super().__init__(name, cost, failure_threshold, cooldown)
+        self.median_latency = latency
+        self.latency_sigma = latency_sigma
+        self.errors = {str(status): share for status, share in (errors or {}).items()}
+        self.random = random.Random(seed)
+        self.reply = reply
+
+    def _draw(self):
+        delay = self.median_latency * math.exp(self.random.gauss(0.0, self.latency_sigma))
+        roll, threshold = self.random.random(), 0.0
+        for status, share in self.errors.items():
+            threshold += share
+            if roll < threshold:
+                return delay, status
+        return delay, None
+
+    async def _complete(self, system_prompt, user_prompt, timeout, on_partial, max_tokens) -> Completion:
+        self.circuit_breaker.before_call()
+        try:
+            completion = await self._reply(system_prompt, user_prompt, timeout, on_partial)
+        except BackendError as error:
+            # Как у провайдера: 4xx и 429 не сбой, 5xx - сбой
+            if error.status is not None and error.status < 500:
+                self.circuit_breaker.record_success()
+            else:
+                self.circuit_breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            self.circuit_breaker.record_cancelled()
+            raise
+        except BaseException:
+            self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        return completion
+
+    async def _reply(self, system_prompt, user_prompt, timeout, on_partial) -> Completion:
+        delay, error = self._draw()
+        if error == "timeout" or delay >= timeout:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError(f"{self.name}: no reply in {timeout:.1f}s")
+        if error is not None:
+            # Как у провайдера: ошибка приходит быстрее полного ответа
+            await asyncio.sleep(delay / 4)
+            raise BackendError(f"{self.name}: scripted {error}", int(error) if error.isdigit() else None)
+
+        text = self.reply(system_prompt, user_prompt)
+        if on_partial is None:
+            await asyncio.sleep(delay)
+        else:
+            # Первый фрагмент - через треть задержки, остальное - равномерно
+            parser = IncrementalResponseParser()
+            chunks = [text[i:i + 16] for i in range(0, len(text), 16)] or [""]
+            await asyncio.sleep(delay / 3)
+            for chunk in chunks:
+                if parser.feed(chunk) and parser.visible_text:
+                    on_partial(parser.visible_text)
+                await asyncio.sleep(delay * 2 / 3 / len(chunks))
+        return Completion(text, len(system_prompt + user_prompt) // 3, len(text) // 3)
+
+
+class LLMRouter(LLMBackend):
+    """
+    Выбор бэкенда для каждого запроса.
+
+    Стратегии:
+    - fallback: по порядку списка, при ошибке - следующий;
+    - fastest: сначала бэкенд с наименьшей средней задержкой;
+    - cheapest: сначала самый дешевый;
+    - hedged: по порядку списка, но если бэкенд не ответил за
+      `hedge_delay`, тот же запрос уходит следующему; побеждает первый
+      ответ, остальные отменяются.
+    Бэкенды с разомкнутым предохранителем пропускаются.
+    """
+
+    STRATEGIES = ("fallback", "fastest", "cheapest", "hedged")
+
+    def __init__(self, backends: List[LLMBackend], strategy: str = "fallback", hedge_delay: float = 0.0):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown LLM router strategy: {strategy}")
+        super().__init__("router")
+        self.backends = backends
+        self.strategy = strategy
+        self.hedge_delay = hedge_delay    # 0 - вдвое больше средней задержки основного
+        self.stats.update({'fallbacks': 0, 'hedged': 0, 'hedge_wins': 0})
+
+    @property
+    def available(self) -> bool:
+        return any(backend.available for backend in self.backends)
+
+    def ordered(self) -> List[LLMBackend]:
+        """Здоровые бэкенды в порядке попыток"""
+        healthy = [backend for backend in self.backends if backend.available]
+        if self.strategy == "fastest":
+            # Бэкенд без замеров пробуется первым, чтобы получить оценку
+            healthy.sort(key=lambda backend: (backend.latency or 0.0, backend.cost))
+        elif self.strategy == "cheapest":
+            healthy.sort(key=lambda backend: backend.cost)
+        return healthy
+
+    async def _complete(self, system_prompt, user_prompt, timeout, on_partial, max_tokens) -> Completion:
+        order = self.ordered()
+        if not order:
+            raise CircuitOpenError("All LLM backends are cooling down")
+        deadline = time.monotonic() + timeout
+
+        def call(backend: LLMBackend, partial: Optional[Callable[[str], None]]):
+            return backend.complete(system_prompt, user_prompt, deadline - time.monotonic(), partial, max_tokens)
+
+        if self.strategy == "hedged" and len(order) > 1:
+            return await self._hedged(order, call, on_partial, deadline)
+
+        last_error = None
+        for index, backend in enumerate(order):
+            if deadline - time.monotonic() <= 0:
+                break
+            if index:
+                self.stats['fallbacks'] += 1
+                logger.info(f"↪️ LLM: переключаемся на {backend.name} после ошибки: {last_error}")
+            try:
+                return await call(backend, on_partial)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                last_error = e
+        raise last_error or asyncio.TimeoutError("LLM deadline exceeded")
+
+    async def _hedged(self, order, call, on_partial, deadline) -> Completion:
+        # Поток ответа показывает только бэкенд, первым начавший генерацию
+        streaming_owner: List[LLMBackend] = []
+
+        def gate(backend: LLMBackend):
+            if on_partial is None:
+                return None
+
+            def forward(text: str):
+                if not streaming_owner:
+                    streaming_owner.append(backend)
+                if streaming_owner[0] is backend:
+                    on_partial(text)
+            return forward
+
+        tasks: Dict[asyncio.Task, LLMBackend] = {}
+        launched = 0
+        last_error = None
+
+        def launch():
+            nonlocal launched
+            backend = order[launched]
+            tasks[asyncio.ensure_future(call(backend, gate(backend)))] = backend
+            launched += 1
+
+        launch()
+        try:
+            while tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait = remaining
+                if launched < len(order) and not streaming_owner:
+                    wait = min(remaining, self.hedge_delay or 2 * (order[0].latency or 0.5))
+                done, _ = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if launched < len(order) and not streaming_owner:
+                        self.stats['hedged'] += 1
+                        launch()
+                    continue
+                for task in done:
+                    backend = tasks.pop(task)
+                    if task.exception() is None:
+                        if backend is not order[0]:
+                            self.stats['hedge_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+                if not tasks and launched < len(order):
+                    self.stats['fallbacks'] += 1
+                    launch()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        raise last_error or asyncio.TimeoutError("LLM deadline exceeded")
+
+    def scale_limits(self, factor: float):
+        for backend in self.backends:
+            backend.scale_limits(factor)
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.close()
+
+
+def _build_backend(spec: Dict[str, Any]) -> LLMBackend:
+    spec = dict(spec)
+    kind = spec.pop('type', 'openai')
+    common = {
+        'failure_threshold': spec.pop('failure_threshold', config.llm_circuit_failure_threshold),
+        'cooldown': spec.pop('cooldown', config.llm_circuit_cooldown),
+    }
+    if kind == 'stub':
+        return StubBackend(**spec, **common)
+    if kind == 'openai':
+        model = spec.pop('model', config.openai_model)
+        return OpenAICompatibleBackend(
+            name=spec.pop('name', model),
+            model=model,
+            base_url=spec.pop('base_url', config.openai_base_url),
+            api_key=spec.pop('api_key', config.openai_api_key),
+            rpm=spec.pop('rpm', config.llm_rate_limit_rpm),
+            **spec,
+            **common,
+        )
+    raise ValueError(f"Unknown LLM backend type: {kind}")
+
+
+def create_backend() -> LLMBackend:
+    """
+    Бэкенд по настройкам: LLM_BACKENDS (JSON список) или один
+    OpenAI-совместимый провайдер из OPENAI_BASE_URL / OPENAI_MODEL
+    """
+    specs = config.llm_backends or [{'type': 'openai'}]
+    backends = [_build_backend(spec) for spec in specs]
+    if len(backends) == 1:
+        return backends[0]
+    logger.info(f"🧭 Маршрутизатор LLM ({config.llm_router_strategy}): {', '.join(b.name for b in backends)}")
+    return LLMRouter(backends, config.llm_router_strategy, config.llm_hedge_delay)
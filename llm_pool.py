@@ -0,0 +1,215 @@
+"""
+Глобальный пул воркеров для запросов к LLM
+"""
+import asyncio
+import heapq
+import itertools
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+from loguru import logger
+
+
+class Priority(IntEnum):
+    """Приоритет запроса (меньше - важнее)"""
+    DIRECT = 0   # Прямой вопрос или упоминание бота
+    AMBIENT = 1  # Фоновая болтовня
+    BACKGROUND = 2  # Служебные запросы вне пути ответа (резюме чата)
+
+
+class LLMPoolOverloaded(Exception):
+    """Запрос отброшен из-за переполнения очереди"""
+
+
+class LLMDeadlineExceeded(Exception):
+    """Дедлайн запроса истек до начала выполнения"""
+
+
+def classify_priority(text: str, mentions: Iterable[str] = ()) -> Priority:
+    """Определяет приоритет по последнему сообщению"""
+    text = (text or "").lower()
+    if '?' in text or any(mention and mention in text for mention in mentions):
+        return Priority.DIRECT
+    return Priority.AMBIENT
+
+
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    deadline: float = field(compare=False)
+    call: Callable[[float], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    task: Optional[asyncio.Task] = field(default=None, compare=False)
+    on_start: Optional[Callable[[], None]] = field(default=None, compare=False)
+
+
+class LLMWorkerPool:
+    """
+    Ограниченный пул воркеров с приоритетной очередью.
+
+    Не больше `concurrency` запросов выполняются одновременно, очередь
+    ограничена `max_queue`: при переполнении вытесняется наименее важный
+    запрос. Запросы, чей дедлайн истек в очереди, не выполняются вовсе.
+    """
+
+    def __init__(self, concurrency: int = 4, max_queue: int = 100):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(1, max_queue)
+        self._heap: List[_Job] = []
+        self._seq = itertools.count()
+        self._not_empty: Optional[asyncio.Condition] = None
+        self._workers: List[asyncio.Task] = []
+        self.active = 0
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'shed': 0,
+            'expired': 0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        """Текущая глубина очереди"""
+        return len(self._heap)
+
+    async def resize(self, concurrency: int):
+        """Меняет число воркеров; лишние завершаются после текущего запроса"""
+        self.concurrency = max(1, concurrency)
+        if self._not_empty is None:
+            return
+        self._ensure_workers()
+        async with self._not_empty:
+            self._not_empty.notify_all()
+
+    @property
+    def _excess(self) -> bool:
+        return len(self._workers) > self.concurrency
+
+    def _ensure_workers(self):
+        """Лениво запускает воркеры в текущем event loop"""
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        if self._not_empty is None:
+            self._not_empty = asyncio.Condition()
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def submit(
+        self,
+        call: Callable[[float], Awaitable[Any]],
+        priority: Priority = Priority.AMBIENT,
+        deadline: Optional[float] = None,
+        on_start: Optional[Callable[[], None]] = None,
+    ) -> Any:
+        """
+        Ставит запрос в очередь и ждет его результат.
+
+        Args:
+            call: Фабрика корутины; получает оставшееся до дедлайна время
+            priority: Приоритет запроса
+            deadline: Момент loop.time(), после которого результат не нужен
+            on_start: Вызывается, когда воркер берет запрос в работу
+
+        Raises:
+            LLMPoolOverloaded: Очередь переполнена
+            LLMDeadlineExceeded: Дедлайн истек до начала выполнения
+        """
+        self._ensure_workers()
+        loop = asyncio.get_running_loop()
+        job = _Job(
+            priority=int(priority),
+            seq=next(self._seq),
+            deadline=deadline if deadline is not None else float('inf'),
+            call=call,
+            future=loop.create_future(),
+            on_start=on_start,
+        )
+        job.future.add_done_callback(lambda future: self._on_done(job))
+        self.stats['submitted'] += 1
+
+        if len(self._heap) >= self.max_queue:
+            worst = max(self._heap)
+            if worst < job:
+                self.stats['shed'] += 1
+                raise LLMPoolOverloaded(f"LLM queue is full ({self.max_queue})")
+            # Вытесняем наименее важный запрос в пользу нового
+            self._heap.remove(worst)
+            heapq.heapify(self._heap)
+            self.stats['shed'] += 1
+            if not worst.future.done():
+                worst.future.set_exception(LLMPoolOverloaded("Displaced by a higher priority request"))
+
+        heapq.heappush(self._heap, job)
+        async with self._not_empty:
+            self._not_empty.notify()
+
+        return await job.future
+
+    def _on_done(self, job: _Job):
+        """Отменяет выполнение или убирает запрос из очереди, если вызывающий перестал ждать"""
+        if not job.future.cancelled():
+            return
+        if job.task is None:
+            # Еще в очереди: не занимаем место под max_queue до выборки воркером
+            if job in self._heap:
+                self._heap.remove(job)
+                heapq.heapify(self._heap)
+        elif not job.task.done():
+            job.task.cancel()
+
+    async def _next_job(self) -> Optional[_Job]:
+        async with self._not_empty:
+            await self._not_empty.wait_for(lambda: self._heap or self._excess)
+            if self._excess:
+                # Пул уменьшен (resize): лишний воркер выходит между запросами
+                self._workers.remove(asyncio.current_task())
+                return None
+            return heapq.heappop(self._heap)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._next_job()
+            if job is None:
+                return
+            if job.future.done():
+                continue
+
+            remaining = job.deadline - loop.time()
+            if remaining <= 0:
+                self.stats['expired'] += 1
+                job.future.set_exception(LLMDeadlineExceeded("Deadline expired in queue"))
+                continue
+
+            self.active += 1
+            if job.on_start is not None:
+                job.on_start()
+            job.task = asyncio.ensure_future(job.call(remaining))
+            try:
+                result = await asyncio.wait_for(asyncio.shield(job.task), remaining)
+            except asyncio.TimeoutError:
+                job.task.cancel()
+                self.stats['failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(asyncio.TimeoutError())
+            except asyncio.CancelledError:
+                if job.task.cancelled():
+                    # Вызывающий отказался от результата, воркер продолжает работу
+                    self.stats['failed'] += 1
+                    continue
+                job.task.cancel()
+                raise
+            except Exception as e:
+                self.stats['failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.stats['completed'] += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.active -= 1
+
+            if self.queue_depth:
+                logger.debug(f"📥 LLM очередь: {self.queue_depth}, активно: {self.active}")
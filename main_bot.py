@@ -33,6 +33,7 @@ class SmartGroupBot:
         
         self.config = config
         self.application = None
+        self.webhook = None
         self.running = False
         
         logger.info("🤖 SmartGroupBot инициализирован")
@@ -74,25 +75,66 @@ class SmartGroupBot:
             user_id = str(user.id) if user else None
             username = user.username if user else None
             
+            # Потоковый ответ отправляется рано и дописывается правками
+            from send_queue import send_queue
+            streaming_reply = None
+            if self.config.stream_responses:
+                from streaming import StreamingReply
+                streaming_reply = StreamingReply(
+                    message, edit_interval=self.config.stream_edit_interval, limiter=send_queue
+                )
+            
+            # Номер этого сообщения в чате: по нему очередь отправки узнает, что разговор ушел дальше.
+            # Буфер подгружается заранее, иначе номер считался бы от пустого чата
+            await bot_service.message_buffer.ensure_loaded(chat_id)
+            seq = bot_service.message_buffer.message_seq(chat_id) + 1
+            
             logger.info(f"🔄 Вызываем bot_service.process_message...")
             bot_response = await bot_service.process_message(
                 chat_id=chat_id,
                 chat_title=chat_title,
                 message_text=message_text,
                 user_id=user_id,
-                username=username
+                username=username,
+                on_partial=streaming_reply.update if streaming_reply else None
             )
             
+            # Отправка идет в фоне: обработчик входящих не ждет Telegram
             if bot_response:
                 logger.info(f"📤 Отправляем ответ: {bot_response[:100]}...")
-                await message.reply_text(bot_response)
-                logger.info(f"✅ Ответ отправлен!")
+                if streaming_reply and streaming_reply.engaged:
+                    context.application.create_task(
+                        self._finish_stream(streaming_reply, chat_id, bot_response, message.message_id, seq)
+                    )
+                else:
+                    send_queue.submit(chat_id, bot_response, reply_to=message.message_id, seq=seq)
             else:
+                if streaming_reply and streaming_reply.engaged:
+                    context.application.create_task(self._close_stream(streaming_reply, chat_id))
                 logger.info(f"🤐 Бот решил не отвечать")
                 
         except Exception as e:
             logger.error(f"❌ Ошибка в handle_message: {e}", exc_info=True)
     
+    async def _finish_stream(self, streaming_reply, chat_id: str, text: str, reply_to: int, seq: int):
+        """Дописывает потоковый ответ и учитывает его в буфере чата"""
+        from bot_service import bot_service
+        from send_queue import send_queue
+        if not await streaming_reply.finish(text):
+            # Потоковое сообщение не ушло - ответ идет обычной очередью
+            send_queue.submit(chat_id, text, reply_to=reply_to, seq=seq)
+            return
+        bot_service.record_bot_reply(chat_id, text)
+        logger.info(f"✅ Ответ отправлен!")
+    
+    async def _close_stream(self, streaming_reply, chat_id: str):
+        """Фиксирует начатый потоковый ответ, если окончательного не будет"""
+        from bot_service import bot_service
+        shown = await streaming_reply.cancel()
+        if shown:
+            bot_service.record_bot_reply(chat_id, shown)
+            logger.info(f"✂️ Потоковый ответ оставлен с уже показанным текстом")
+    
     async def start_command(self, update, context):
         """Команда /start"""
         logger.info(f"🚀 Команда /start")
@@ -137,42 +179,34 @@ class SmartGroupBot:
     async def stats_command(self, update, context):
         """Команда /stats для статистики чата"""
         try:
-            from models import db_manager, ChatInteraction
-            from sqlalchemy import func
+            from bot_service import bot_service
             
             chat_id = str(update.effective_chat.id)
             
-            with db_manager.get_session() as db:
-                # Получаем статистику для текущего чата
-                total_messages = db.query(ChatInteraction).filter(
-                    ChatInteraction.chat_id == chat_id
-                ).count()
-                
-                responses_given = db.query(ChatInteraction).filter(
-                    ChatInteraction.chat_id == chat_id,
-                    ChatInteraction.response_generated == True
-                ).count()
-                
-                avg_sentiment = db.query(func.avg(ChatInteraction.sentiment)).filter(
-                    ChatInteraction.chat_id == chat_id,
-                    ChatInteraction.sentiment.isnot(None)
-                ).scalar()
-                
-                response_rate = (responses_given / total_messages * 100) if total_messages > 0 else 0
-                
-                stats_text = f"""
+            # Одна строка из накопительной таблицы chat_stats вместо скана истории
+            summary = await bot_service.get_chat_stats(chat_id)
+            total_messages = summary.get('total_interactions', 0)
+            responses_given = summary.get('responses_generated', 0)
+            avg_sentiment = summary.get('avg_sentiment')
+            
+            response_rate = summary.get('response_rate', 0.0) * 100
+            sentiment_text = f"{avg_sentiment:.2f}" if avg_sentiment is not None else "н/д"
+            topics = ", ".join(topic for topic, _ in summary.get('popular_topics', [])) or "н/д"
+            
+            stats_text = f"""
 📊 Статистика чата "{update.effective_chat.title}":
 
 📈 Всего обработано сообщений: {total_messages}
 🤖 Ответов от бота: {responses_given}
 📉 Частота ответов: {response_rate:.1f}%
-😊 Средний sentiment: {avg_sentiment:.2f if avg_sentiment else 'н/д'}
+😊 Средний sentiment: {sentiment_text}
+💬 Популярные темы: {topics}
 
 🌐 Полная аналитика: http://localhost:5001
-                """
-                
-                await update.message.reply_text(stats_text)
-                
+            """
+            
+            await update.message.reply_text(stats_text)
+            
         except Exception as e:
             logger.error(f"❌ Ошибка в stats_command: {e}")
             await update.message.reply_text("❌ Ошибка получения статистики")
@@ -186,33 +220,17 @@ class SmartGroupBot:
             logger.info(f"   • Частота ответов: раз в {self.config.response_frequency} сообщений")
             logger.info(f"   • Минимум контекста: {self.config.min_context_messages} сообщений")
             
-            # Создаем приложение
-            from telegram.ext import Application, MessageHandler, CommandHandler, filters
-            self.application = Application.builder().token(self.config.telegram_bot_token).build()
-            
-            # Добавляем обработчики
-            self.application.add_handler(CommandHandler("start", self.start_command))
-            self.application.add_handler(CommandHandler("help", self.help_command))
-            self.application.add_handler(CommandHandler("stats", self.stats_command))
-            self.application.add_handler(
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
-            )
-            
-            logger.info("✅ Обработчики настроены")
-            
-            # Получаем информацию о боте
-            bot_info = await self.application.bot.get_me()
-            logger.info(f"🤖 Бот @{bot_info.username} готов!")
-            logger.info(f"📖 Может читать все сообщения в группах: {bot_info.can_read_all_group_messages}")
-            logger.info(f"👥 Может присоединяться к группам: {bot_info.can_join_groups}")
-            
-            # Запускаем
-            await self.application.initialize()
-            await self.application.start()
-            await self.application.updater.start_polling(
-                allowed_updates=["message"],
-                drop_pending_updates=True
-            )
+            if self.config.webhook_url:
+                await self.setup_application(polling=False)
+                await self.start_webhook()
+            else:
+                await self.setup_application()
+                await self.application.updater.start_polling(
+                    allowed_updates=["message"],
+                    drop_pending_updates=True
+                )
+            self.start_background_jobs()
+            await self.start_metrics()
             
             self.running = True
             logger.info("🤖 === SMARTGROUPBOT АКТИВЕН ===")
@@ -227,6 +245,100 @@ class SmartGroupBot:
             logger.error(f"❌ Ошибка запуска: {e}", exc_info=True)
             raise
     
+    async def setup_application(self, polling: bool = True):
+        """Создает и запускает Application; без polling обновления кладутся в update_queue извне"""
+        # Создаем таблицы до приема сообщений
+        from models import db_manager
+        await db_manager.init_models()
+        
+        # Создаем приложение
+        from telegram.ext import Application, MessageHandler, CommandHandler, filters
+        # concurrent_updates: сообщения разных чатов не ждут друг друга,
+        # а всплески внутри чата сворачивает планировщик bot_service
+        builder = Application.builder()\
+            .token(self.config.telegram_bot_token)\
+            .concurrent_updates(True)
+        if not polling:
+            builder = builder.updater(None)
+        self.application = builder.build()
+        
+        # Добавляем обработчики
+        self.application.add_handler(CommandHandler("start", self.start_command))
+        self.application.add_handler(CommandHandler("help", self.help_command))
+        self.application.add_handler(CommandHandler("stats", self.stats_command))
+        self.application.add_handler(
+            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
+        )
+        
+        logger.info("✅ Обработчики настроены")
+        
+        # Получаем информацию о боте
+        bot_info = await self.application.bot.get_me()
+        
+        from ai_service import ai_service
+        ai_service.add_mention(f"@{bot_info.username}")
+        logger.info(f"🤖 Бот @{bot_info.username} готов!")
+        logger.info(f"📖 Может читать все сообщения в группах: {bot_info.can_read_all_group_messages}")
+        logger.info(f"👥 Может присоединяться к группам: {bot_info.can_join_groups}")
+        
+        # Запускаем
+        await self.application.initialize()
+        await self.application.start()
+        
+        # Ответы уходят через очередь с учетом лимитов Telegram
+        from bot_service import bot_service
+        from send_queue import send_queue
+        send_queue.start(
+            self.application.bot,
+            seq_source=bot_service.message_buffer.message_seq,
+            on_sent=bot_service.record_bot_reply
+        )
+    
+    async def start_webhook(self):
+        """Прием обновлений вебхуком на встроенном HTTP сервере вместо long polling"""
+        from telegram import Update
+        from http_server import http_server, create_webhook_ingress, webhook_url
+        
+        bot = self.application.bot
+        
+        async def deliver(data):
+            await self.application.update_queue.put(Update.de_json(data, bot))
+        
+        self.webhook = create_webhook_ingress(deliver)
+        self.webhook.attach(http_server)
+        self.webhook.start()
+        await http_server.start()
+        await bot.set_webhook(
+            url=webhook_url(),
+            secret_token=self.webhook.secret,
+            allowed_updates=["message"],
+            drop_pending_updates=True,
+            max_connections=self.config.webhook_max_connections
+        )
+        logger.info(f"🪝 Вебхук установлен: {webhook_url()}")
+    
+    async def start_metrics(self):
+        """Отдает метрики Prometheus на встроенном HTTP сервере"""
+        if not (self.config.metrics_enabled or self.webhook):
+            return
+        from http_server import http_server
+        from metrics import registry
+        http_server.route("GET", self.config.metrics_path, registry.handle)
+        await http_server.start()
+        logger.info(f"📊 Метрики: http://{http_server.host}:{http_server.port}{self.config.metrics_path}")
+    
+    def start_background_jobs(self, retention: bool = True):
+        """Запускает фоновые задачи процесса (очистку истории и снимки буфера)"""
+        # Периодическая очистка истории небольшими транзакциями
+        if retention and self.config.retention_enabled:
+            from retention import retention_job
+            retention_job.start(self.config.retention_interval)
+        
+        # Снимки буфера сообщений для теплого старта после перезапуска
+        from bot_service import bot_service
+        if bot_service.snapshots:
+            bot_service.snapshots.start(self.config.buffer_snapshot_interval)
+    
     async def stop(self):
         """Остановка бота"""
         logger.info("🛑 Остановка SmartGroupBot...")
@@ -235,9 +347,19 @@ class SmartGroupBot:
         if self.application:
             try:
                 # Проверяем, запущен ли updater перед остановкой
-                if self.application.updater.running:
+                if self.application.updater and self.application.updater.running:
                     await self.application.updater.stop()
                 
+                # Вебхук: перестаем принимать запросы и передаем уже принятые обновления
+                from http_server import http_server
+                await http_server.stop()
+                if self.webhook:
+                    await self.webhook.stop()
+                
+                # Досылаем ожидающие ответы, пока бот еще доступен
+                from send_queue import send_queue
+                await send_queue.stop()
+                
                 # Останавливаем приложение если оно запущено
                 if self.application.running:
                     await self.application.stop()
@@ -248,6 +370,23 @@ class SmartGroupBot:
             except Exception as e:
                 logger.warning(f"⚠️ Ошибка при остановке (не критично): {e}")
             
+        # Дописываем накопленные взаимодействия
+        try:
+            from bot_service import bot_service
+            from persistence import interaction_writer
+            from retention import retention_job
+            from models import db_manager
+            await retention_job.stop()
+            if bot_service.summarizer:
+                await bot_service.summarizer.stop()
+            if bot_service.snapshots:
+                await bot_service.snapshots.stop()
+            await interaction_writer.stop()
+            await bot_service.message_buffer.flush_spill()
+            await db_manager.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка сброса очереди записи: {e}")
+            
         logger.info("✅ SmartGroupBot остановлен")
 
 async def main():
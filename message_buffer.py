@@ -0,0 +1,385 @@
+"""
+Компактный буфер последних сообщений по чатам
+"""
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from loguru import logger
+
+from ai_service import ai_service
+from config import config
+from models import db_manager
+
+
+class ChatBuffer:
+    """
+    Кольцевой буфер сообщений одного чата.
+
+    Тексты, монотонные отметки времени и признак "от бота" хранятся
+    в параллельных массивах фиксированной длины. Счетчики сообщений
+    в скользящем окне обновляются при добавлении и при устаревании
+    записей, поэтому проверка частоты не перебирает буфер.
+    """
+
+    __slots__ = (
+        'capacity', 'texts', 'times', 'flags', 'start', 'size', 'expired',
+        'humans_in_window', 'bots_in_window', 'bot_responses', 'last_response_at', 'last_activity',
+        'text_bytes', 'human_seq', 'summary', 'unsummarized',
+    )
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.texts: List[Optional[str]] = [None] * capacity
+        self.times = [0.0] * capacity
+        self.flags = bytearray(capacity)
+        self.start = 0           # Индекс самой старой записи
+        self.size = 0
+        self.expired = 0         # Сколько самых старых записей уже вне окна
+        self.humans_in_window = 0
+        self.bots_in_window = 0
+        self.bot_responses = 0
+        self.last_response_at = float('-inf')
+        self.last_activity = 0.0
+        self.text_bytes = 0      # Суммарный размер хранимых строк
+        self.human_seq = 0       # Сколько сообщений людей добавлено за все время
+        self.summary = ""        # Краткое содержание обсуждения (см. summarizer.py)
+        self.unsummarized = 0    # Сообщений после последнего обновления резюме
+
+    @staticmethod
+    def overhead(capacity: int) -> int:
+        """Размер пустого буфера: объект, массивы и объекты float отметок времени"""
+        return (
+            sys.getsizeof(ChatBuffer.__new__(ChatBuffer))
+            + 2 * sys.getsizeof([None] * capacity)
+            + sys.getsizeof(bytearray(capacity))
+            + 24 * capacity
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.overhead(self.capacity) + self.text_bytes
+
+    def _uncount(self, index: int):
+        if self.flags[index]:
+            self.bots_in_window -= 1
+        else:
+            self.humans_in_window -= 1
+
+    def append(self, text: str, is_bot: bool, now: float):
+        if self.size == self.capacity:
+            # Вытесняем самую старую запись; из счетчиков - только если она еще в окне
+            if self.expired:
+                self.expired -= 1
+            else:
+                self._uncount(self.start)
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+            self.text_bytes -= sys.getsizeof(self.texts[index])
+        else:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+
+        self.text_bytes += sys.getsizeof(text)
+        self.unsummarized += 1
+        self.texts[index] = text
+        self.times[index] = now
+        self.flags[index] = is_bot
+        if is_bot:
+            self.bots_in_window += 1
+            self.bot_responses += 1
+            self.last_response_at = now
+        else:
+            self.humans_in_window += 1
+            self.human_seq += 1
+        self.last_activity = now
+
+    def expire(self, cutoff: float):
+        """Выводит из окна записи старше cutoff (амортизированно O(1))"""
+        while self.expired < self.size:
+            index = (self.start + self.expired) % self.capacity
+            if self.times[index] >= cutoff:
+                break
+            self._uncount(index)
+            self.expired += 1
+
+    def recent_texts(self, limit: int) -> List[str]:
+        """Тексты людей среди последних `limit` записей, от старых к новым"""
+        count = min(limit, self.size)
+        first = self.start + self.size - count
+        texts, flags, capacity = self.texts, self.flags, self.capacity
+        return [texts[i % capacity] for i in range(first, first + count) if not flags[i % capacity]]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def records(self):
+        """Записи (текст, монотонное время, от бота) от старых к новым"""
+        for i in range(self.start, self.start + self.size):
+            index = i % self.capacity
+            yield self.texts[index], self.times[index], bool(self.flags[index])
+
+    def export(self, now: float = None, wall_now: float = None) -> Dict[str, Any]:
+        """Состояние с временем в unix-секундах, переживающее перезапуск процесса"""
+        offset = (wall_now if wall_now is not None else time.time()) - (now if now is not None else time.monotonic())
+        texts, times, flags = [], [], []
+        for text, at, is_bot in self.records():
+            texts.append(text)
+            times.append(round(at + offset, 3))
+            flags.append(int(is_bot))
+        return {
+            'texts': texts,
+            'times': times,
+            'flags': flags,
+            'bot_responses': self.bot_responses,
+            'last_response_at': self.last_response_at + offset if self.bot_responses else None,
+            'summary': self.summary,
+            'unsummarized': self.unsummarized,
+            'human_seq': self.human_seq,
+        }
+
+    @classmethod
+    def restore(cls, state: Dict[str, Any], capacity: int, now: float = None, wall_now: float = None) -> 'ChatBuffer':
+        """Восстанавливает буфер из export(), переводя время в монотонные часы"""
+        offset = (now if now is not None else time.monotonic()) - (wall_now if wall_now is not None else time.time())
+        chat = cls(capacity)
+        for text, at, is_bot in zip(state['texts'], state['times'], state['flags']):
+            chat.append(text, bool(is_bot), at + offset)
+        chat.bot_responses = state.get('bot_responses', chat.bot_responses)
+        if state.get('last_response_at') is not None:
+            chat.last_response_at = state['last_response_at'] + offset
+        chat.set_summary(state.get('summary') or "", state.get('unsummarized', chat.unsummarized))
+        # Номер сообщения не сбрасывается: по нему очередь отправки отсеивает устаревшие ответы
+        chat.human_seq = max(chat.human_seq, state.get('human_seq') or 0)
+        return chat
+
+    def set_summary(self, summary: str, unsummarized: int):
+        # Пустая строка - общий объект, в размере буфера не учитывается
+        if self.summary:
+            self.text_bytes -= sys.getsizeof(self.summary)
+        if summary:
+            self.text_bytes += sys.getsizeof(summary)
+        self.summary = summary
+        self.unsummarized = unsummarized
+
+
+class MessageBuffer:
+    """Буфер для хранения последних сообщений по чатам"""
+
+    def __init__(
+        self,
+        max_messages: int = 20,
+        window: float = 600.0,
+        response_cooldown: float = 30.0,
+        idle_ttl: float = None,
+        memory_budget: int = None,
+        spill: bool = None,
+        spill_max_age: float = None,
+    ):
+        self.max_messages = max_messages
+        self.window = window                        # Окно подсчета частоты (сек)
+        self.response_cooldown = response_cooldown  # Пауза после ответа бота (сек)
+        self.idle_ttl = idle_ttl if idle_ttl is not None else config.buffer_idle_ttl
+        self.memory_budget = (
+            memory_budget if memory_budget is not None else int(config.buffer_memory_budget_mb * 2 ** 20)
+        )
+        self.spill = spill if spill is not None else config.buffer_spill_enabled
+        self.spill_max_age = spill_max_age if spill_max_age is not None else config.buffer_spill_max_age
+        # Порядок - по последней активности: в начале самые давно молчащие чаты
+        self.chats: "OrderedDict[str, ChatBuffer]" = OrderedDict()
+        self.bytes_used = 0
+        self._spill_pending: Dict[str, Dict[str, Any]] = {}
+        self._spill_task: Optional[asyncio.Task] = None
+        # Чаты, изменившиеся после последнего снимка (см. buffer_snapshot.py)
+        self.dirty: Set[str] = set()
+        # Источник состояний чатов, не загруженных при старте (ленивый снимок)
+        self.lazy_loader: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None
+        self.stats = {
+            'evicted_idle': 0,
+            'evicted_budget': 0,
+            'spilled': 0,
+            'rehydrated': 0,
+            'spill_errors': 0,
+        }
+
+    @property
+    def gauges(self) -> Dict[str, int]:
+        """Текущее состояние памяти буфера"""
+        return {
+            'tracked_chats': len(self.chats),
+            'bytes_used': self.bytes_used,
+            'memory_budget': self.memory_budget,
+            'spill_pending': len(self._spill_pending),
+        }
+
+    def __len__(self) -> int:
+        return len(self.chats)
+
+    def __contains__(self, chat_id: str) -> bool:
+        return chat_id in self.chats
+
+    def add_message(self, chat_id: str, message: str, is_bot: bool = False):
+        """Добавляет сообщение в буфер"""
+        now = time.monotonic()
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatBuffer(self.max_messages)
+            self.bytes_used += chat.nbytes
+        else:
+            self.chats.move_to_end(chat_id)
+        before = chat.text_bytes
+        chat.append(message, is_bot, now)
+        self.bytes_used += chat.text_bytes - before
+        self.dirty.add(chat_id)
+        self.evict_idle(now)
+        self.enforce_budget()
+
+    def _evict(self, chat_id: str, reason: str):
+        chat = self.chats.pop(chat_id)
+        self.bytes_used -= chat.nbytes
+        self.stats[f'evicted_{reason}'] += 1
+        if self.spill and chat.size:
+            self._schedule_spill(chat_id, chat.export())
+
+    def evict_idle(self, now: float = None) -> int:
+        """Забывает (или вытесняет в БД) чаты, молчавшие дольше idle_ttl"""
+        if not self.idle_ttl:
+            return 0
+        cutoff = (now if now is not None else time.monotonic()) - self.idle_ttl
+        evicted = 0
+        while self.chats:
+            chat_id, chat = next(iter(self.chats.items()))
+            if chat.last_activity >= cutoff:
+                break
+            self._evict(chat_id, 'idle')
+            evicted += 1
+        return evicted
+
+    def enforce_budget(self) -> int:
+        """Вытесняет давно неактивные чаты, пока буфер не уложится в бюджет памяти"""
+        evicted = 0
+        # Самый активный чат не вытесняется, даже если один не помещается в бюджет
+        while self.memory_budget and self.bytes_used > self.memory_budget and len(self.chats) > 1:
+            self._evict(next(iter(self.chats)), 'budget')
+            evicted += 1
+        return evicted
+
+    def _schedule_spill(self, chat_id: str, state: Dict[str, Any]):
+        self._spill_pending[chat_id] = state
+        if self._spill_task is None or self._spill_task.done():
+            try:
+                self._spill_task = asyncio.get_running_loop().create_task(self.flush_spill())
+            except RuntimeError:
+                # Нет event loop: состояние запишет следующий flush_spill()
+                pass
+
+    async def flush_spill(self):
+        """Записывает вытесненные буферы в БД (таблица chat_buffers)"""
+        while self._spill_pending:
+            batch = self._spill_pending
+            self._spill_pending = {}
+            try:
+                await db_manager.save_chat_buffers(batch, self.spill_max_age)
+                self.stats['spilled'] += len(batch)
+            except Exception as e:
+                self.stats['spill_errors'] += 1
+                logger.warning(f"⚠️ Не удалось выгрузить {len(batch)} буферов чатов в БД: {e}")
+                return
+
+    async def ensure_loaded(self, chat_id: str):
+        """Подгружает вытесненный или не восстановленный при старте буфер чата"""
+        if chat_id in self.chats:
+            return
+        state = self._spill_pending.pop(chat_id, None)
+        if state is None and self.lazy_loader is not None:
+            state = self.lazy_loader(chat_id)
+        if state is None and self.spill:
+            try:
+                state = await db_manager.pop_chat_buffer(chat_id, self.spill_max_age)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось загрузить буфер чата {chat_id}: {e}")
+                return
+        if not state:
+            return
+        self.restore_chat(chat_id, ChatBuffer.restore(state, self.max_messages))
+        self.stats['rehydrated'] += 1
+
+    def release(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        """Убирает чат из буфера и возвращает его состояние (передача другому процессу)"""
+        chat = self.chats.pop(chat_id, None)
+        if chat is None:
+            return None
+        self.bytes_used -= chat.nbytes
+        self.dirty.discard(chat_id)
+        return chat.export()
+
+    def restore_chat(self, chat_id: str, restored: ChatBuffer):
+        """Возвращает в буфер восстановленное состояние чата"""
+        current = self.chats.pop(chat_id, None)
+        if current is not None:
+            # Пока шла загрузка, в чат успели прийти сообщения - они новее сохраненных
+            self.bytes_used -= current.nbytes
+            for text, at, is_bot in current.records():
+                restored.append(text, is_bot, at)
+        self.chats[chat_id] = restored
+        self.bytes_used += restored.nbytes
+        self.enforce_budget()
+
+    def get_recent_messages(self, chat_id: str, limit: int = None) -> List[str]:
+        """Получает последние сообщения из чата"""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return []
+        return chat.recent_texts(limit or config.max_context_messages)
+
+    def get_participants_count(self, chat_id: str) -> int:
+        """Подсчитывает количество уникальных участников (упрощенная версия)"""
+        # В реальной реализации здесь был бы анализ пользователей
+        chat = self.chats.get(chat_id)
+        return min(len(chat), 10) if chat is not None else 0
+
+    def get_summary(self, chat_id: str) -> str:
+        """Краткое содержание обсуждения в чате (пустая строка - еще нет)"""
+        chat = self.chats.get(chat_id)
+        return chat.summary if chat is not None else ""
+
+    def set_summary(self, chat_id: str, summary: str, covered: int):
+        """Сохраняет резюме, учитывающее `covered` самых старых несведенных сообщений"""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return
+        before = chat.text_bytes
+        chat.set_summary(summary, max(0, chat.unsummarized - covered))
+        self.bytes_used += chat.text_bytes - before
+        self.dirty.add(chat_id)
+
+    def message_seq(self, chat_id: str) -> int:
+        """Номер последнего сообщения людей в чате (растет с каждым сообщением)"""
+        chat = self.chats.get(chat_id)
+        return chat.human_seq if chat is not None else 0
+
+    def window_counts(self, chat_id: str) -> Dict[str, int]:
+        """Сообщения людей и бота за последние `window` секунд"""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return {'humans': 0, 'bots': 0}
+        chat.expire(time.monotonic() - self.window)
+        return {'humans': chat.humans_in_window, 'bots': chat.bots_in_window}
+
+    def should_respond_by_frequency(self, chat_id: str) -> bool:
+        """Проверяет, можно ли отвечать по частоте"""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return False
+        now = time.monotonic()
+
+        # Проверяем, не отвечал ли бот недавно
+        if now - chat.last_response_at < self.response_cooldown:
+            return False
+
+        chat.expire(now - self.window)
+        return ai_service.should_respond_based_on_frequency(
+            chat.humans_in_window, chat.bots_in_window
+        )
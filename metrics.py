@@ -0,0 +1,321 @@
+"""
+Метрики процесса в текстовом формате Prometheus
+"""
+import functools
+import math
+import time
+from bisect import bisect_left
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from loguru import logger
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Границы по умолчанию: от миллисекунд (БД, разбор) до десятков секунд (LLM)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _label_text(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    """
+    Семейство метрик с одинаковыми метками.
+
+    Дочерняя метрика на набор значений меток создается один раз и
+    кэшируется: горячий путь - поиск в словаре и сложение, без
+    блокировок (весь бот работает в одном потоке asyncio).
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], '_Metric'] = {}
+
+    def labels(self, *values) -> '_Metric':
+        child = self._children.get(values)
+        if child is None:
+            key = tuple(str(value) for value in values)
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получено {key}")
+            child = self._children.get(key) or self._child()
+            # Строковые метки (почти все вызовы) находятся без преобразования
+            self._children[key] = self._children[values] = child
+        return child
+
+    def _child(self) -> '_Metric':
+        return type(self)(self.name, self.documentation)
+
+    def _series(self) -> Iterable[Tuple[Tuple[str, ...], '_Metric']]:
+        if self.labelnames:
+            return sorted(item for item in self._children.items() if all(type(value) is str for value in item[0]))
+        return [((), self)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._series():
+            lines.extend(child._samples(self.labelnames, values))
+        return lines
+
+    def _samples(self, names: Sequence[str], values: Sequence[str]) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def _samples(self, names, values):
+        return [f"{self.name}{_label_text(names, values)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    """Текущее значение; с функцией значение читается только при сборе метрик"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), function: Callable[[], float] = None):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def _samples(self, names, values):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.debug(f"📉 Метрика {self.name} не собрана: {e}")
+                return []
+        return [f"{self.name}{_label_text(names, values)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (задержки и размеры)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self) -> 'Histogram':
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> '_Timer':
+        """Контекстный менеджер: наблюдает длительность блока"""
+        return _Timer(self)
+
+    def _samples(self, names, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            labels = _label_text(tuple(names) + ('le',), tuple(values) + (_format_value(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _label_text(names, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count{labels} {self.count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class StatsCollector:
+    """
+    Экспорт словаря `stats` компонента как семейства метрик с одной меткой.
+
+    Компоненты бота уже ведут счетчики в `self.stats`; они читаются только
+    при запросе /metrics, поэтому горячий путь не меняется. С несколькими
+    метками ключи словаря - кортежи их значений (например, бэкенд и событие).
+    """
+
+    def __init__(self, name: str, documentation: str, source: Callable[[], Optional[Dict[Any, float]]], label: Union[str, Sequence[str]], kind: str = "counter"):
+        self.name = name
+        self.documentation = documentation
+        self.source = source
+        self.labels = (label,) if isinstance(label, str) else tuple(label)
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        try:
+            stats = self.source()
+        except Exception as e:
+            logger.debug(f"📉 Метрика {self.name} не собрана: {e}")
+            return []
+        if not stats:
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(stats.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{self.name}{_label_text(self.labels, values)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса и их выдача для Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), function: Callable[[], float] = None) -> Gauge:
+        """С function значение читается из объекта при сборе; новый объект заменяет прежний"""
+        if function is not None:
+            self._metrics.pop(name, None)
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def stats(self, name: str, documentation: str, source: Callable[[], Optional[Dict[Any, float]]], label: Union[str, Sequence[str]], kind: str = "counter") -> StatsCollector:
+        """Словарь stats компонента (читается при сборе) - см. StatsCollector"""
+        self._metrics.pop(name, None)
+        return self.register(StatsCollector(name, documentation, source, label, kind))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request) -> Tuple[int, bytes, str]:
+        """Обработчик GET /metrics для http_server"""
+        return HTTPStatus.OK, self.render().encode('utf-8'), CONTENT_TYPE
+
+
+def timed(histogram: Histogram, errors: Counter = None):
+    """
+    Декоратор корутины-метода: длительность в histogram с меткой имени метода
+
+    Исключения считаются в errors с метками (метод, класс исключения).
+    """
+    def decorator(function):
+        observe = histogram.labels(function.__name__).observe
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                if errors is not None:
+                    errors.labels(function.__name__, type(e).__name__).inc()
+                raise
+            finally:
+                observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# Глобальный реестр метрик
+registry = MetricsRegistry()
+
+# Обработка сообщений (bot_service)
+messages_total = registry.counter(
+    "smartbot_messages_total", "Processed incoming messages by pipeline outcome", ("outcome",)
+)
+stage_seconds = registry.histogram(
+    "smartbot_stage_seconds", "Time spent in each process_message stage", ("stage",)
+)
+
+# Запросы к LLM (ai_service)
+llm_request_seconds = registry.histogram(
+    "smartbot_llm_request_seconds", "LLM completion latency by backend and outcome", ("backend", "outcome")
+)
+llm_tokens_total = registry.counter(
+    "smartbot_llm_tokens_total", "Tokens reported by the LLM provider", ("kind",)
+)
+llm_errors_total = registry.counter(
+    "smartbot_llm_errors_total", "Failed LLM completions by exception type", ("type",)
+)
+ai_results_total = registry.counter(
+    "smartbot_ai_results_total", "Context analysis results by source (llm, cache, fallback, silent)", ("source",)
+)
+ai_fallback_total = registry.counter(
+    "smartbot_ai_fallback_total", "Local fallback answers by reason", ("reason",)
+)
+
+# База данных (models.DatabaseManager)
+db_seconds = registry.histogram(
+    "smartbot_db_seconds", "DatabaseManager operation latency", ("operation",)
+)
+db_errors_total = registry.counter(
+    "smartbot_db_errors_total", "Failed DatabaseManager operations", ("operation", "type")
+)
+
+# Отправка в Telegram (send_queue, streaming)
+telegram_seconds = registry.histogram(
+    "smartbot_telegram_seconds", "Telegram Bot API call latency", ("method",)
+)
+telegram_errors_total = registry.counter(
+    "smartbot_telegram_errors_total", "Failed Telegram Bot API calls", ("method", "type")
+)
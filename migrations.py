@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Версионные миграции схемы базы данных
+
+Текущая версия хранится в таблице `schema_version`. Каждая миграция -
+функция над синхронным SQLAlchemy соединением, которая описывает схему
+на момент своего написания и не зависит от текущих моделей.
+
+    python migrations.py            # применить недостающие миграции
+    python migrations.py --status   # показать текущую версию
+"""
+import argparse
+import asyncio
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from loguru import logger
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Integer, JSON, LargeBinary,
+    MetaData, SmallInteger, String, Table, Text, inspect, text
+)
+from sqlalchemy.engine import Connection
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+_version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", _version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def _baseline(connection: Connection):
+    """v1: исходная схема (chat_id строкой, sentiment строкой)"""
+
+
+# Значения sentiment, которые раньше писались метками вместо чисел
+_SENTIMENT_CASE = """
+    CASE lower(trim(sentiment))
+        WHEN 'positive' THEN 1.0
+        WHEN 'neutral' THEN 0.0
+        WHEN 'negative' THEN -1.0
+        ELSE {numeric}
+    END
+"""
+
+
+def _interactions_v2(metadata: MetaData, name: str) -> Table:
+    return Table(
+        name, metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("timestamp", DateTime, nullable=False),
+        Column("chat_id", BigInteger, nullable=False),
+        Column("chat_title", String(255), nullable=True),
+        Column("context_messages", JSON, nullable=False),
+        Column("detected_topic", String(255), nullable=True),
+        Column("sentiment", Float, nullable=True),
+        Column("bot_response", Text, nullable=True),
+        Column("response_generated", Boolean, nullable=False),
+        Column("participants_count", Integer, nullable=False),
+    )
+
+
+def _typed_columns_and_indexes(connection: Connection):
+    """
+    v2: chat_id BIGINT, sentiment FLOAT, составной индекс (chat_id, timestamp)
+    и частичный индекс по ответам бота.
+    """
+    dialect = connection.dialect.name
+
+    if dialect == "postgresql":
+        connection.execute(text("DROP INDEX IF EXISTS ix_chat_interactions_chat_id"))
+        connection.execute(text(
+            "ALTER TABLE chat_interactions "
+            "ALTER COLUMN chat_id TYPE BIGINT USING chat_id::bigint"
+        ))
+        numeric = "CASE WHEN sentiment ~ '^\\s*-?[0-9]+(\\.[0-9]+)?\\s*$' THEN sentiment::double precision END"
+        connection.execute(text(
+            "ALTER TABLE chat_interactions ALTER COLUMN sentiment TYPE DOUBLE PRECISION USING "
+            + _SENTIMENT_CASE.format(numeric=numeric)
+        ))
+        responded = "response_generated IS TRUE"
+    else:
+        # SQLite не меняет тип колонки: пересобираем таблицу и переносим данные
+        # Те же правила, что у регулярного выражения PostgreSQL: -?цифры(.цифры)?
+        value = "trim(sentiment, ' ' || char(9, 10, 13))"
+        numeric = (
+            f"CASE WHEN {value} GLOB '*[0-9]*' AND {value} NOT GLOB '*[^0-9.-]*' "
+            f"AND substr({value}, 2) NOT GLOB '*-*' AND {value} NOT GLOB '*.*.*' "
+            f"AND {value} NOT GLOB '*.' AND {value} NOT GLOB '.*' AND {value} NOT GLOB '-.*' "
+            f"THEN CAST({value} AS REAL) END"
+        )
+        new_table = _interactions_v2(MetaData(), "chat_interactions__v2")
+        new_table.create(connection)
+        connection.execute(text(
+            "INSERT INTO chat_interactions__v2 "
+            "(id, timestamp, chat_id, chat_title, context_messages, detected_topic, "
+            "sentiment, bot_response, response_generated, participants_count) "
+            "SELECT id, timestamp, CAST(chat_id AS INTEGER), chat_title, context_messages, "
+            "detected_topic, " + _SENTIMENT_CASE.format(numeric=numeric) + ", bot_response, "
+            "coalesce(response_generated, 0), coalesce(participants_count, 0) "
+            "FROM chat_interactions"
+        ))
+        connection.execute(text("DROP TABLE chat_interactions"))
+        connection.execute(text("ALTER TABLE chat_interactions__v2 RENAME TO chat_interactions"))
+        responded = "response_generated IS 1"
+
+    connection.execute(text(
+        "CREATE INDEX ix_chat_interactions_chat_id_timestamp "
+        "ON chat_interactions (chat_id, timestamp)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX ix_chat_interactions_responded "
+        f"ON chat_interactions (chat_id, timestamp) WHERE {responded}"
+    ))
+
+    # Накопительная статистика выводится из истории: таблицы пересоздадутся
+    # с новым типом chat_id и заполнятся через rebuild_stats()
+    connection.execute(text("DROP TABLE IF EXISTS chat_stats_hourly"))
+    connection.execute(text("DROP TABLE IF EXISTS chat_stats"))
+
+
+def _split_context_messages(connection: Connection, chunk_size: int = 2000):
+    """
+    v3: тексты контекста переезжают из JSON колонки в таблицу messages
+    (по одному экземпляру на текст) со ссылками из interaction_messages.
+    """
+    from models import intern_messages
+
+    metadata = MetaData()
+    Table(
+        "messages", metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("content_hash", String(64), nullable=False, unique=True),
+        Column("body", LargeBinary, nullable=False),
+        Column("codec", String(8), nullable=False),
+        Column("size", Integer, nullable=False),
+    )
+    Table("chat_interactions", metadata, Column("id", Integer, primary_key=True))
+    links = Table(
+        "interaction_messages", metadata,
+        Column("interaction_id", Integer, ForeignKey("chat_interactions.id", ondelete="CASCADE"), primary_key=True),
+        Column("position", SmallInteger, primary_key=True),
+        Column("message_id", Integer, ForeignKey("messages.id"), nullable=False, index=True),
+    )
+    metadata.create_all(connection, tables=[metadata.tables["messages"], links])
+
+    last_id, moved = 0, 0
+    while True:
+        rows = connection.execute(
+            text("SELECT id, context_messages FROM chat_interactions WHERE id > :last ORDER BY id LIMIT :limit"),
+            {"last": last_id, "limit": chunk_size},
+        ).all()
+        if not rows:
+            break
+        contexts = []
+        for interaction_id, context in rows:
+            if isinstance(context, (str, bytes)):
+                context = json.loads(context)
+            contexts.append((interaction_id, [str(body) for body in context or []]))
+        bodies = [body for _, context in contexts for body in context]
+        if bodies:
+            message_ids = iter(intern_messages(connection, bodies))
+            connection.execute(links.insert(), [
+                {"interaction_id": interaction_id, "position": position, "message_id": next(message_ids)}
+                for interaction_id, context in contexts
+                for position in range(len(context))
+            ])
+        last_id = rows[-1][0]
+        moved += len(rows)
+    logger.info(f"🗄️ Контекст {moved} взаимодействий перенесен в messages")
+
+    # SQLite освобождает место на диске только после VACUUM
+    connection.execute(text("ALTER TABLE chat_interactions DROP COLUMN context_messages"))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline", _baseline),
+    Migration(2, "typed chat_id and sentiment, composite indexes", _typed_columns_and_indexes),
+    Migration(3, "content-addressed messages table for context", _split_context_messages),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(connection: Connection) -> Optional[int]:
+    """Версия схемы или None, если база еще не под управлением миграций"""
+    if not inspect(connection).has_table("schema_version"):
+        return None
+    return connection.execute(text("SELECT max(version) FROM schema_version")).scalar()
+
+
+def _stamp(connection: Connection, migration: Migration):
+    connection.execute(schema_version.insert().values(
+        version=migration.version, name=migration.name, applied_at=datetime.utcnow()
+    ))
+
+
+def upgrade(connection: Connection, metadata: MetaData = None) -> int:
+    """
+    Доводит схему до последней версии.
+
+    Пустая база создается сразу по текущим моделям (`metadata`) и помечается
+    последней версией; база без `schema_version`, но с данными, считается v1.
+
+    Returns:
+        Количество примененных миграций
+    """
+    version = current_version(connection)
+    has_interactions = inspect(connection).has_table("chat_interactions")
+    _version_metadata.create_all(connection)
+
+    if version is None and not has_interactions:
+        if metadata is not None:
+            metadata.create_all(connection)
+        _stamp(connection, MIGRATIONS[-1])
+        logger.info(f"🗄️ Создана схема БД версии {LATEST_VERSION}")
+        return 0
+
+    version = version or 0
+    applied = 0
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        logger.info(f"🗄️ Миграция БД {migration.version}: {migration.name}")
+        migration.upgrade(connection)
+        _stamp(connection, migration)
+        applied += 1
+
+    if metadata is not None:
+        # Новые таблицы, которые не требуют переноса данных
+        metadata.create_all(connection)
+    return applied
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы БД SmartGroupBot")
+    parser.add_argument("--status", action="store_true", help="Только показать версию схемы")
+    args = parser.parse_args()
+
+    from models import Base, db_manager
+
+    async with db_manager.engine.begin() as connection:
+        if args.status:
+            version = await connection.run_sync(current_version)
+            print(f"Версия схемы: {version if version is not None else 'не размечена'} (последняя {LATEST_VERSION})")
+        else:
+            applied = await connection.run_sync(upgrade, Base.metadata)
+            print(f"Применено миграций: {applied}, версия схемы {LATEST_VERSION}")
+    await db_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
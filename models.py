@@ -1,114 +1,771 @@
 """
 Модели базы данных
 """
-from datetime import datetime
-from typing import Dict, List, Any
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Optional, Tuple
+import asyncio
+import hashlib
 import json
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, JSON
+import zlib
+from sqlalchemy import (
+    insert, select, delete, func, text, Column, ForeignKey, Index, Integer, BigInteger, SmallInteger,
+    String, DateTime, Boolean, Text, JSON, Float, LargeBinary
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import relationship, selectinload
 from config import config
+from metrics import db_errors_total, db_seconds, timed
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 Base = declarative_base()
 
 
+SENTIMENT_LABELS = {'positive': 1.0, 'neutral': 0.0, 'negative': -1.0}
+MAX_TRACKED_TOPICS = 50
+
+
+def parse_sentiment(value: Any) -> Optional[float]:
+    """Приводит sentiment (число, строка-число или метка) к float"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().lower()
+    if text in SENTIMENT_LABELS:
+        return SENTIMENT_LABELS[text]
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def to_chat_id(value: Any) -> int:
+    """Приводит ID чата Telegram к целому числу"""
+    return int(value)
+
+
+def sentiment_bucket(value: float) -> str:
+    """Относит числовой sentiment к positive/neutral/negative"""
+    if value > 0.25:
+        return 'positive'
+    if value < -0.25:
+        return 'negative'
+    return 'neutral'
+
+
+def message_hash(body: str) -> str:
+    """Адрес текста в таблице messages"""
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def encode_message_body(body: str) -> Tuple[bytes, str]:
+    """Сжимает текст согласно настройкам, возвращает (данные, алгоритм)"""
+    raw = body.encode('utf-8')
+    codec = config.message_compression
+    if codec == 'none' or len(raw) < config.message_compression_min_bytes:
+        return raw, 'none'
+    if codec == 'zstd' and zstandard is not None:
+        packed, used = zstandard.ZstdCompressor(level=3).compress(raw), 'zstd'
+    else:
+        packed, used = zlib.compress(raw, 6), 'zlib'
+    # Несжимаемые тексты выгоднее хранить как есть
+    return (packed, used) if len(packed) < len(raw) else (raw, 'none')
+
+
+def decode_message_body(data: bytes, codec: str) -> str:
+    """Восстанавливает текст из таблицы messages"""
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard package is required to read zstd-compressed messages")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return data.decode('utf-8')
+
+
+class StoredMessage(Base):
+    """Текст сообщения, хранится один раз независимо от числа ссылок"""
+    
+    __tablename__ = "messages"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    content_hash = Column(String(64), nullable=False, unique=True)
+    body = Column(LargeBinary, nullable=False)
+    codec = Column(String(8), nullable=False, default='none')  # none, zlib, zstd
+    size = Column(Integer, nullable=False)  # Размер исходного текста в байтах
+    
+    @property
+    def text(self) -> str:
+        return decode_message_body(self.body, self.codec)
+
+
+class InteractionMessage(Base):
+    """Ссылка взаимодействия на сообщение контекста с позицией в окне"""
+    
+    __tablename__ = "interaction_messages"
+    
+    interaction_id = Column(Integer, ForeignKey("chat_interactions.id", ondelete="CASCADE"), primary_key=True)
+    position = Column(SmallInteger, primary_key=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False, index=True)
+    
+    message = relationship(StoredMessage, lazy="raise")
+
+
+def _dialect_insert(executor, table):
+    """INSERT, пропускающий уже существующие тексты, если диалект это умеет"""
+    bind = executor.get_bind() if hasattr(executor, 'get_bind') else executor
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing(index_elements=['content_hash'])
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing(index_elements=['content_hash'])
+    return insert(table)
+
+
+def intern_messages(executor, bodies: List[str], chunk_size: int = 500) -> List[int]:
+    """
+    Возвращает id текстов в таблице messages, добавляя недостающие.
+    
+    Работает с синхронными Session/Connection, поэтому используется и
+    из миграций, и из AsyncSession через run_sync().
+    """
+    hashes = [message_hash(body) for body in bodies]
+    unique = dict(zip(hashes, bodies))
+    ids: Dict[str, int] = {}
+    
+    def lookup(keys):
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            # FOR KEY SHARE: сборщик неиспользуемых текстов (retention) не удалит
+            # найденный текст, пока эта транзакция не вставит ссылки на него
+            result = executor.execute(
+                select(StoredMessage.content_hash, StoredMessage.id)
+                .where(StoredMessage.content_hash.in_(chunk))
+                .with_for_update(read=True, key_share=True)
+            )
+            ids.update((key, message_id) for key, message_id in result)
+    
+    lookup(list(unique))
+    missing = [key for key in unique if key not in ids]
+    if missing:
+        rows = []
+        for key in missing:
+            body, codec = encode_message_body(unique[key])
+            rows.append({'content_hash': key, 'body': body, 'codec': codec, 'size': len(unique[key].encode('utf-8'))})
+        executor.execute(_dialect_insert(executor, StoredMessage.__table__), rows)
+        lookup(missing)
+    return [ids[key] for key in hashes]
+
+
 class ChatInteraction(Base):
     """Модель для хранения взаимодействий в чатах"""
     
     __tablename__ = "chat_interactions"
+    __table_args__ = (
+        # Все выборки фильтруют по чату и сортируют по времени
+        Index('ix_chat_interactions_chat_id_timestamp', 'chat_id', 'timestamp'),
+        # Частичный индекс: ответы бота - малая доля истории
+        Index(
+            'ix_chat_interactions_responded', 'chat_id', 'timestamp',
+            sqlite_where=text('response_generated IS 1'),
+            postgresql_where=text('response_generated IS TRUE')
+        ),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
-    chat_id = Column(String(50), nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
     chat_title = Column(String(255), nullable=True)
-    context_messages = Column(JSON, nullable=False)  # Список последних сообщений
     detected_topic = Column(String(255), nullable=True)
-    sentiment = Column(String(20), nullable=True)  # positive, neutral, negative
+    sentiment = Column(Float, nullable=True)  # от -1 до 1
     bot_response = Column(Text, nullable=True)
     response_generated = Column(Boolean, default=False, nullable=False)
     participants_count = Column(Integer, default=0, nullable=False)
     
-    def to_dict(self) -> Dict[str, Any]:
+    # Тексты контекста лежат в messages; загружаются только явно (selectinload)
+    context_links = relationship(
+        InteractionMessage, order_by=InteractionMessage.position, lazy="raise", passive_deletes=True
+    )
+    
+    @property
+    def context_messages(self) -> List[str]:
+        """Контекст взаимодействия; требует загрузки через include_context=True"""
+        return [link.message.text for link in self.context_links]
+    
+    def to_dict(self, include_context: bool = False) -> Dict[str, Any]:
         """Преобразует объект в словарь"""
-        return {
+        result = {
             'id': self.id,
             'timestamp': self.timestamp.isoformat() if self.timestamp else None,
-            'chat_id': self.chat_id,
+            'chat_id': str(self.chat_id),
             'chat_title': self.chat_title,
-            'context_messages': self.context_messages,
             'detected_topic': self.detected_topic,
             'sentiment': self.sentiment,
             'bot_response': self.bot_response,
             'response_generated': self.response_generated,
             'participants_count': self.participants_count
         }
+        if include_context:
+            result['context_messages'] = self.context_messages
+        return result
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'ChatInteraction':
-        """Создает объект из словаря"""
-        return cls(
-            chat_id=data['chat_id'],
+        """Создает объект из словаря (без контекста, он сохраняется через DatabaseManager)"""
+        return cls(**cls.row_from_dict(data))
+    
+    @staticmethod
+    def row_from_dict(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Готовит значения колонок для bulk INSERT"""
+        return dict(
+            timestamp=data.get('timestamp') or datetime.utcnow(),
+            chat_id=to_chat_id(data['chat_id']),
             chat_title=data.get('chat_title'),
-            context_messages=data['context_messages'],
             detected_topic=data.get('detected_topic'),
-            sentiment=data.get('sentiment'),
+            sentiment=parse_sentiment(data.get('sentiment')),
             bot_response=data.get('bot_response'),
             response_generated=data.get('response_generated', False),
             participants_count=data.get('participants_count', 0)
         )
 
 
+class ChatStats(Base):
+    """Накопительная статистика чата, обновляется при каждой записи"""
+    
+    __tablename__ = "chat_stats"
+    
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    chat_title = Column(String(255), nullable=True)
+    total_interactions = Column(Integer, default=0, nullable=False)
+    responses_generated = Column(Integer, default=0, nullable=False)
+    sentiment_sum = Column(Float, default=0.0, nullable=False)
+    sentiment_count = Column(Integer, default=0, nullable=False)
+    sentiment_positive = Column(Integer, default=0, nullable=False)
+    sentiment_neutral = Column(Integer, default=0, nullable=False)
+    sentiment_negative = Column(Integer, default=0, nullable=False)
+    topic_counts = Column(JSON, nullable=False, default=dict)  # {тема: количество}
+    participants_count = Column(Integer, default=0, nullable=False)
+    first_interaction_at = Column(DateTime, nullable=True)
+    last_interaction_at = Column(DateTime, nullable=True)
+    
+    @property
+    def avg_sentiment(self) -> Optional[float]:
+        return self.sentiment_sum / self.sentiment_count if self.sentiment_count else None
+    
+    @property
+    def response_rate(self) -> float:
+        return (self.responses_generated or 0) / max(self.total_interactions or 0, 1)
+    
+    def popular_topics(self, limit: int = 5) -> List[Tuple[str, int]]:
+        return sorted((self.topic_counts or {}).items(), key=lambda x: x[1], reverse=True)[:limit]
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Преобразует объект в словарь"""
+        return {
+            'chat_id': str(self.chat_id),
+            'chat_title': self.chat_title,
+            'total_interactions': self.total_interactions,
+            'responses_generated': self.responses_generated,
+            'response_rate': self.response_rate,
+            'avg_sentiment': self.avg_sentiment,
+            'sentiment_distribution': {
+                'positive': self.sentiment_positive,
+                'neutral': self.sentiment_neutral,
+                'negative': self.sentiment_negative
+            },
+            'popular_topics': self.popular_topics(),
+            'participants_count': self.participants_count,
+            'first_interaction_at': self.first_interaction_at.isoformat() if self.first_interaction_at else None,
+            'last_activity': self.last_interaction_at.isoformat() if self.last_interaction_at else None
+        }
+
+
+class ChatStatsHourly(Base):
+    """Почасовые счетчики активности чата"""
+    
+    __tablename__ = "chat_stats_hourly"
+    
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    hour = Column(DateTime, primary_key=True)
+    interactions = Column(Integer, default=0, nullable=False)
+    responses = Column(Integer, default=0, nullable=False)
+    sentiment_sum = Column(Float, default=0.0, nullable=False)
+    sentiment_count = Column(Integer, default=0, nullable=False)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Преобразует объект в словарь"""
+        return {
+            'hour': self.hour.isoformat(),
+            'interactions': self.interactions,
+            'responses': self.responses,
+            'avg_sentiment': self.sentiment_sum / self.sentiment_count if self.sentiment_count else None
+        }
+
+
+class SpilledChatBuffer(Base):
+    """Буфер сообщений чата, вытесненный из памяти"""
+    
+    __tablename__ = "chat_buffers"
+    
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    state = Column(JSON, nullable=False)  # ChatBuffer.export()
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+
+class ChatKeyword(Base):
+    """Ключевые слова чата по TF-IDF всей истории (пересчитывает run_analytics.py)"""
+    
+    __tablename__ = "chat_keywords"
+    
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    keyword = Column(String(64), primary_key=True)
+    score = Column(Float, nullable=False)
+    documents = Column(Integer, default=0, nullable=False)  # Во скольких взаимодействиях слово среди главных
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Преобразует объект в словарь"""
+        return {'keyword': self.keyword, 'score': self.score, 'documents': self.documents}
+
+
+def _new_chat_stats(chat_id: int) -> ChatStats:
+    return ChatStats(
+        chat_id=chat_id, total_interactions=0, responses_generated=0,
+        sentiment_sum=0.0, sentiment_count=0, sentiment_positive=0,
+        sentiment_neutral=0, sentiment_negative=0, topic_counts={}, participants_count=0
+    )
+
+
+def _new_hourly_stats(chat_id: int, hour: datetime) -> ChatStatsHourly:
+    return ChatStatsHourly(
+        chat_id=chat_id, hour=hour, interactions=0, responses=0,
+        sentiment_sum=0.0, sentiment_count=0
+    )
+
+
+def _count_sentiment(item: Optional[ChatStats], bucket: Optional[ChatStatsHourly], sentiment: Optional[float], step: int = 1):
+    """Добавляет (step=1) или вычитает (step=-1) тональность строки из счетчиков"""
+    if sentiment is None:
+        return
+    label = sentiment_bucket(sentiment)
+    if item is not None:
+        item.sentiment_sum += step * sentiment
+        item.sentiment_count += step
+        setattr(item, f'sentiment_{label}', max(getattr(item, f'sentiment_{label}') + step, 0))
+    if bucket is not None:
+        bucket.sentiment_sum += step * sentiment
+        bucket.sentiment_count += step
+
+
+def _count_topic(item: ChatStats, topic: Optional[str], step: int = 1):
+    """Меняет счетчик темы; темы с нулевым счетчиком убираются"""
+    if not topic:
+        return
+    # JSON колонка отслеживает изменения только при присваивании
+    topics = dict(item.topic_counts or {})
+    count = topics.get(topic, 0) + step
+    if count > 0:
+        topics[topic] = count
+    else:
+        topics.pop(topic, None)
+    if len(topics) > MAX_TRACKED_TOPICS:
+        topics = dict(sorted(topics.items(), key=lambda x: x[1], reverse=True)[:MAX_TRACKED_TOPICS])
+    item.topic_counts = topics
+
+
+def _hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def to_async_url(database_url: str) -> str:
+    """Подставляет асинхронный драйвер в URL базы данных"""
+    scheme, sep, rest = database_url.partition("://")
+    dialect = scheme.split("+", 1)[0]
+    drivers = {
+        "sqlite": "sqlite+aiosqlite",
+        "postgresql": "postgresql+asyncpg",
+        "postgres": "postgresql+asyncpg",
+    }
+    if dialect in drivers and scheme != drivers[dialect]:
+        return f"{drivers[dialect]}{sep}{rest}"
+    return database_url
+
+
 class DatabaseManager:
-    """Менеджер для работы с базой данных"""
+    """Асинхронный менеджер для работы с базой данных"""
     
     def __init__(self, database_url: str = None):
-        self.database_url = database_url or config.database_url
-        self.engine = create_engine(self.database_url, echo=False)
-        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.database_url = to_async_url(database_url or config.database_url)
         
-        # Создаем таблицы
-        Base.metadata.create_all(bind=self.engine)
+        engine_options = {}
+        if not self.database_url.startswith("sqlite"):
+            # Настройки пула соединений для серверных БД
+            engine_options = {
+                "pool_size": config.db_pool_size,
+                "max_overflow": config.db_max_overflow,
+                "pool_timeout": config.db_pool_timeout,
+                "pool_recycle": config.db_pool_recycle,
+                "pool_pre_ping": True,
+            }
+        
+        self.engine = create_async_engine(self.database_url, echo=False, **engine_options)
+        self.SessionLocal = async_sessionmaker(
+            bind=self.engine, autoflush=False, expire_on_commit=False
+        )
+        self._initialized = False
+        self._init_lock = asyncio.Lock()
+        # False - схемой управляет другой процесс (супервизор шардирования)
+        self.manage_schema = True
     
-    def get_session(self):
+    async def init_models(self):
+        """Создает таблицы (один раз за процесс)"""
+        if self._initialized:
+            return
+        async with self._init_lock:
+            if self._initialized:
+                return
+            if not self.manage_schema:
+                self._initialized = True
+                return
+            from migrations import upgrade
+            async with self.engine.begin() as connection:
+                await connection.run_sync(upgrade, Base.metadata)
+            self._initialized = True
+            
+            # Первый запуск с накопительной статистикой на существующей истории
+            async with self.get_session() as session:
+                has_stats = (await session.execute(select(ChatStats.chat_id).limit(1))).first()
+                has_history = (await session.execute(select(ChatInteraction.id).limit(1))).first()
+            if has_history and not has_stats:
+                await self.rebuild_stats()
+    
+    def get_session(self) -> AsyncSession:
         """Получает сессию базы данных"""
         return self.SessionLocal()
     
-    def save_interaction(self, interaction_data: Dict[str, Any]) -> ChatInteraction:
+    @staticmethod
+    async def _lock_rollups(
+        session: AsyncSession, chat_ids: set, hours: set
+    ) -> Tuple[Dict[int, ChatStats], Dict[Tuple[int, datetime], ChatStatsHourly]]:
+        """
+        Читает счетчики чатов и часов с блокировкой строк до конца транзакции.
+        
+        Фоновый писатель и пакетная аналитика меняют одни и те же строки;
+        FOR UPDATE в одном порядке (по chat_id, затем по часу) не дает им
+        затереть изменения друг друга. SQLite блокирует всю базу на запись
+        и FOR UPDATE не поддерживает - там он опускается.
+        """
+        result = await session.execute(
+            select(ChatStats).where(ChatStats.chat_id.in_(chat_ids)).order_by(ChatStats.chat_id).with_for_update()
+        )
+        stats = {item.chat_id: item for item in result.scalars()}
+        result = await session.execute(
+            select(ChatStatsHourly)
+            .where(ChatStatsHourly.chat_id.in_(chat_ids), ChatStatsHourly.hour.in_(hours))
+            .order_by(ChatStatsHourly.chat_id, ChatStatsHourly.hour)
+            .with_for_update()
+        )
+        hourly = {(item.chat_id, item.hour): item for item in result.scalars()}
+        return stats, hourly
+    
+    async def _apply_rollups(self, session: AsyncSession, rows: List[Dict[str, Any]]):
+        """Добавляет строки к накопительной статистике в той же транзакции"""
+        stats, hourly = await self._lock_rollups(
+            session, {row['chat_id'] for row in rows}, {_hour(row['timestamp']) for row in rows}
+        )
+        
+        for row in rows:
+            chat_id = row['chat_id']
+            item = stats.get(chat_id)
+            if item is None:
+                item = stats[chat_id] = _new_chat_stats(chat_id)
+                session.add(item)
+            hour = _hour(row['timestamp'])
+            bucket = hourly.get((chat_id, hour))
+            if bucket is None:
+                bucket = hourly[(chat_id, hour)] = _new_hourly_stats(chat_id, hour)
+                session.add(bucket)
+            
+            responded = bool(row.get('response_generated'))
+            item.chat_title = row.get('chat_title') or item.chat_title
+            item.total_interactions += 1
+            item.responses_generated += int(responded)
+            item.participants_count = max(item.participants_count, row.get('participants_count') or 0)
+            if item.first_interaction_at is None or row['timestamp'] < item.first_interaction_at:
+                item.first_interaction_at = row['timestamp']
+            if item.last_interaction_at is None or row['timestamp'] > item.last_interaction_at:
+                item.last_interaction_at = row['timestamp']
+            bucket.interactions += 1
+            bucket.responses += int(responded)
+            
+            _count_sentiment(item, bucket, parse_sentiment(row.get('sentiment')))
+            _count_topic(item, row.get('detected_topic'))
+    
+    async def adjust_rollups(self, session: AsyncSession, changes: List[Dict[str, Any]]):
+        """
+        Переносит в статистику исправления тональности и темы уже учтенных строк.
+        
+        changes - словари с chat_id, timestamp и парами old_/new_sentiment,
+        old_/new_topic. Вызывается в транзакции, которая меняет сами строки:
+        счетчики сдвигаются на разницу, поэтому вклад истории, уже удаленной
+        очисткой, сохраняется. Почасовой счетчик, свернутый в дневной,
+        ищется по началу дня.
+        """
+        hours = {_hour(change['timestamp']) for change in changes}
+        stats, hourly = await self._lock_rollups(
+            session, {change['chat_id'] for change in changes}, hours | {hour.replace(hour=0) for hour in hours}
+        )
+        
+        for change in changes:
+            chat_id = change['chat_id']
+            item = stats.get(chat_id)
+            hour = _hour(change['timestamp'])
+            bucket = hourly.get((chat_id, hour)) or hourly.get((chat_id, hour.replace(hour=0)))
+            old, new = parse_sentiment(change.get('old_sentiment')), parse_sentiment(change.get('new_sentiment'))
+            if old != new:
+                _count_sentiment(item, bucket, old, -1)
+                _count_sentiment(item, bucket, new)
+            if item is not None and change.get('old_topic') != change.get('new_topic'):
+                _count_topic(item, change.get('old_topic'), -1)
+                _count_topic(item, change.get('new_topic'))
+    
+    async def _insert_interactions(self, session: AsyncSession, interactions_data: List[Dict[str, Any]]) -> List[int]:
+        """Вставляет взаимодействия, их контекст и статистику в одной транзакции"""
+        rows = [ChatInteraction.row_from_dict(data) for data in interactions_data]
+        result = await session.execute(
+            insert(ChatInteraction).returning(ChatInteraction.id, sort_by_parameter_order=True), rows
+        )
+        interaction_ids = list(result.scalars())
+        
+        contexts = [list(data.get('context_messages') or []) for data in interactions_data]
+        bodies = [body for context in contexts for body in context]
+        if bodies:
+            # Перекрывающиеся окна контекста ссылаются на одни и те же тексты
+            message_ids = iter(await session.run_sync(intern_messages, bodies))
+            links = [
+                {'interaction_id': interaction_id, 'position': position, 'message_id': next(message_ids)}
+                for interaction_id, context in zip(interaction_ids, contexts)
+                for position in range(len(context))
+            ]
+            await session.execute(insert(InteractionMessage), links)
+        
+        await self._apply_rollups(session, rows)
+        return interaction_ids
+    
+    @timed(db_seconds, db_errors_total)
+    async def save_interaction(self, interaction_data: Dict[str, Any]) -> ChatInteraction:
         """Сохраняет взаимодействие в базу данных"""
-        session = self.get_session()
-        try:
-            interaction = ChatInteraction.from_dict(interaction_data)
-            session.add(interaction)
-            session.commit()
-            session.refresh(interaction)
-            return interaction
-        except Exception as e:
-            session.rollback()
-            raise e
-        finally:
-            session.close()
-    
-    def get_chat_history(self, chat_id: str, limit: int = 50) -> List[ChatInteraction]:
-        """Получает историю чата"""
-        session = self.get_session()
-        try:
-            interactions = session.query(ChatInteraction)\
-                .filter(ChatInteraction.chat_id == chat_id)\
-                .order_by(ChatInteraction.timestamp.desc())\
-                .limit(limit)\
-                .all()
-            return interactions
-        finally:
-            session.close()
-    
-    def get_total_interactions(self) -> int:
+        await self.init_models()
+        async with self.get_session() as session:
+            try:
+                [interaction_id] = await self._insert_interactions(session, [interaction_data])
+                await session.commit()
+                return await session.get(ChatInteraction, interaction_id)
+            except Exception as e:
+                await session.rollback()
+                raise e
+    
+    @timed(db_seconds, db_errors_total)
+    async def save_interactions(self, interactions_data: List[Dict[str, Any]]) -> int:
+        """Сохраняет пачку взаимодействий bulk INSERT'ами в одной транзакции"""
+        if not interactions_data:
+            return 0
+        await self.init_models()
+        async with self.get_session() as session:
+            try:
+                interaction_ids = await self._insert_interactions(session, interactions_data)
+                await session.commit()
+                return len(interaction_ids)
+            except Exception as e:
+                await session.rollback()
+                raise e
+    
+    @timed(db_seconds, db_errors_total)
+    async def get_chat_history(self, chat_id: str, limit: int = 50, include_context: bool = False) -> List[ChatInteraction]:
+        """
+        Получает историю чата.
+        
+        Тексты контекста подгружаются отдельным запросом только при
+        include_context=True; иначе обращение к ним вызывает ошибку.
+        """
+        await self.init_models()
+        async with self.get_session() as session:
+            query = (
+                select(ChatInteraction)
+                .where(ChatInteraction.chat_id == to_chat_id(chat_id))
+                .order_by(ChatInteraction.timestamp.desc())
+                .limit(limit)
+            )
+            if include_context:
+                query = query.options(
+                    selectinload(ChatInteraction.context_links).selectinload(InteractionMessage.message)
+                )
+            result = await session.execute(query)
+            return list(result.scalars().all())
+
+    @timed(db_seconds, db_errors_total)
+    async def get_bot_responses(self, chat_id: str, limit: int = 20) -> List[ChatInteraction]:
+        """Получает последние ответы бота в чате (частичный индекс по ответам)"""
+        await self.init_models()
+        async with self.get_session() as session:
+            result = await session.execute(
+                select(ChatInteraction)
+                .where(
+                    ChatInteraction.chat_id == to_chat_id(chat_id),
+                    ChatInteraction.response_generated.is_(True)
+                )
+                .order_by(ChatInteraction.timestamp.desc())
+                .limit(limit)
+            )
+            return list(result.scalars().all())
+
+    @timed(db_seconds, db_errors_total)
+    async def get_total_interactions(self) -> int:
         """Получает общее количество взаимодействий"""
-        session = self.get_session()
-        try:
-            return session.query(ChatInteraction).count()
-        finally:
-            session.close()
+        await self.init_models()
+        async with self.get_session() as session:
+            result = await session.execute(select(func.count()).select_from(ChatInteraction))
+            return result.scalar_one()
+    
+    @timed(db_seconds, db_errors_total)
+    async def get_chat_stats(self, chat_id: str) -> Optional[ChatStats]:
+        """Получает накопительную статистику чата (O(1), без сканирования истории)"""
+        await self.init_models()
+        async with self.get_session() as session:
+            return await session.get(ChatStats, to_chat_id(chat_id))
+    
+    @timed(db_seconds, db_errors_total)
+    async def get_all_chat_stats(self) -> List[ChatStats]:
+        """Получает статистику всех чатов, последние активные первыми"""
+        await self.init_models()
+        async with self.get_session() as session:
+            result = await session.execute(
+                select(ChatStats).order_by(ChatStats.last_interaction_at.desc())
+            )
+            return list(result.scalars().all())
+    
+    @timed(db_seconds, db_errors_total)
+    async def get_global_stats(self) -> Dict[str, Any]:
+        """Сводная статистика по всем чатам из таблицы chat_stats"""
+        await self.init_models()
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        async with self.get_session() as session:
+            result = await session.execute(
+                select(
+                    func.count(ChatStats.chat_id),
+                    func.coalesce(func.sum(ChatStats.total_interactions), 0),
+                    func.coalesce(func.sum(ChatStats.responses_generated), 0),
+                    func.coalesce(func.sum(ChatStats.sentiment_sum), 0.0),
+                    func.coalesce(func.sum(ChatStats.sentiment_count), 0),
+                    func.count(ChatStats.chat_id).filter(ChatStats.last_interaction_at >= today),
+                    func.max(ChatStats.last_interaction_at),
+                )
+            )
+            chats, interactions, responses, sentiment_sum, sentiment_count, active_today, last_activity = result.one()
+        return {
+            'total_chats': chats,
+            'total_interactions': interactions,
+            'total_responses': responses,
+            'response_rate': round(responses / interactions * 100, 1) if interactions else 0.0,
+            'avg_sentiment': sentiment_sum / sentiment_count if sentiment_count else None,
+            'active_chats_today': active_today,
+            'last_activity': last_activity.isoformat() if last_activity else None
+        }
+    
+    @timed(db_seconds, db_errors_total)
+    async def get_hourly_activity(self, chat_id: str = None, hours: int = 24) -> List[ChatStatsHourly]:
+        """Почасовая активность чата (или всех чатов) за последние часы"""
+        await self.init_models()
+        since = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+        async with self.get_session() as session:
+            query = select(ChatStatsHourly).where(ChatStatsHourly.hour >= since)
+            if chat_id is not None:
+                query = query.where(ChatStatsHourly.chat_id == to_chat_id(chat_id))
+            result = await session.execute(query.order_by(ChatStatsHourly.hour))
+            return list(result.scalars().all())
+    
+    @timed(db_seconds, db_errors_total)
+    async def rebuild_stats(self, chunk_size: int = 5000):
+        """Пересчитывает накопительную статистику по всей истории"""
+        await self.init_models()
+        async with self.get_session() as session:
+            await session.execute(delete(ChatStats))
+            await session.execute(delete(ChatStatsHourly))
+            stream = await session.stream(
+                select(
+                    ChatInteraction.chat_id, ChatInteraction.chat_title, ChatInteraction.timestamp,
+                    ChatInteraction.sentiment, ChatInteraction.detected_topic,
+                    ChatInteraction.response_generated, ChatInteraction.participants_count
+                ).execution_options(yield_per=chunk_size)
+            )
+            async for partition in stream.mappings().partitions(chunk_size):
+                await self._apply_rollups(session, [dict(row) for row in partition])
+                await session.flush()
+            await session.commit()
+        logger.info("📊 Накопительная статистика пересчитана")
+    
+    @timed(db_seconds, db_errors_total)
+    async def get_chat_keywords(self, chat_id: str, limit: int = 10) -> List[ChatKeyword]:
+        """Главные ключевые слова чата из материализованной таблицы chat_keywords"""
+        await self.init_models()
+        async with self.get_session() as session:
+            result = await session.execute(
+                select(ChatKeyword)
+                .where(ChatKeyword.chat_id == to_chat_id(chat_id))
+                .order_by(ChatKeyword.score.desc())
+                .limit(limit)
+            )
+            return list(result.scalars().all())
+    
+    @timed(db_seconds, db_errors_total)
+    async def save_chat_buffers(self, states: Dict[str, Dict[str, Any]], max_age: float = None):
+        """Сохраняет вытесненные буферы чатов (перезаписывая прежние) и удаляет устаревшие"""
+        await self.init_models()
+        now = datetime.utcnow()
+        rows = [{'chat_id': to_chat_id(chat_id), 'state': state, 'updated_at': now} for chat_id, state in states.items()]
+        async with self.get_session() as session:
+            try:
+                await session.execute(
+                    delete(SpilledChatBuffer).where(SpilledChatBuffer.chat_id.in_([row['chat_id'] for row in rows]))
+                )
+                await session.execute(insert(SpilledChatBuffer), rows)
+                if max_age:
+                    await session.execute(
+                        delete(SpilledChatBuffer).where(SpilledChatBuffer.updated_at < now - timedelta(seconds=max_age))
+                    )
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                raise e
+    
+    @timed(db_seconds, db_errors_total)
+    async def pop_chat_buffer(self, chat_id: str, max_age: float = None) -> Optional[Dict[str, Any]]:
+        """Забирает вытесненный буфер чата (строка удаляется)"""
+        await self.init_models()
+        async with self.get_session() as session:
+            row = await session.get(SpilledChatBuffer, to_chat_id(chat_id))
+            if row is None:
+                return None
+            state, updated_at = row.state, row.updated_at
+            await session.delete(row)
+            await session.commit()
+        if max_age and updated_at < datetime.utcnow() - timedelta(seconds=max_age):
+            return None
+        return state
+    
+    async def close(self):
+        """Закрывает пул соединений"""
+        await self.engine.dispose()
 
 
 # Глобальный экземпляр менеджера базы данных
-db_manager = DatabaseManager() 
\ No newline at end of file
+db_manager = DatabaseManager()
@@ -0,0 +1,277 @@
+"""
+Отложенная пакетная запись взаимодействий в базу данных
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+
+from models import db_manager
+from metrics import registry
+from config import config
+
+
+class InteractionWriter:
+    """
+    Write-behind конвейер для взаимодействий.
+
+    Обработчик сообщений только кладет запись в ограниченную очередь,
+    а единственный писатель собирает пачки (по размеру или по времени)
+    и сохраняет их одним bulk INSERT. Если база недоступна, пачка уходит
+    в JSONL спул на диске и дописывается в базу после восстановления.
+    Строки спула, которые не читаются или не сохраняются из-за самих
+    данных, откладываются в карантин `<спул>.bad` и не мешают остальным.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        spool_path: Optional[str] = None,
+        spool_max_bytes: int = 50 * 1024 * 1024,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spool_path = Path(spool_path) if spool_path else None
+        self.spool_max_bytes = spool_max_bytes
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'dropped': 0,
+            'spooled': 0,
+            'replayed': 0,
+            'quarantined': 0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        """Запускает писателя в текущем event loop"""
+        self._closed = False
+        if self._task is None or self._task.done():
+            self._queue = self._queue or asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+            logger.info("💾 Пакетная запись в БД запущена")
+
+    def submit(self, interaction_data: Dict[str, Any]):
+        """Ставит взаимодействие в очередь, никогда не блокируя вызывающего"""
+        interaction_data.setdefault('timestamp', datetime.utcnow())
+        if self._closed:
+            # После stop() писатель не перезапускается сам: база может быть уже закрыта
+            if not self._spool([interaction_data]):
+                self.stats['dropped'] += 1
+                logger.warning("⚠️ Запись в БД остановлена, взаимодействие отброшено")
+            return
+        self.start()
+        try:
+            self._queue.put_nowait(interaction_data)
+            self.stats['queued'] += 1
+        except asyncio.QueueFull:
+            # Очередь ограничена по памяти: излишек уходит в спул или теряется
+            if not self._spool([interaction_data]):
+                self.stats['dropped'] += 1
+                logger.warning("⚠️ Очередь записи переполнена, взаимодействие отброшено")
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    # Остановка: дописываем собранное и выходим
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        try:
+            await db_manager.save_interactions(batch)
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетной записи в БД ({len(batch)} записей): {e}")
+            if not self._spool(batch):
+                self.stats['dropped'] += len(batch)
+            return
+
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+        logger.debug(f"💾 Сохранено {len(batch)} взаимодействий одной пачкой")
+
+        if self.spool_path and self.spool_path.exists():
+            await self._replay_spool()
+
+    def _spool(self, batch: List[Dict[str, Any]]) -> bool:
+        """Дописывает записи в спул на диске"""
+        if not self.spool_path:
+            return False
+        try:
+            if self.spool_path.exists() and self.spool_path.stat().st_size >= self.spool_max_bytes:
+                logger.warning("⚠️ Спул записи переполнен")
+                return False
+            lines = "".join(json.dumps(item, ensure_ascii=False, default=_json_default) + "\n" for item in batch)
+            _append_lines(self.spool_path, lines.encode('utf-8'))
+            self.stats['spooled'] += len(batch)
+            return True
+        except OSError as e:
+            logger.error(f"❌ Ошибка записи в спул: {e}")
+            return False
+
+    def _quarantine(self, lines: List[bytes], reason: Any):
+        """Откладывает строки спула, которые нельзя записать, в <спул>.bad"""
+        self.stats['quarantined'] += len(lines)
+        logger.error(f"❌ {len(lines)} строк спула отложено в карантин: {reason}")
+        try:
+            _append_lines(self.spool_path.with_suffix(self.spool_path.suffix + ".bad"), b"".join(lines))
+        except OSError as e:
+            logger.error(f"❌ Ошибка записи карантина спула: {e}")
+
+    async def _replay_spool(self):
+        """Переносит накопленный спул в базу после восстановления"""
+        replay_path = self.spool_path.with_suffix(self.spool_path.suffix + ".replay")
+        try:
+            os.replace(self.spool_path, replay_path)
+        except OSError:
+            return
+
+        pending: List[Tuple[Dict[str, Any], bytes]] = []
+        with open(replay_path, 'rb') as replay:
+            try:
+                for line in replay:
+                    if not line.strip():
+                        continue
+                    try:
+                        pending.append((_decode_spooled(line), line))
+                    except (TypeError, ValueError) as e:
+                        # Оборванная при сбое или испорченная строка
+                        self._quarantine([_terminated(line)], e)
+                        continue
+                    if len(pending) >= self.batch_size:
+                        await self._replay_batch(pending)
+                if pending:
+                    await self._replay_batch(pending)
+                logger.info("♻️ Спул записи перенесен в БД")
+            except Exception as e:
+                # База снова недоступна: незаписанный остаток возвращается в спул до следующей попытки
+                logger.error(f"❌ Ошибка переноса спула в БД: {e}")
+                rest = b"".join(_terminated(line) for _, line in pending) + b"".join(_terminated(line) for line in replay)
+                _append_lines(self.spool_path, rest)
+        replay_path.unlink()
+
+    async def _replay_batch(self, pending: List[Tuple[Dict[str, Any], bytes]]):
+        """
+        Сохраняет пачку из спула; записанные строки убираются из pending.
+
+        Пачка, отвергнутая из-за данных, делится пополам, пока не останется
+        одна плохая строка - она уходит в карантин, остальные записываются.
+        Ошибки доступности базы пробрасываются, остаток остается в pending.
+        """
+        try:
+            await db_manager.save_interactions([item for item, _ in pending])
+        except Exception as e:
+            if _unavailable(e):
+                raise
+            if len(pending) == 1:
+                self._quarantine([_terminated(pending[0][1])], e)
+                pending.clear()
+                return
+            head, tail = pending[:len(pending) // 2], pending[len(pending) // 2:]
+            try:
+                await self._replay_batch(head)
+                await self._replay_batch(tail)
+            finally:
+                pending[:] = head + tail
+            return
+        self.stats['replayed'] += len(pending)
+        pending.clear()
+
+    async def stop(self):
+        """Дописывает очередь и останавливает писателя; последующие записи уходят в спул"""
+        self._closed = True
+        if self._task is None or self._task.done():
+            return
+        # Маркер остановки встает в конец очереди, все до него будет записано
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        logger.info("💾 Очередь записи в БД сброшена")
+
+
+def _unavailable(error: Exception) -> bool:
+    """Ошибка доступности базы, а не данных конкретных строк"""
+    return isinstance(
+        error, (OperationalError, InterfaceError, DisconnectionError, PoolTimeoutError, OSError, asyncio.TimeoutError)
+    ) or getattr(error, 'connection_invalidated', False)
+
+
+def _decode_spooled(line: bytes) -> Dict[str, Any]:
+    """Строка спула в запись; ValueError, если строка испорчена"""
+    item = json.loads(line.decode('utf-8'))
+    if not isinstance(item, dict):
+        raise ValueError(f"unexpected spool record: {line[:80]!r}")
+    if item.get('timestamp'):
+        item['timestamp'] = datetime.fromisoformat(item['timestamp'])
+    return item
+
+
+def _terminated(line: bytes) -> bytes:
+    return line if line.endswith(b"\n") else line + b"\n"
+
+
+def _append_lines(path: Path, data: bytes):
+    """
+    Дописывает готовые строки в файл одной записью.
+
+    Если прошлая запись оборвалась на середине строки, сначала
+    дописывается перевод строки, чтобы не склеить новую запись с обрывком.
+    """
+    if not data:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab+') as target:
+        if target.tell():
+            target.seek(-1, os.SEEK_END)
+            if target.read(1) != b"\n":
+                data = b"\n" + data
+        target.write(data)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# Глобальный экземпляр писателя
+interaction_writer = InteractionWriter(
+    batch_size=config.persistence_batch_size,
+    flush_interval=config.persistence_flush_interval,
+    max_queue=config.persistence_queue_size,
+    spool_path=config.persistence_spool_path or None
+)
+
+registry.gauge("smartbot_writer_queue_depth", "Interactions waiting for a batch write", function=lambda: interaction_writer.queue_depth)
+registry.stats("smartbot_writer_total", "Interaction writer rows and batches by result", lambda: interaction_writer.stats, "result")
@@ -0,0 +1,218 @@
+"""
+Сборка промптов для LLM с бюджетом токенов контекста
+"""
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+from config import config
+
+# Грубая офлайн оценка токенизатора BPE (Llama 3 / GPT): слово латиницей -
+# примерно токен на 4 символа, кириллицей - на 3, числа режутся по 3 цифры,
+# каждый знак препинания - отдельный токен. Пробел перед словом входит
+# в его токен, перевод строки считается отдельно.
+_WORD_CLASSES = (
+    (re.compile(r"[A-Za-z]+"), 4),
+    (re.compile(r"[А-Яа-яЁё]+"), 3),
+    (re.compile(r"\d+"), 3),
+    (re.compile(r"[^\W\dA-Za-zА-Яа-яЁё_]+"), 2),
+)
+_SYMBOLS = re.compile(r"[^\w\s]|_")
+ELLIPSIS = " … "
+
+SYSTEM_HEADER = 'Ты умный и полезный помощник в групповом чате "{title}".\nТвой характер: {personality}.\n'
+SYSTEM_BODY = """
+Твоя задача:
+1. Проанализировать последние сообщения
+2. Определить тему разговора
+3. Оценить эмоциональный тон (sentiment от -1 до 1)
+4. Решить, стоит ли отвечать (should_respond: true/false)
+5. Если да - сгенерировать полезный и информативный ответ
+
+ВАЖНО: На прямые вопросы (особенно с "?" или "что ты знаешь", "расскажи") отвечай подробно и по существу.
+Для вопросов о странах, фактах, истории давай содержательные ответы.
+
+Отвечай естественно, как умный участник беседы. Будь полезным и информативным.
+Отвечай на русском языке.
+
+Верни ответ в JSON формате:
+{
+    "detected_topic": "тема разговора",
+    "sentiment": число_от_-1_до_1,
+    "should_respond": true/false,
+    "response": "твой подробный и полезный ответ или null"
+}
+"""
+SUMMARY_SECTION = "Краткое содержание обсуждения до этих сообщений:\n{}\n\n"
+USER_HEADER = "Последние сообщения в чате:\n"
+USER_FOOTER = "\nПроанализируй контекст и реши, стоит ли отвечать.\n"
+CONTEXT_LINE = "- {}\n"
+_LINE_TOKENS = 2  # Маркер "-" и перевод строки
+
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов текста без загрузки токенизатора модели"""
+    tokens = text.count("\n")
+    for pattern, chars in _WORD_CLASSES:
+        tokens += sum(-(-len(word) // chars) for word in pattern.findall(text))
+    # Прочие символы (эмодзи, CJK) - примерно токен на два байта UTF-8
+    tokens += sum(1 if symbol < "\x80" else max(1, len(symbol.encode('utf-8')) // 2) for symbol in _SYMBOLS.findall(text))
+    return tokens
+
+
+@lru_cache(maxsize=1024)
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Сокращает текст до max_tokens, оставляя начало и конец"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    budget = max(1, max_tokens - estimate_tokens(ELLIPSIS))
+    chars = len(text) * budget // tokens
+    # Оценка неравномерна по тексту: ужимаем, пока не уложимся
+    while chars > 0:
+        head = chars * 2 // 3
+        tail = chars - head
+        cut = text[:head].rstrip() + ELLIPSIS + (text[-tail:].lstrip() if tail else "")
+        if estimate_tokens(cut) <= max_tokens:
+            return cut
+        chars = chars * 4 // 5
+    return ELLIPSIS.strip()
+
+
+@dataclass
+class BuiltPrompt:
+    """Готовый промпт и его размер"""
+    system: str
+    user: str
+    prompt_tokens: int       # Оценка токенов system + user
+    messages_used: int       # Сообщений контекста вошло в промпт
+    messages_dropped: int    # Старые сообщения, не уместившиеся в бюджет
+    truncated: int           # Сообщений сокращено
+
+
+class PromptBuilder:
+    """
+    Сборщик промптов анализа контекста.
+
+    Системный промпт зависит только от названия чата и характера бота,
+    поэтому собирается один раз и кэшируется вместе с оценкой токенов.
+    Контекст набирается от новых сообщений к старым, пока укладывается
+    в бюджет токенов; слишком длинные сообщения сокращаются. Более ранняя
+    часть обсуждения передается резюме перед сообщениями.
+    """
+
+    def __init__(self, budget: int = 1500, max_message_tokens: int = 300, cache_size: int = 1024):
+        self.budget = budget
+        self.max_message_tokens = max_message_tokens
+        self.cache_size = cache_size
+        self._system: 'OrderedDict[Tuple[str, str], Tuple[str, int]]' = OrderedDict()
+        self._footer_tokens = estimate_tokens(USER_FOOTER)
+        self.stats = {
+            'prompts': 0,
+            'prompt_tokens': 0,
+            'messages_dropped': 0,
+            'messages_truncated': 0,
+            'system_cache_hits': 0,
+            'usage_reports': 0,
+            'usage_prompt_tokens': 0,       # Фактические токены по данным провайдера
+            'usage_estimated_tokens': 0,    # Наша оценка для тех же запросов
+            'usage_completion_tokens': 0,
+        }
+
+    def system_prompt(self, chat_title: str = None, personality: str = None) -> Tuple[str, int]:
+        """Системный промпт и его размер в токенах (из кэша)"""
+        key = (chat_title or "Группа", personality or config.bot_personality)
+        cached = self._system.get(key)
+        if cached is not None:
+            self._system.move_to_end(key)
+            self.stats['system_cache_hits'] += 1
+            return cached
+        text = SYSTEM_HEADER.format(title=key[0], personality=key[1]) + SYSTEM_BODY
+        cached = self._system[key] = (text, estimate_tokens(text))
+        if len(self._system) > self.cache_size:
+            self._system.popitem(last=False)
+        return cached
+
+    def build(
+        self,
+        context_messages: List[str],
+        chat_title: str = None,
+        personality: str = None,
+        summary: str = None,
+    ) -> BuiltPrompt:
+        """Собирает промпт: резюме обсуждения и самые свежие сообщения, уложившиеся в бюджет"""
+        system, system_tokens = self.system_prompt(chat_title, personality)
+        header = USER_HEADER
+        if summary:
+            header = SUMMARY_SECTION.format(truncate_to_tokens(summary, self.max_message_tokens)) + USER_HEADER
+        frame_tokens = estimate_tokens(header) + self._footer_tokens
+        available = self.budget - system_tokens - frame_tokens
+        lines: List[str] = []
+        used_tokens = truncated = 0
+
+        for message in reversed(context_messages):
+            tokens = estimate_tokens(message)
+            cut = tokens > self.max_message_tokens
+            if cut:
+                message = truncate_to_tokens(message, self.max_message_tokens)
+                tokens = estimate_tokens(message)
+            if used_tokens + tokens + _LINE_TOKENS > available:
+                if lines:
+                    break
+                # Последнее сообщение нужно всегда: сокращаем его под остаток
+                message = truncate_to_tokens(message, max(1, available - _LINE_TOKENS))
+                tokens = estimate_tokens(message)
+                cut = True
+            truncated += cut
+            lines.append(CONTEXT_LINE.format(message))
+            used_tokens += tokens + _LINE_TOKENS
+
+        user = header + "".join(reversed(lines)) + USER_FOOTER
+        dropped = len(context_messages) - len(lines)
+        prompt = BuiltPrompt(
+            system=system,
+            user=user,
+            prompt_tokens=system_tokens + frame_tokens + used_tokens,
+            messages_used=len(lines),
+            messages_dropped=dropped,
+            truncated=truncated,
+        )
+        self.stats['prompts'] += 1
+        self.stats['prompt_tokens'] += prompt.prompt_tokens
+        self.stats['messages_dropped'] += dropped
+        self.stats['messages_truncated'] += truncated
+        return prompt
+
+    def record_usage(self, estimated: int, prompt_tokens: int, completion_tokens: int = 0):
+        """Учитывает фактический расход токенов из ответа провайдера"""
+        self.stats['usage_reports'] += 1
+        self.stats['usage_prompt_tokens'] += prompt_tokens
+        self.stats['usage_estimated_tokens'] += estimated
+        self.stats['usage_completion_tokens'] += completion_tokens
+        logger.info(f"📏 Токены запроса: промпт {prompt_tokens} (оценка {estimated}), ответ {completion_tokens}")
+
+    @property
+    def estimate_ratio(self) -> float:
+        """Во сколько раз фактический размер промптов больше оценки"""
+        estimated = self.stats['usage_estimated_tokens']
+        return self.stats['usage_prompt_tokens'] / estimated if estimated else 1.0
+
+    def report(self) -> Dict[str, float]:
+        prompts = self.stats['prompts']
+        return {
+            **self.stats,
+            'avg_prompt_tokens': self.stats['prompt_tokens'] / prompts if prompts else 0.0,
+            'estimate_ratio': self.estimate_ratio,
+        }
+
+
+# Глобальный экземпляр сборщика промптов
+prompt_builder = PromptBuilder(
+    budget=config.llm_prompt_token_budget,
+    max_message_tokens=config.llm_max_message_tokens,
+)
@@ -0,0 +1,276 @@
+"""
+Ограничение частоты запросов к LLM провайдеру
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, Mapping, Optional, Tuple
+from loguru import logger
+
+
+class RateLimitedError(Exception):
+    """Ожидание свободного слота не укладывается в дедлайн"""
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель разомкнут, запросы временно не отправляются"""
+
+
+class TokenBucket:
+    """Классический token bucket на монотонных часах"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate          # Токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float = None) -> float:
+        """Сколько ждать до появления токена"""
+        now = now if now is not None else time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate if self.rate > 0 else float('inf'))
+        return wait
+
+    def consume(self, now: float = None):
+        """Забирает токен (может уйти в минус при резервировании)"""
+        now = now if now is not None else time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+
+    def scale(self, factor: float):
+        """Меняет скорость и емкость ведра в factor раз (доля процесса в общем лимите)"""
+        self.rate *= factor
+        self.capacity = max(1.0, self.capacity * factor)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        """Запрещает выдачу токенов на указанное время"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], reset_after: Optional[float]):
+        """Подстраивает ведро под лимиты, сообщенные провайдером"""
+        if limit:
+            self.capacity = max(1.0, min(self.capacity, limit))
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0 and reset_after:
+                self.pause(reset_after)
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Разбирает '1.5', '6m0s', '250ms' или epoch-время в секундах до сброса"""
+    value = value.strip()
+    try:
+        number = float(value)
+    except ValueError:
+        total, digits = 0.0, ""
+        i = 0
+        while i < len(value):
+            char = value[i]
+            if char.isdigit() or char == '.':
+                digits += char
+            elif value.startswith('ms', i):
+                total += float(digits or 0) / 1000
+                digits = ""
+                i += 1
+            elif char in 'hms':
+                total += float(digits or 0) * {'h': 3600, 'm': 60, 's': 1}[char]
+                digits = ""
+            else:
+                return None
+            i += 1
+        return total if not digits else None
+
+    # Абсолютное время сброса (OpenRouter отдает epoch в миллисекундах)
+    now = time.time()
+    if number > 1e12:
+        return max(0.0, number / 1000 - now)
+    if number > 1e9:
+        return max(0.0, number - now)
+    return number
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Извлекает паузу из заголовка Retry-After (секунды или HTTP-дата)"""
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def parse_rate_limit_headers(headers: Mapping[str, str]) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+    """Возвращает (limit, remaining, reset_after) из x-ratelimit-* заголовков"""
+    if not headers:
+        return None, None, None
+
+    def first(*names):
+        for name in names:
+            if headers.get(name) is not None:
+                return headers.get(name)
+        return None
+
+    limit = first('x-ratelimit-limit-requests', 'x-ratelimit-limit')
+    remaining = first('x-ratelimit-remaining-requests', 'x-ratelimit-remaining')
+    reset = first('x-ratelimit-reset-requests', 'x-ratelimit-reset')
+
+    def number(value):
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    return number(limit), number(remaining), _parse_duration(reset) if reset else None
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Экспоненциальная задержка с полным джиттером"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после `failure_threshold` ошибок подряд перестает
+    пропускать запросы на `cooldown` секунд, затем пропускает один пробный.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = self.CLOSED
+        self.stats = {'opened': 0, 'rejected': 0}
+
+    @property
+    def available(self) -> bool:
+        """Пропустит ли предохранитель запрос сейчас (без смены состояния)"""
+        return self.state != self.OPEN or time.monotonic() - self.opened_at >= self.cooldown
+
+    def before_call(self):
+        """Проверяет, можно ли отправлять запрос"""
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            self.stats['rejected'] += 1
+            raise CircuitOpenError(f"Circuit {self.state}, cooling down for {self.cooldown}s")
+        # Пропускаем один пробный запрос, следующий - не раньше чем через cooldown
+        self.state = self.HALF_OPEN
+        self.opened_at = now
+
+    def record_success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_cancelled(self):
+        """
+        Вызов отменен (дедлайн пула, проигравший hedged запрос).
+
+        О провайдере это ничего не говорит, поэтому счетчик ошибок не
+        растет; но пробный запрос не может остаться без исхода и считается
+        неудачным.
+        """
+        if self.state == self.HALF_OPEN:
+            self.record_failure()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats['opened'] += 1
+                logger.warning(f"🔌 Предохранитель LLM разомкнут на {self.cooldown:.0f}с")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class RateLimiter:
+    """Набор token bucket'ов по ключам (API ключ, модель)"""
+
+    def __init__(self, default_rpm: float = 20, rpm_overrides: Dict[str, float] = None):
+        self.default_rpm = default_rpm
+        self.rpm_overrides = rpm_overrides or {}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.stats = {'acquired': 0, 'waited': 0, 'rejected': 0, 'throttled': 0}
+
+    def scale(self, factor: float):
+        """Меняет все лимиты в factor раз, включая уже созданные ведра"""
+        self.default_rpm *= factor
+        self.rpm_overrides = {key: rpm * factor for key, rpm in self.rpm_overrides.items()}
+        for bucket in self.buckets.values():
+            bucket.scale(factor)
+
+    def bucket(self, key: str) -> TokenBucket:
+        if key not in self.buckets:
+            rpm = self.rpm_overrides.get(key, self.default_rpm)
+            self.buckets[key] = TokenBucket(rate=rpm / 60.0, capacity=max(1.0, rpm / 60))
+        return self.buckets[key]
+
+    async def acquire(self, keys: Iterable[str], deadline: float = None):
+        """
+        Ждет токен во всех ведрах сразу.
+
+        Raises:
+            RateLimitedError: Токен не появится до дедлайна
+        """
+        buckets = [self.bucket(key) for key in keys]
+        waited = False
+        while True:
+            now = time.monotonic()
+            wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.consume(now)
+                self.stats['acquired'] += 1
+                if waited:
+                    self.stats['waited'] += 1
+                return
+            if deadline is not None and now + wait >= deadline:
+                self.stats['rejected'] += 1
+                raise RateLimitedError(f"Rate limit slot in {wait:.1f}s is past the deadline")
+            waited = True
+            await asyncio.sleep(wait)
+
+    def observe(self, keys: Iterable[str], headers: Mapping[str, str]):
+        """Учитывает лимиты из заголовков успешного ответа"""
+        limit, remaining, reset_after = parse_rate_limit_headers(headers)
+        if limit is None and remaining is None:
+            return
+        for key in keys:
+            self.bucket(key).sync(limit, remaining, reset_after)
+
+    def throttle(self, keys: Iterable[str], retry_after: float):
+        """Ставит ведра на паузу после 429"""
+        self.stats['throttled'] += 1
+        for key in keys:
+            bucket = self.bucket(key)
+            bucket.pause(retry_after)
+            bucket.tokens = min(bucket.tokens, 0.0)
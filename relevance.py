@@ -0,0 +1,353 @@
+"""
+Локальный фильтр уместности ответа перед обращением к LLM
+"""
+import json
+import math
+import random
+import struct
+import zlib
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from config import config
+from intents import normalize
+from models import ChatInteraction, InteractionMessage, db_manager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Формат файла модели: MAGIC, длина JSON заголовка, заголовок (bits, topics),
+# затем веса float32 построчно: (2**bits + 1) строк по (2 + число тем) столбцов.
+# Последняя строка - смещение (bias). Столбцы: логит "стоит ответить",
+# тональность, логиты тем.
+MAGIC = b"SGBR"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sHI")
+CONTEXT_DEPTH = 3  # Сколько предыдущих сообщений дают признаки контекста
+
+
+def feature_tokens(context_messages: Sequence[str]) -> List[str]:
+    """
+    Строковые признаки контекста
+
+    Слова и биграммы последнего сообщения, его знаки и длина, а также
+    слова нескольких предыдущих сообщений с отдельным префиксом.
+    """
+    if not context_messages:
+        return []
+    last = context_messages[-1]
+    words = normalize(last).split()
+    tokens = ['w:' + word for word in words]
+    tokens.extend('b:' + first + ' ' + second for first, second in zip(words, words[1:]))
+    tokens.append('n:%d' % min(len(words), 30).bit_length())
+    tokens.extend('m:' + mark for mark in '?!@' if mark in last)
+    for message in context_messages[-CONTEXT_DEPTH - 1:-1]:
+        tokens.extend('c:' + word for word in normalize(message).split())
+    return tokens
+
+
+def hash_tokens(tokens: Sequence[str], bits: int) -> List[int]:
+    """Номера признаков (crc32 одинаков во всех процессах, в отличие от hash())"""
+    mask = (1 << bits) - 1
+    return [zlib.crc32(token.encode('utf-8')) & mask for token in tokens]
+
+
+def context_features(context_messages: Sequence[str], bits: int) -> List[int]:
+    """Номера признаков контекста, последним - смещение (строка 2**bits)"""
+    features = hash_tokens(feature_tokens(context_messages), bits)
+    features.append(1 << bits)
+    return features
+
+
+def _sigmoid(value: float) -> float:
+    if value >= 0:
+        return 1.0 / (1.0 + math.exp(-value))
+    exp = math.exp(value)
+    return exp / (1.0 + exp)
+
+
+@dataclass(frozen=True)
+class RelevanceVerdict:
+    """Оценка контекста локальной моделью"""
+    score: float  # Вероятность того, что LLM решит ответить
+    topic: Optional[str]
+    sentiment: float
+
+
+@dataclass
+class Sample:
+    """Размеченный контекст из chat_interactions"""
+    features: List[int]
+    responded: bool
+    topic: Optional[str]
+    sentiment: Optional[float]
+
+
+class RelevanceModel:
+    """
+    Линейная модель над хешированными признаками контекста.
+
+    Три головы на общих признаках: логистическая регрессия "стоит ли
+    отвечать" (метка - response_generated), линейная регрессия
+    тональности и softmax по частым темам. Оценка одного контекста -
+    сумма строк весов его признаков; NumPy ускоряет ее и обязателен
+    только для обучения.
+    """
+
+    def __init__(self, bits: int = 18, topics: Sequence[str] = (), weights=None):
+        self.bits = bits
+        self.dim = 1 << bits
+        self.topics = list(topics)
+        self.outputs = 2 + len(self.topics)
+        if weights is None:
+            if numpy is None:
+                raise RuntimeError("numpy is required to train the relevance model")
+            weights = numpy.zeros((self.dim + 1, self.outputs), dtype=numpy.float32)
+        self.weights = weights
+
+    def _raw(self, features: List[int]) -> List[float]:
+        if numpy is not None:
+            return self.weights[features].sum(axis=0, dtype=numpy.float64).tolist()
+        outputs, weights = self.outputs, self.weights
+        row = [0.0] * outputs
+        for feature in features:
+            base = feature * outputs
+            for column in range(outputs):
+                row[column] += weights[base + column]
+        return row
+
+    def predict(self, context_messages: Sequence[str]) -> RelevanceVerdict:
+        """Оценка контекста (микросекунды, без сети)"""
+        row = self._raw(context_features(context_messages, self.bits))
+        topic = None
+        if self.topics:
+            topic_logits = row[2:]
+            topic = self.topics[topic_logits.index(max(topic_logits))]
+        return RelevanceVerdict(_sigmoid(row[0]), topic, max(-1.0, min(1.0, row[1])))
+
+    def fit(
+        self,
+        samples: Sequence[Sample],
+        epochs: int = 5,
+        learning_rate: float = 0.1,
+        l2: float = 1e-6,
+        batch_size: int = 256,
+        seed: int = 1,
+    ) -> List[float]:
+        """
+        Обучение мини-пакетами с AdaGrad по строкам весов
+
+        Градиенты считаются для всего пакета сразу и применяются только
+        к встретившимся признакам. Возвращает среднюю logloss по эпохам.
+        """
+        if numpy is None:
+            raise RuntimeError("numpy is required to train the relevance model")
+        topic_index = {topic: index for index, topic in enumerate(self.topics)}
+        lengths = numpy.array([len(sample.features) for sample in samples], dtype=numpy.int64)
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        columns = numpy.fromiter(
+            (feature for sample in samples for feature in sample.features), dtype=numpy.int64, count=int(offsets[-1])
+        )
+        responded = numpy.array([sample.responded for sample in samples], dtype=numpy.float64)
+        sentiment = numpy.array(
+            [math.nan if sample.sentiment is None else sample.sentiment for sample in samples], dtype=numpy.float64
+        )
+        topics = numpy.array([topic_index.get(sample.topic, -1) for sample in samples], dtype=numpy.int64)
+        accumulated = numpy.full(self.weights.shape, 1e-8, dtype=numpy.float32)
+        order = numpy.arange(len(samples))
+        rng = numpy.random.default_rng(seed)
+        history = []
+
+        for _ in range(epochs):
+            rng.shuffle(order)
+            losses = []
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                rows = numpy.repeat(numpy.arange(len(batch)), lengths[batch])
+                cols = numpy.concatenate([columns[offsets[i]:offsets[i + 1]] for i in batch])
+                logits = numpy.zeros((len(batch), self.outputs))
+                numpy.add.at(logits, rows, self.weights[cols])
+
+                gradient = numpy.zeros_like(logits)
+                probability = 1.0 / (1.0 + numpy.exp(-numpy.clip(logits[:, 0], -30, 30)))
+                target = responded[batch]
+                gradient[:, 0] = probability - target
+                losses.append(-numpy.mean(
+                    target * numpy.log(probability + 1e-12) + (1 - target) * numpy.log(1 - probability + 1e-12)
+                ))
+                known = ~numpy.isnan(sentiment[batch])
+                gradient[known, 1] = logits[known, 1] - sentiment[batch][known]
+                labelled = topics[batch] >= 0
+                if self.topics and labelled.any():
+                    topic_logits = logits[labelled, 2:]
+                    topic_logits = numpy.exp(topic_logits - topic_logits.max(axis=1, keepdims=True))
+                    topic_logits /= topic_logits.sum(axis=1, keepdims=True)
+                    topic_logits[numpy.arange(len(topic_logits)), topics[batch][labelled]] -= 1.0
+                    gradient[labelled, 2:] = topic_logits
+                gradient /= len(batch)
+
+                unique, inverse = numpy.unique(cols, return_inverse=True)
+                update = numpy.zeros((len(unique), self.outputs))
+                numpy.add.at(update, inverse, gradient[rows])
+                update += l2 * self.weights[unique]
+                accumulated[unique] += update ** 2
+                self.weights[unique] -= (learning_rate * update / numpy.sqrt(accumulated[unique])).astype(numpy.float32)
+            history.append(float(numpy.mean(losses)) if losses else 0.0)
+        return history
+
+    def save(self, path: str):
+        """Сохраняет модель (см. формат в начале модуля)"""
+        header = json.dumps({'bits': self.bits, 'topics': self.topics}, ensure_ascii=False).encode('utf-8')
+        location = Path(path)
+        location.parent.mkdir(parents=True, exist_ok=True)
+        temporary = location.with_suffix(location.suffix + '.tmp')
+        with open(temporary, 'wb') as target:
+            target.write(FILE_HEADER.pack(MAGIC, VERSION, len(header)))
+            target.write(header)
+            target.write(numpy.ascontiguousarray(self.weights, dtype='<f4').tobytes())
+        temporary.replace(location)
+
+    @classmethod
+    def load(cls, path: str) -> 'RelevanceModel':
+        """Загружает модель; без NumPy веса хранятся в array('f')"""
+        data = Path(path).read_bytes()
+        magic, version, header_size = FILE_HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: не файл модели уместности")
+        offset = FILE_HEADER.size
+        header = json.loads(data[offset:offset + header_size].decode('utf-8'))
+        body = memoryview(data)[offset + header_size:]
+        outputs = 2 + len(header['topics'])
+        if len(body) != ((1 << header['bits']) + 1) * outputs * 4:
+            raise ValueError(f"{path}: размер весов не совпадает с заголовком")
+        if numpy is not None:
+            weights = numpy.frombuffer(body, dtype='<f4').reshape(-1, outputs)
+        else:
+            weights = array('f')
+            weights.frombytes(body)
+        return cls(header['bits'], header['topics'], weights)
+
+
+class RelevanceGate:
+    """
+    Решает, отправлять ли контекст в LLM.
+
+    Контексты с оценкой ниже порога отсекаются. Небольшая доля таких
+    контекстов (explore) все равно уходит в LLM: иначе история перестанет
+    пополняться примерами, на которых модель ошибается.
+    """
+
+    def __init__(self, model: RelevanceModel, threshold: float, explore: float = 0.0):
+        self.model = model
+        self.threshold = threshold
+        self.explore = explore
+        self.stats = {'scored': 0, 'skipped': 0, 'explored': 0}
+
+    def should_escalate(self, context_messages: Sequence[str]) -> bool:
+        verdict = self.model.predict(context_messages)
+        self.stats['scored'] += 1
+        if verdict.score >= self.threshold:
+            return True
+        if self.explore and random.random() < self.explore:
+            self.stats['explored'] += 1
+            return True
+        self.stats['skipped'] += 1
+        logger.debug(
+            f"🪶 Оценка уместности {verdict.score:.2f} < {self.threshold:.2f} "
+            f"(тема ~{verdict.topic}, тональность ~{verdict.sentiment:+.1f})"
+        )
+        return False
+
+
+async def iter_samples(
+    bits: int, chunk_size: int = 1000, limit: Optional[int] = None
+) -> AsyncIterator[Sample]:
+    """Размеченные контексты из chat_interactions по возрастанию id (keyset, пачками)"""
+    await db_manager.init_models()
+    last_id, produced = 0, 0
+    while limit is None or produced < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - produced)
+        async with db_manager.get_session() as session:
+            result = await session.execute(
+                select(ChatInteraction)
+                .where(ChatInteraction.id > last_id)
+                .order_by(ChatInteraction.id)
+                .limit(size)
+                .options(selectinload(ChatInteraction.context_links).selectinload(InteractionMessage.message))
+            )
+            rows = list(result.scalars())
+        if not rows:
+            break
+        for row in rows:
+            context = row.context_messages
+            if context:
+                yield Sample(
+                    context_features(context, bits), bool(row.response_generated),
+                    row.detected_topic or None, row.sentiment
+                )
+        produced += len(rows)
+        last_id = rows[-1].id
+
+
+def evaluate(model: RelevanceModel, samples: Sequence[Sample], recall_target: float = 0.95) -> Dict[str, Any]:
+    """
+    Качество фильтра на отложенной выборке
+
+    Кроме logloss и ROC AUC - порог, при котором сохраняется доля
+    `recall_target` ответов LLM, и доля вызовов LLM, которую он экономит.
+    """
+    scores = [_sigmoid(model._raw(sample.features)[0]) for sample in samples]
+    labels = [sample.responded for sample in samples]
+    positives = sum(labels)
+    report: Dict[str, Any] = {'samples': len(samples), 'positive_share': positives / len(samples) if samples else 0.0}
+    if not samples:
+        return report
+    report['logloss'] = -sum(
+        math.log(max(score if label else 1 - score, 1e-12)) for score, label in zip(scores, labels)
+    ) / len(samples)
+    ranked = sorted(zip(scores, labels), reverse=True)
+    negatives = len(samples) - positives
+    if positives and negatives:
+        # AUC как доля правильно упорядоченных пар (по рангам)
+        rank_sum, rank = 0.0, 0
+        for score, label in sorted(zip(scores, labels)):
+            rank += 1
+            if label:
+                rank_sum += rank
+        report['auc'] = (rank_sum - positives * (positives + 1) / 2) / (positives * negatives)
+    if positives:
+        needed = math.ceil(positives * recall_target)
+        kept = hits = 0
+        for score, label in ranked:
+            kept += 1
+            hits += label
+            if hits >= needed:
+                break
+        report['threshold'] = score
+        report['recall'] = hits / positives
+        report['llm_calls_saved'] = 1 - kept / len(samples)
+    return report
+
+
+def create_relevance_gate() -> Optional[RelevanceGate]:
+    """Фильтр по настройкам (None - модель не задана или не загрузилась)"""
+    if not config.relevance_model_path:
+        return None
+    try:
+        model = RelevanceModel.load(config.relevance_model_path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Модель уместности не загружена, все контексты идут в LLM: {e}")
+        return None
+    logger.info(
+        f"🪶 Модель уместности: 2^{model.bits} признаков, тем {len(model.topics)}, "
+        f"порог {config.relevance_threshold}"
+    )
+    return RelevanceGate(model, config.relevance_threshold, config.relevance_explore)
@@ -0,0 +1,230 @@
+"""
+Кэш ответов AI для повторяющихся вопросов
+"""
+import hashlib
+import re
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_PUNCTUATION = re.compile(r'[^\w\s?]+')
+_SPACES = re.compile(r'\s+')
+# Слова, которые переворачивают смысл вопроса: тексты с разными отрицаниями не почти-дубликаты
+_NEGATIONS = frozenset({'не', 'нет', 'ни', 'not', 'no'})
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к каноническому виду для сравнения"""
+    text = (text or "").lower().replace('ё', 'е')
+    text = _PUNCTUATION.sub(' ', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+def _token_hash(token: str) -> int:
+    """Стабильный 32-битный хэш токена"""
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), 'little')
+
+
+class MinHasher:
+    """MinHash сигнатуры для оценки сходства Жаккара"""
+
+    def __init__(self, num_perm: int = 32, seed: int = 1):
+        state = seed
+        self.permutations = []
+        for _ in range(num_perm):
+            # Детерминированный LCG, чтобы сигнатуры не зависели от запуска
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            a = (state >> 3) % _MERSENNE_PRIME or 1
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            b = (state >> 3) % _MERSENNE_PRIME
+            self.permutations.append((a, b))
+
+    def signature(self, tokens: Set[str]) -> Tuple[int, ...]:
+        hashes = [_token_hash(token) for token in tokens]
+        if not hashes:
+            return tuple(_MAX_HASH for _ in self.permutations)
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self.permutations
+        )
+
+    @staticmethod
+    def similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+        return sum(1 for x, y in zip(left, right) if x == y) / max(len(left), 1)
+
+
+@dataclass
+class _CacheEntry:
+    value: Dict[str, Any]
+    expires_at: float
+    scope: str
+    signature: Tuple[int, ...]
+    bands: List[Tuple[int, Tuple[int, ...]]]
+    negations: FrozenSet[str]
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов: точное совпадение нормализованного
+    контекста и поиск почти-дубликатов через MinHash + LSH.
+
+    Работает полностью локально; записи живут `ttl` секунд и вытесняются
+    по LRU при превышении `max_entries`.
+    """
+
+    def __init__(
+        self,
+        tokenize: Callable[[str], List[str]],
+        max_entries: int = 5000,
+        ttl: float = 3600,
+        scope: str = "chat",
+        similarity: float = 0.8,
+        context_size: int = 1,
+        num_perm: int = 32,
+        bands: int = 8,
+        stem_length: int = 6,
+        min_tokens: int = 2,
+    ):
+        self.tokenize = tokenize
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.scope = scope
+        self.similarity = similarity
+        self.context_size = context_size
+        self.stem_length = stem_length
+        self.min_tokens = min_tokens
+        self.hasher = MinHasher(num_perm)
+        self.band_count = bands
+        self.rows_per_band = max(1, num_perm // bands)
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._bands: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = defaultdict(set)
+        self.stats = {
+            'hits_exact': 0,
+            'hits_near': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expired': 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _scope_for(self, chat_id: Optional[str]) -> str:
+        return f"chat:{chat_id}" if self.scope == "chat" and chat_id else "global"
+
+    def _features(self, context_messages: List[str]) -> Tuple[str, Optional[Tuple[int, ...]], FrozenSet[str]]:
+        tail = [normalize_text(message) for message in context_messages[-self.context_size:]]
+        text = "\n".join(tail)
+        if len(set(self.tokenize(text))) < self.min_tokens:
+            # Короткие реплики ("ок", "да") слишком неоднозначны для кэша
+            return text, None, frozenset()
+        # Сигнатура по всем словам, включая короткие ("ли", "не"); префикс слова -
+        # грубый стемминг, сводит словоформы к одной
+        words = [word for word in (token.strip('?') for token in text.split()) if word]
+        tokens = {word[:self.stem_length] for word in words}
+        return text, self.hasher.signature(tokens), frozenset(_NEGATIONS.intersection(words))
+
+    def _key(self, scope: str, text: str) -> str:
+        return hashlib.sha1(f"{scope}\x00{text}".encode()).hexdigest()
+
+    def _band_keys(self, scope: str, signature: Tuple[int, ...]):
+        rows = self.rows_per_band
+        return [
+            (hash(scope) ^ band, signature[band * rows:(band + 1) * rows])
+            for band in range(self.band_count)
+        ]
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band_key in entry.bands:
+            bucket = self._bands.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._bands[band_key]
+
+    def get(self, context_messages: List[str], chat_id: str = None) -> Optional[Dict[str, Any]]:
+        """Ищет ответ для контекста, сначала точно, затем по сходству"""
+        if not context_messages:
+            return None
+        now = time.monotonic()
+        scope = self._scope_for(chat_id)
+        text, signature, negations = self._features(context_messages)
+        if signature is None:
+            self.stats['misses'] += 1
+            return None
+
+        key = self._key(scope, text)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self.stats['hits_exact'] += 1
+                return dict(entry.value)
+            self._remove(key)
+            self.stats['expired'] += 1
+
+        best_key, best_score = None, 0.0
+        candidates = set()
+        for band_key in self._band_keys(scope, signature):
+            candidates.update(self._bands.get(band_key, ()))
+        for candidate in candidates:
+            entry = self._entries.get(candidate)
+            if entry is None or entry.scope != scope or entry.negations != negations:
+                continue
+            if entry.expires_at <= now:
+                self._remove(candidate)
+                self.stats['expired'] += 1
+                continue
+            score = MinHasher.similarity(signature, entry.signature)
+            if score > best_score:
+                best_key, best_score = candidate, score
+
+        if best_key is not None and best_score >= self.similarity:
+            self._entries.move_to_end(best_key)
+            self.stats['hits_near'] += 1
+            return dict(self._entries[best_key].value)
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, context_messages: List[str], value: Dict[str, Any], chat_id: str = None):
+        """Сохраняет ответ для контекста"""
+        if not context_messages:
+            return
+        scope = self._scope_for(chat_id)
+        text, signature, negations = self._features(context_messages)
+        if signature is None:
+            return
+        key = self._key(scope, text)
+        self._remove(key)
+
+        bands = self._band_keys(scope, signature)
+        self._entries[key] = _CacheEntry(
+            value=dict(value),
+            expires_at=time.monotonic() + self.ttl,
+            scope=scope,
+            signature=signature,
+            bands=bands,
+            negations=negations,
+        )
+        for band_key in bands:
+            self._bands[band_key].add(key)
+        self.stats['stores'] += 1
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats['evictions'] += 1
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats['hits_exact'] + self.stats['hits_near']
+        return hits / max(hits + self.stats['misses'], 1)
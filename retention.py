@@ -0,0 +1,324 @@
+"""
+Хранение истории: архивация и удаление старых взаимодействий
+"""
+import asyncio
+import gzip
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+from sqlalchemy import delete, exists, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from config import config
+from models import (
+    ChatInteraction, ChatStats, ChatStatsHourly, InteractionMessage, StoredMessage, db_manager, to_chat_id
+)
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    """Сколько истории хранить; None - без ограничения"""
+    max_age_days: Optional[int] = None
+    max_rows: Optional[int] = None
+
+    @classmethod
+    def from_values(cls, max_age_days: int = 0, max_rows: int = 0) -> 'RetentionPolicy':
+        return cls(max_age_days=max_age_days or None, max_rows=max_rows or None)
+
+    @property
+    def unlimited(self) -> bool:
+        return self.max_age_days is None and self.max_rows is None
+
+
+class RetentionJob:
+    """
+    Инкрементальная чистка истории по политикам хранения.
+
+    Старые взаимодействия выгружаются в архив (Parquet или JSONL.gz,
+    по файлу на пачку внутри партиции чат/месяц) и удаляются небольшими
+    транзакциями, чтобы не задерживать фоновую запись. Накопительная
+    статистика в chat_stats при этом не меняется, а почасовые счетчики
+    старше `hourly_days` сворачиваются в дневные.
+    """
+
+    def __init__(
+        self,
+        default_policy: RetentionPolicy,
+        overrides: Dict[str, RetentionPolicy] = None,
+        archive_dir: Optional[str] = None,
+        archive_format: str = "auto",
+        batch_size: int = 500,
+        batch_pause: float = 0.05,
+        hourly_days: int = 30,
+    ):
+        self.default_policy = default_policy
+        self.overrides = {to_chat_id(chat_id): policy for chat_id, policy in (overrides or {}).items()}
+        self.archive_dir = Path(archive_dir) if archive_dir else None
+        if archive_format == "parquet" and parquet is None:
+            raise RuntimeError("pyarrow is required for parquet retention archives")
+        self.use_parquet = archive_format == "parquet" or (archive_format == "auto" and parquet is not None)
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.hourly_days = hourly_days
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            'runs': 0,
+            'archived': 0,
+            'deleted': 0,
+            'messages_deleted': 0,
+            'buckets_compacted': 0,
+            'errors': 0,
+        }
+
+    def policy_for(self, chat_id: int) -> RetentionPolicy:
+        return self.overrides.get(chat_id, self.default_policy)
+
+    async def _cutoff(self, chat_id: int, policy: RetentionPolicy, now: datetime) -> Optional[datetime]:
+        """Момент, раньше которого взаимодействия чата удаляются"""
+        cutoffs = []
+        if policy.max_age_days is not None:
+            cutoffs.append(now - timedelta(days=policy.max_age_days))
+        if policy.max_rows is not None:
+            async with db_manager.get_session() as session:
+                # Время самой старой из max_rows последних записей (индекс chat_id, timestamp)
+                oldest_kept = await session.scalar(
+                    select(ChatInteraction.timestamp)
+                    .where(ChatInteraction.chat_id == chat_id)
+                    .order_by(ChatInteraction.timestamp.desc())
+                    .offset(policy.max_rows - 1)
+                    .limit(1)
+                )
+            if oldest_kept is not None:
+                cutoffs.append(oldest_kept)
+        return max(cutoffs) if cutoffs else None
+
+    async def count_expired(self, chat_id: int, now: datetime = None) -> int:
+        """Сколько взаимодействий чата попадает под удаление"""
+        cutoff = await self._cutoff(chat_id, self.policy_for(chat_id), now or datetime.utcnow())
+        if cutoff is None:
+            return 0
+        async with db_manager.get_session() as session:
+            return await session.scalar(
+                select(func.count()).select_from(ChatInteraction)
+                .where(ChatInteraction.chat_id == chat_id, ChatInteraction.timestamp < cutoff)
+            )
+
+    async def prune_chat(self, chat_id: int, now: datetime = None) -> int:
+        """Архивирует и удаляет устаревшие взаимодействия одного чата"""
+        policy = self.policy_for(chat_id)
+        if policy.unlimited:
+            return 0
+        cutoff = await self._cutoff(chat_id, policy, now or datetime.utcnow())
+        if cutoff is None:
+            return 0
+
+        deleted = 0
+        while not self._stopping.is_set():
+            async with db_manager.get_session() as session:
+                query = (
+                    select(ChatInteraction)
+                    .where(ChatInteraction.chat_id == chat_id, ChatInteraction.timestamp < cutoff)
+                    .order_by(ChatInteraction.timestamp)
+                    .limit(self.batch_size)
+                )
+                if self.archive_dir:
+                    query = query.options(
+                        selectinload(ChatInteraction.context_links).selectinload(InteractionMessage.message)
+                    )
+                batch = list((await session.execute(query)).scalars())
+                if not batch:
+                    break
+                if self.archive_dir:
+                    records = [interaction.to_dict(include_context=True) for interaction in batch]
+                    # Файл пишется до удаления: при сбое пачка будет выгружена повторно в тот же файл
+                    await asyncio.to_thread(self._write_archive, chat_id, records)
+                    self.stats['archived'] += len(records)
+
+                ids = [interaction.id for interaction in batch]
+                await session.execute(delete(InteractionMessage).where(InteractionMessage.interaction_id.in_(ids)))
+                await session.execute(delete(ChatInteraction).where(ChatInteraction.id.in_(ids)))
+                await session.commit()
+            deleted += len(ids)
+            self.stats['deleted'] += len(ids)
+            # Отдаем БД фоновому писателю между транзакциями
+            await asyncio.sleep(self.batch_pause)
+
+        if deleted:
+            logger.info(f"🧹 Чат {chat_id}: удалено {deleted} взаимодействий старше {cutoff:%Y-%m-%d %H:%M}")
+        return deleted
+
+    def _write_archive(self, chat_id: int, records: List[Dict[str, Any]]):
+        """Пишет пачку в архив: <dir>/chat_<id>/<YYYY-MM>/<first_id>-<last_id>.<ext>"""
+        partitions: Dict[str, List[Dict[str, Any]]] = {}
+        for record in records:
+            partitions.setdefault(record['timestamp'][:7], []).append(record)
+
+        for month, rows in partitions.items():
+            directory = self.archive_dir / f"chat_{chat_id}" / month
+            directory.mkdir(parents=True, exist_ok=True)
+            stem = f"{rows[0]['id']}-{rows[-1]['id']}"
+            if self.use_parquet:
+                table = pyarrow.Table.from_pylist(rows)
+                parquet.write_table(table, directory / f"{stem}.parquet", compression="zstd")
+            else:
+                with gzip.open(directory / f"{stem}.jsonl.gz", "wt", encoding="utf-8") as archive:
+                    for row in rows:
+                        archive.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    async def collect_orphan_messages(self) -> int:
+        """Удаляет тексты, на которые больше не ссылается ни одно взаимодействие"""
+        removed = 0
+        while not self._stopping.is_set():
+            async with db_manager.get_session() as session:
+                orphan_ids = list((await session.execute(
+                    select(StoredMessage.id)
+                    .where(~exists().where(InteractionMessage.message_id == StoredMessage.id))
+                    .limit(self.batch_size)
+                )).scalars())
+                if not orphan_ids:
+                    break
+                try:
+                    # Проверка повторяется в самом DELETE: писатель мог сослаться на текст после выборки
+                    result = await session.execute(
+                        delete(StoredMessage).where(
+                            StoredMessage.id.in_(orphan_ids),
+                            ~exists().where(InteractionMessage.message_id == StoredMessage.id)
+                        )
+                    )
+                    await session.commit()
+                except IntegrityError as e:
+                    # PostgreSQL: ссылку добавили параллельно, текст соберем при следующем проходе
+                    await session.rollback()
+                    logger.warning(f"⚠️ Сборка неиспользуемых текстов прервана: {e}")
+                    break
+            removed += result.rowcount
+            self.stats['messages_deleted'] += result.rowcount
+            await asyncio.sleep(self.batch_pause)
+        return removed
+
+    async def compact_hourly(self, chat_id: int, now: datetime = None) -> int:
+        """Сворачивает почасовые счетчики старше hourly_days в дневные"""
+        if not self.hourly_days:
+            return 0
+        cutoff = (now or datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff -= timedelta(days=self.hourly_days)
+        async with db_manager.get_session() as session:
+            buckets = list((await session.execute(
+                select(ChatStatsHourly)
+                .where(ChatStatsHourly.chat_id == chat_id, ChatStatsHourly.hour < cutoff)
+            )).scalars())
+            days: Dict[datetime, List[ChatStatsHourly]] = {}
+            for bucket in buckets:
+                days.setdefault(bucket.hour.replace(hour=0), []).append(bucket)
+
+            compacted = 0
+            for day, items in days.items():
+                if len(items) == 1 and items[0].hour == day:
+                    continue  # Уже дневной
+                for item in items:
+                    await session.delete(item)
+                await session.flush()
+                await session.execute(insert(ChatStatsHourly), [{
+                    'chat_id': chat_id,
+                    'hour': day,
+                    'interactions': sum(item.interactions for item in items),
+                    'responses': sum(item.responses for item in items),
+                    'sentiment_sum': sum(item.sentiment_sum for item in items),
+                    'sentiment_count': sum(item.sentiment_count for item in items),
+                }])
+                compacted += len(items)
+            await session.commit()
+        self.stats['buckets_compacted'] += compacted
+        return compacted
+
+    async def run_once(self, chat_ids: List[str] = None) -> Dict[str, int]:
+        """Один проход по всем (или указанным) чатам"""
+        await db_manager.init_models()
+        now = datetime.utcnow()
+        if chat_ids is None:
+            async with db_manager.get_session() as session:
+                targets = list((await session.execute(select(ChatStats.chat_id))).scalars())
+        else:
+            targets = [to_chat_id(chat_id) for chat_id in chat_ids]
+
+        before = dict(self.stats)
+        for chat_id in targets:
+            if self._stopping.is_set():
+                break
+            try:
+                await self.prune_chat(chat_id, now)
+                await self.compact_hourly(chat_id, now)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"❌ Ошибка очистки истории чата {chat_id}: {e}")
+        await self.collect_orphan_messages()
+        self.stats['runs'] += 1
+        return {key: self.stats[key] - before[key] for key in self.stats}
+
+    async def _run_forever(self, interval: float):
+        while not self._stopping.is_set():
+            try:
+                result = await self.run_once()
+                logger.info(
+                    f"🧹 Очистка истории: удалено {result['deleted']}, в архиве {result['archived']}, "
+                    f"текстов удалено {result['messages_deleted']}"
+                )
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"❌ Ошибка очистки истории: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, interval: float):
+        """Запускает периодическую очистку в текущем event loop"""
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run_forever(interval))
+            logger.info(f"🧹 Очистка истории запущена (раз в {interval:.0f}с)")
+
+    async def stop(self):
+        """Останавливает очистку после текущей транзакции"""
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+
+def create_retention_job(**overrides) -> RetentionJob:
+    """Создает задачу очистки из настроек; поля чатов без явного значения берутся из глобальной политики"""
+    max_age_days = overrides.pop('max_age_days', config.retention_max_age_days)
+    max_rows = overrides.pop('max_rows', config.retention_max_rows_per_chat)
+    options = dict(
+        default_policy=RetentionPolicy.from_values(max_age_days, max_rows),
+        overrides={
+            chat_id: RetentionPolicy.from_values(
+                values.get('max_age_days', max_age_days), values.get('max_rows', max_rows)
+            )
+            for chat_id, values in config.retention_chat_overrides.items()
+        },
+        archive_dir=config.retention_archive_dir or None,
+        archive_format=config.retention_archive_format,
+        batch_size=config.retention_batch_size,
+        hourly_days=config.retention_hourly_days,
+    )
+    options.update(overrides)
+    return RetentionJob(**options)
+
+
+# Глобальный экземпляр задачи очистки
+retention_job = create_retention_job()
@@ -2,6 +2,7 @@
 """
 Скрипт для запуска SmartGroupBot с полным функционалом
 """
+import argparse
 import asyncio
 import sys
 import os
@@ -71,6 +72,13 @@ async def run_bot_async():
 
 def main():
     """Главная функция для запуска"""
+    parser = argparse.ArgumentParser(description="Запуск SmartGroupBot")
+    parser.add_argument(
+        "--shards", type=int, nargs="?", const=0, default=None, metavar="N",
+        help="Многопроцессный режим: N обработчиков (без числа - SHARD_WORKERS или по числу ядер)"
+    )
+    args = parser.parse_args()
+    
     try:
         # Проверяем окружение
         if not check_environment():
@@ -82,7 +90,11 @@ def main():
         logger.info("=" * 50)
         
         # Запускаем бота
-        asyncio.run(run_bot_async())
+        if args.shards is not None:
+            from sharding import run_supervisor
+            run_supervisor(args.shards)
+        else:
+            asyncio.run(run_bot_async())
         
     except KeyboardInterrupt:
         logger.info("\n🛑 Остановка по Ctrl+C")
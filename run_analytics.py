@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Пакетная аналитика истории SmartGroupBot: тональность, темы, ключевые слова чатов
+
+Заполняет пустые detected_topic и sentiment в chat_interactions (накопительная
+статистика сдвигается на разницу) и пересчитывает таблицу chat_keywords.
+
+    python run_analytics.py                  # заполнить пропуски
+    python run_analytics.py --dry-run        # только посчитать
+    python run_analytics.py --overwrite      # пересчитать все строки
+    python run_analytics.py --rebuild-stats  # еще и пересчитать chat_stats с нуля
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+async def run(args):
+    from models import db_manager
+    from analytics import AnalyticsEngine
+
+    engine = AnalyticsEngine(
+        bits=args.bits,
+        chunk_size=args.chunk_size,
+        top_keywords=args.top_keywords,
+        keywords_per_chat=args.keywords_per_chat,
+        overwrite=args.overwrite,
+    )
+    try:
+        stats = await engine.run(dry_run=args.dry_run, rebuild_stats=args.rebuild_stats)
+        print(
+            f"📈 {'Будет заполнено' if args.dry_run else 'Заполнено'}: тем {stats['topics_filled']}, "
+            f"тональностей {stats['sentiments_filled']} из {stats['rows']} взаимодействий, "
+            f"чатов {stats['chats']}, {stats['rows'] / max(stats['elapsed'], 1e-9):,.0f} строк/с"
+        )
+    finally:
+        await db_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная аналитика истории SmartGroupBot")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="Взаимодействий в одной пачке")
+    parser.add_argument("--bits", type=int, default=20, help="2^bits счетчиков документной частоты")
+    parser.add_argument("--top-keywords", type=int, default=5, help="Главных слов на взаимодействие")
+    parser.add_argument("--keywords-per-chat", type=int, default=50, help="Слов на чат в chat_keywords")
+    parser.add_argument("--overwrite", action="store_true", help="Перезаписать темы и тональность от LLM")
+    parser.add_argument(
+        "--rebuild-stats", action="store_true",
+        help="Пересчитать chat_stats по оставшейся истории (счетчики удаленных строк пропадут)"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Ничего не записывать")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
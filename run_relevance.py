@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Обучение и проверка локальной модели уместности ответа SmartGroupBot
+
+Метка - решение LLM (response_generated) в истории chat_interactions.
+Самые новые --eval-share взаимодействий откладываются для проверки:
+соседние контексты одного чата почти совпадают, поэтому случайное
+разбиение завысило бы качество.
+
+    python run_relevance.py train --out data/relevance.model
+    python run_relevance.py train --out data/relevance.model --bits 16 --epochs 10 --topics 30
+    python run_relevance.py eval --model data/relevance.model --recall 0.98
+"""
+import argparse
+import asyncio
+import sys
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def print_report(report):
+    print(f"📊 Проверка на {report['samples']} взаимодействиях, ответов LLM {report['positive_share']:.1%}")
+    if 'logloss' in report:
+        print(f"   logloss {report['logloss']:.4f}" + (f", ROC AUC {report['auc']:.3f}" if 'auc' in report else ""))
+    if 'threshold' in report:
+        print(
+            f"   RELEVANCE_THRESHOLD={report['threshold']:.3f}: сохраняется {report['recall']:.1%} ответов, "
+            f"вызовов LLM меньше на {report['llm_calls_saved']:.1%}"
+        )
+
+
+async def run(args):
+    from models import db_manager
+    from relevance import RelevanceModel, evaluate, iter_samples
+
+    try:
+        if args.command == 'train':
+            samples = [sample async for sample in iter_samples(args.bits, limit=args.limit)]
+            split = len(samples) - int(len(samples) * args.eval_share)
+            train, holdout = samples[:split], samples[split:]
+            if not train:
+                print("❌ В chat_interactions нет взаимодействий с контекстом")
+                return
+            topics = [topic for topic, _ in Counter(s.topic for s in train if s.topic).most_common(args.topics)]
+            model = RelevanceModel(args.bits, topics)
+            losses = model.fit(train, epochs=args.epochs, learning_rate=args.learning_rate, l2=args.l2)
+            print(f"🧠 Обучено на {len(train)} взаимодействиях, тем {len(topics)}, logloss по эпохам: "
+                  + ", ".join(f"{loss:.4f}" for loss in losses))
+            model.save(args.out)
+            print(f"💾 Модель сохранена в {args.out}")
+            if holdout:
+                print_report(evaluate(model, holdout, args.recall))
+        else:
+            model = RelevanceModel.load(args.model)
+            samples = [sample async for sample in iter_samples(model.bits, limit=args.limit)]
+            holdout = samples[len(samples) - int(len(samples) * args.eval_share):]
+            print_report(evaluate(model, holdout, args.recall))
+    finally:
+        await db_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная модель уместности ответа SmartGroupBot")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train = commands.add_parser("train", help="Обучить модель по истории взаимодействий")
+    train.add_argument("--out", required=True, help="Файл модели (RELEVANCE_MODEL_PATH)")
+    train.add_argument("--bits", type=int, default=18, help="2^bits хешированных признаков")
+    train.add_argument("--topics", type=int, default=20, help="Сколько самых частых тем предсказывать")
+    train.add_argument("--epochs", type=int, default=5)
+    train.add_argument("--learning-rate", type=float, default=0.1)
+    train.add_argument("--l2", type=float, default=1e-6)
+
+    check = commands.add_parser("eval", help="Проверить модель на самых новых взаимодействиях")
+    check.add_argument("--model", required=True)
+
+    for command in (train, check):
+        command.add_argument("--limit", type=int, help="Не больше N самых старых взаимодействий")
+        command.add_argument("--eval-share", type=float, default=0.2, help="Доля самых новых для проверки")
+        command.add_argument("--recall", type=float, default=0.95, help="Какую долю ответов LLM сохранить")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
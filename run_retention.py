@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Разовая очистка истории SmartGroupBot по политикам хранения
+
+    python run_retention.py                      # политики из config.env
+    python run_retention.py --dry-run            # только посчитать
+    python run_retention.py --chat -1001234567890 --max-age-days 30 --no-archive
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+async def run(args):
+    from models import db_manager
+    from retention import create_retention_job
+
+    options = {}
+    if args.max_age_days is not None:
+        options['max_age_days'] = args.max_age_days
+    if args.max_rows is not None:
+        options['max_rows'] = args.max_rows
+    if args.no_archive:
+        options['archive_dir'] = None
+    if args.batch_size:
+        options['batch_size'] = args.batch_size
+    job = create_retention_job(**options)
+
+    try:
+        if args.dry_run:
+            await db_manager.init_models()
+            from sqlalchemy import select
+            from models import ChatStats, to_chat_id
+            if args.chat:
+                chat_ids = [to_chat_id(chat_id) for chat_id in args.chat]
+            else:
+                async with db_manager.get_session() as session:
+                    chat_ids = list((await session.execute(select(ChatStats.chat_id))).scalars())
+            total = 0
+            for chat_id in chat_ids:
+                expired = await job.count_expired(chat_id)
+                if expired:
+                    print(f"  {chat_id}: {expired}")
+                total += expired
+            print(f"🧹 К удалению: {total} взаимодействий в {len(chat_ids)} чатах")
+        else:
+            result = await job.run_once(args.chat or None)
+            print(
+                f"🧹 Удалено {result['deleted']}, в архиве {result['archived']}, "
+                f"текстов удалено {result['messages_deleted']}, "
+                f"часовых счетчиков свернуто {result['buckets_compacted']}, ошибок {result['errors']}"
+            )
+    finally:
+        await db_manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Очистка и архивация истории SmartGroupBot")
+    parser.add_argument("--chat", action="append", help="Только указанный чат (можно повторять)")
+    parser.add_argument("--max-age-days", type=int, help="Переопределить RETENTION_MAX_AGE_DAYS (0 - без ограничения)")
+    parser.add_argument("--max-rows", type=int, help="Переопределить RETENTION_MAX_ROWS_PER_CHAT (0 - без ограничения)")
+    parser.add_argument("--no-archive", action="store_true", help="Удалять без выгрузки в архив")
+    parser.add_argument("--batch-size", type=int, help="Строк в одной транзакции")
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать, что будет удалено")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
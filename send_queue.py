@@ -0,0 +1,303 @@
+"""
+Очередь исходящих сообщений с учетом лимитов Telegram
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from config import config
+from metrics import registry, telegram_errors_total, telegram_seconds
+from rate_limiter import TokenBucket, backoff_delay
+
+# Предел длины сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dataclass
+class OutboundReply:
+    """Ответ бота, ожидающий отправки"""
+    chat_id: str
+    text: str
+    reply_to: Optional[int] = None
+    seq: int = 0                     # Номер сообщения чата, на которое отвечаем
+    created_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+# RetryAfter от стольких разных чатов за окно (секунд) - признак общего лимита бота
+GLOBAL_FLOOD_CHATS = 2
+GLOBAL_FLOOD_WINDOW = 2.0
+
+
+class SendQueue:
+    """
+    Диспетчер исходящих ответов.
+
+    Обработчик входящих только ставит ответ в очередь. Фоновая задача
+    отправляет ответы, соблюдая общий лимит бота и лимит каждого чата
+    (token bucket), при RetryAfter ставит чат на паузу и повторяет позже
+    (если RetryAfter за короткое время пришел нескольким чатам, лимит
+    общий - на паузу встает вся отправка), выбрасывает ответы, пока ждавшие отправки чат успел уйти дальше,
+    и склеивает несколько ожидающих ответов одного чата в одно сообщение.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate_per_min: float = 20.0,
+        chat_burst: float = 3.0,
+        stale_messages: int = 5,
+        stale_seconds: float = 120.0,
+        max_attempts: int = 3,
+        concurrency: int = 8,
+        merge_max: int = 3,
+    ):
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate_per_min / 60.0
+        self.chat_burst = chat_burst
+        self.stale_messages = stale_messages
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.merge_max = merge_max
+        self.chat_buckets: Dict[str, TokenBucket] = {}
+        # Ожидающие ответы по чатам; порядок чатов - по времени постановки
+        self.pending: Dict[str, List[OutboundReply]] = {}
+        self.in_flight: Dict[str, int] = {}
+        self.bot = None
+        self.seq_source: Optional[Callable[[str], int]] = None
+        self.on_sent: Optional[Callable[[str, str], None]] = None
+        self._wakeup = asyncio.Event()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sends: set = set()
+        self._retry_after_at: Dict[str, float] = {}
+        self.stats = {
+            'submitted': 0,
+            'sent': 0,
+            'merged': 0,
+            'dropped_stale': 0,
+            'retry_after': 0,
+            'global_pauses': 0,
+            'failed': 0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(replies) for replies in self.pending.values())
+
+    def chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+        return bucket
+
+    def start(self, bot, seq_source: Callable[[str], int] = None, on_sent: Callable[[str, str], None] = None):
+        """Запускает диспетчер: bot - telegram.Bot, on_sent(chat_id, text) - после успешной отправки"""
+        self.bot = bot
+        self.seq_source = seq_source
+        self.on_sent = on_sent
+        if self._task is None or self._task.done():
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._run())
+            logger.info("📮 Очередь исходящих сообщений запущена")
+
+    def submit(self, chat_id: str, text: str, reply_to: int = None, seq: int = 0):
+        """Ставит ответ в очередь; никогда не ждет отправки"""
+        self.pending.setdefault(chat_id, []).append(OutboundReply(chat_id, text, reply_to, seq))
+        self.stats['submitted'] += 1
+        self._wakeup.set()
+
+    async def acquire(self, chat_id: str):
+        """Ждет слот отправки для вызова API вне очереди (правки потоковых ответов)"""
+        while True:
+            now = time.monotonic()
+            bucket = self.chat_bucket(chat_id)
+            wait = max(self.global_bucket.wait_time(now), bucket.wait_time(now))
+            if wait <= 0:
+                self.global_bucket.consume(now)
+                bucket.consume(now)
+                return
+            await asyncio.sleep(wait)
+
+    def _is_stale(self, reply: OutboundReply, now: float) -> bool:
+        if self.stale_seconds and now - reply.created_at > self.stale_seconds:
+            return True
+        if self.stale_messages and self.seq_source is not None and reply.seq:
+            # Сколько сообщений людей пришло после того, на которое отвечаем
+            return self.seq_source(reply.chat_id) - reply.seq > self.stale_messages
+        return False
+
+    def _drop_stale(self, now: float):
+        for chat_id in list(self.pending):
+            fresh = [reply for reply in self.pending[chat_id] if not self._is_stale(reply, now)]
+            dropped = len(self.pending[chat_id]) - len(fresh)
+            if dropped:
+                self.stats['dropped_stale'] += dropped
+                logger.info(f"🗑️ Чат {chat_id}: устаревших ответов выброшено {dropped}")
+            if fresh:
+                self.pending[chat_id] = fresh
+            else:
+                del self.pending[chat_id]
+
+    def _merge(self, replies: List[OutboundReply]) -> Tuple[OutboundReply, List[OutboundReply]]:
+        """
+        Склеивает первые ответы чата, которые помещаются в одно сообщение
+
+        Возвращает склеенный ответ и те, что не поместились: они уходят
+        следующими сообщениями.
+        """
+        count, length = 1, len(replies[0].text)
+        while count < len(replies) and length + 2 + len(replies[count].text) <= MAX_MESSAGE_LENGTH:
+            length += 2 + len(replies[count].text)
+            count += 1
+        if count == 1:
+            return replies[0], replies[1:]
+        merged, last = replies[:count], replies[count - 1]
+        self.stats['merged'] += count - 1
+        return OutboundReply(
+            last.chat_id, "\n\n".join(reply.text for reply in merged), last.reply_to, last.seq,
+            merged[0].created_at, max(reply.attempts for reply in merged),
+        ), replies[count:]
+
+    def _on_retry_after(self, chat_id: str, retry_after: float):
+        """Пауза чата; если RetryAfter получили несколько чатов подряд - пауза всей отправки"""
+        now = time.monotonic()
+        self.stats['retry_after'] += 1
+        self.chat_bucket(chat_id).pause(retry_after)
+        self._retry_after_at = {
+            other: at for other, at in self._retry_after_at.items() if now - at <= GLOBAL_FLOOD_WINDOW
+        }
+        self._retry_after_at[chat_id] = now
+        if len(self._retry_after_at) >= GLOBAL_FLOOD_CHATS:
+            self.stats['global_pauses'] += 1
+            self.global_bucket.pause(retry_after)
+            logger.warning(f"⏳ RetryAfter у {len(self._retry_after_at)} чатов: вся отправка на паузе {retry_after}с")
+        else:
+            logger.warning(f"⏳ Чат {chat_id}: RetryAfter {retry_after}с, ответ отложен")
+
+    def _next_chat(self, now: float):
+        """Чат, который можно обслужить раньше всех, и сколько до этого ждать"""
+        best, best_wait = None, float('inf')
+        for chat_id in self.pending:
+            if self.in_flight.get(chat_id):
+                continue  # Сообщения одного чата уходят по порядку
+            wait = self.chat_bucket(chat_id).wait_time(now)
+            if wait < best_wait:
+                best, best_wait = chat_id, wait
+                if wait <= 0:
+                    break
+        return best, max(best_wait, self.global_bucket.wait_time(now))
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            self._drop_stale(now)
+            chat_id, wait = self._next_chat(now)
+            if chat_id is None or wait > 0:
+                if chat_id is None and not self._sends:
+                    self._sweep_buckets(now)
+                self._wakeup.clear()
+                timeout = None if chat_id is None else wait
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            replies = self.pending.pop(chat_id)
+            batch, rest = replies[:self.merge_max], replies[self.merge_max:]
+            if rest:
+                self.pending[chat_id] = rest
+            reply, unsent = self._merge(batch)
+            if unsent:
+                self.pending[chat_id] = unsent + self.pending.get(chat_id, [])
+            self.global_bucket.consume(now)
+            self.chat_bucket(chat_id).consume(now)
+            self.in_flight[chat_id] = self.in_flight.get(chat_id, 0) + 1
+            task = asyncio.create_task(self._send(reply))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    def _requeue(self, reply: OutboundReply):
+        # Обратно в начало очереди чата, чтобы сохранить порядок
+        self.pending[reply.chat_id] = [reply] + self.pending.get(reply.chat_id, [])
+
+    async def _send(self, reply: OutboundReply):
+        started = time.perf_counter()
+        try:
+            reply.attempts += 1
+            await self.bot.send_message(
+                chat_id=int(reply.chat_id),
+                text=reply.text,
+                reply_to_message_id=reply.reply_to,
+                allow_sending_without_reply=True,
+            )
+            self.stats['sent'] += 1
+            if self.on_sent is not None:
+                self.on_sent(reply.chat_id, reply.text)
+        except Exception as e:
+            telegram_errors_total.labels("send_message", type(e).__name__).inc()
+            if isinstance(e, RetryAfter):
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self._on_retry_after(reply.chat_id, retry_after)
+                self._requeue(reply)
+            elif isinstance(e, (BadRequest, Forbidden)) or reply.attempts >= self.max_attempts:
+                # Бота удалили из чата, сообщение некорректно или попытки исчерпаны
+                self.stats['failed'] += 1
+                logger.error(f"❌ Не удалось отправить ответ в чат {reply.chat_id}: {e}")
+            else:
+                self.chat_bucket(reply.chat_id).pause(backoff_delay(reply.attempts, 0.5, 8.0))
+                self._requeue(reply)
+        finally:
+            telegram_seconds.labels("send_message").observe(time.perf_counter() - started)
+            self.in_flight[reply.chat_id] -= 1
+            if not self.in_flight[reply.chat_id]:
+                del self.in_flight[reply.chat_id]
+            self._slots.release()
+            self._wakeup.set()
+
+    def _sweep_buckets(self, now: float):
+        # Полное ведро без ожидающих ответов ничем не отличается от нового
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.pending and bucket.wait_time(now) <= 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    async def stop(self, timeout: float = 10.0):
+        """Пытается отправить ожидающие ответы за timeout секунд и останавливается"""
+        deadline = time.monotonic() + timeout
+        while (self.pending or self._sends) and time.monotonic() < deadline and self._task is not None:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sends:
+            await asyncio.wait(self._sends, timeout=max(0.0, deadline - time.monotonic()))
+        if self.pending:
+            logger.warning(f"⚠️ При остановке не отправлено ответов: {self.queue_depth}")
+            self.pending.clear()
+
+
+# Глобальный экземпляр очереди отправки
+send_queue = SendQueue(
+    global_rate=config.send_global_rate,
+    chat_rate_per_min=config.send_chat_rate_per_min,
+    chat_burst=config.send_chat_burst,
+    stale_messages=config.send_stale_messages,
+    stale_seconds=config.send_stale_seconds,
+    max_attempts=config.send_max_attempts,
+    concurrency=config.send_concurrency,
+)
+
+registry.gauge("smartbot_send_queue_depth", "Replies waiting to be sent to Telegram", function=lambda: send_queue.queue_depth)
+registry.stats("smartbot_send_queue_total", "Outbound replies by result", lambda: send_queue.stats, "result")
+
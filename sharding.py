@@ -0,0 +1,444 @@
+"""
+Многопроцессный режим: прием обновлений и обработка чатов в N процессах
+"""
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from loguru import logger
+
+from config import config
+
+
+class HashRing:
+    """
+    Консистентное хеширование chat_id по процессам.
+
+    Каждый процесс занимает `vnodes` точек на кольце; при добавлении
+    или удалении процесса меняют владельца только ~1/N чатов.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 64):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._nodes: List[str] = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    @property
+    def nodes(self) -> List[str]:
+        return list(self._nodes)
+
+    def add(self, node: str):
+        if node in self._nodes:
+            return
+        self._nodes.append(node)
+        for replica in range(self.vnodes):
+            point = self._hash(f"{node}#{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: str):
+        if node not in self._nodes:
+            return
+        self._nodes.remove(node)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def node_for(self, key: str) -> str:
+        if not self._points:
+            raise LookupError("hash ring is empty")
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+def shard_path(path: str, name: str) -> str:
+    """Отдельный файл процесса: data/buffer.snapshot -> data/buffer.shard-0.snapshot"""
+    if not path:
+        return path
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}.{name}{path.suffix}"))
+
+
+class ShardShare:
+    """
+    Доля процесса в лимитах, общих для всего бота.
+
+    Лимит Telegram на отправку, лимиты запросов к LLM на API ключ и
+    число одновременных запросов к LLM задаются на бота целиком; каждый
+    из N обработчиков получает 1/N (пул LLM - не меньше одного воркера).
+    """
+
+    def __init__(self):
+        self.send_global_rate = config.send_global_rate
+        self.llm_rate_limit_rpm = config.llm_rate_limit_rpm
+        self.llm_concurrency = config.llm_concurrency
+        self.llm_backends = [dict(spec) for spec in config.llm_backends]
+        self.count = 1
+
+    def apply(self, count: int):
+        """Записывает долю в config (до импорта сервисов, которые его читают)"""
+        self.count = max(1, count)
+        config.send_global_rate = self.send_global_rate / self.count
+        config.llm_rate_limit_rpm = self.llm_rate_limit_rpm / self.count
+        config.llm_concurrency = max(1, self.llm_concurrency // self.count)
+        config.llm_backends = [
+            {**spec, 'rpm': spec['rpm'] / self.count} if 'rpm' in spec else spec
+            for spec in self.llm_backends
+        ]
+
+    async def rescale(self, count: int):
+        """Пересчитывает долю работающих сервисов при изменении числа обработчиков"""
+        from ai_service import ai_service
+        from send_queue import send_queue
+
+        factor = self.count / max(1, count)
+        if factor == 1:
+            return
+        self.apply(count)
+        send_queue.global_bucket.scale(factor)
+        ai_service.backend.scale_limits(factor)
+        await ai_service.pool.resize(config.llm_concurrency)
+
+
+def run_worker(name: str, nodes: List[str], inbox, outbox, heartbeat, retention: bool):
+    """Точка входа процесса-обработчика"""
+    # Файлы, которые пишет процесс, не должны пересекаться с соседями
+    # (до импорта bot_service и persistence, которые читают эти настройки)
+    config.buffer_snapshot_path = shard_path(config.buffer_snapshot_path, name)
+    config.persistence_spool_path = shard_path(config.persistence_spool_path, name)
+    share = ShardShare()
+    share.apply(len(nodes))
+    asyncio.run(_worker(name, nodes, inbox, outbox, heartbeat, retention, share))
+
+
+async def _worker(name: str, nodes: List[str], inbox, outbox, heartbeat, retention: bool, share: ShardShare):
+    from telegram import Update
+    from bot_service import bot_service
+    from main_bot import SmartGroupBot
+    from message_buffer import ChatBuffer
+    from models import db_manager
+
+    # Миграции и пересчет статистики уже выполнил супервизор
+    db_manager.manage_schema = False
+    bot = SmartGroupBot()
+    await bot.setup_application(polling=False)
+    bot.start_background_jobs(retention=retention)
+    bot.running = True
+    buffer = bot_service.message_buffer
+    ring = HashRing(nodes, config.shard_vnodes)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    logger.info(f"🧩 Обработчик {name} (pid {os.getpid()}) запущен")
+
+    try:
+        while not stopping.is_set():
+            heartbeat.value = time.time()
+            try:
+                kind, *payload = await asyncio.to_thread(inbox.get, True, 1.0)
+            except queue.Empty:
+                continue
+            if kind == 'update':
+                await bot.application.update_queue.put(Update.de_json(payload[0], bot.application.bot))
+            elif kind == 'ring':
+                # Отдаем чаты, сменившие владельца, вместе с их буфером
+                ring = HashRing(payload[0], config.shard_vnodes)
+                await share.rescale(len(ring.nodes))
+                moved = [chat_id for chat_id in buffer.chats if ring.node_for(chat_id) != name]
+                for chat_id in moved:
+                    outbox.put(('handoff', chat_id, buffer.release(chat_id)))
+                if moved:
+                    logger.info(f"🔀 {name}: передано {len(moved)} чатов")
+            elif kind == 'adopt':
+                chat_id, state = payload
+                buffer.restore_chat(chat_id, ChatBuffer.restore(state, buffer.max_messages))
+            elif kind == 'stop':
+                break
+    finally:
+        await bot.stop()
+
+
+@dataclass
+class Shard:
+    """Процесс-обработчик и его очередь"""
+    name: str
+    process: Any
+    inbox: Any
+    heartbeat: Any
+    started_at: float
+    restarts: int = 0
+    restart_at: float = 0.0
+    draining: bool = False
+    routed: int = 0
+
+
+class ShardSupervisor:
+    """
+    Прием обновлений в текущем процессе и маршрутизация по N обработчикам.
+
+    Обновления одного чата всегда попадают в один процесс и в порядке
+    получения, так что MessageBuffer и планировщик чата остаются локальными.
+    Супервизор следит за пульсом обработчиков и перезапускает упавшие
+    или зависшие процессы; rebalance() меняет число процессов на лету
+    с передачей буферов переехавших чатов новым владельцам.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        vnodes: int = 64,
+        health_interval: float = 5.0,
+        health_timeout: float = 30.0,
+        startup_timeout: float = 120.0,
+    ):
+        self.workers = workers
+        self.vnodes = vnodes
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.startup_timeout = startup_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+        self.ring = HashRing(vnodes=vnodes)
+        self.shards: Dict[str, Shard] = {}
+        self._stopping = asyncio.Event()
+        self.stats = {
+            'routed': 0,
+            'unroutable': 0,
+            'restarts': 0,
+            'handoffs': 0,
+            'rebalances': 0,
+        }
+
+    @staticmethod
+    def shard_name(index: int) -> str:
+        return f"shard-{index}"
+
+    def _spawn(self, name: str, restarts: int = 0) -> Shard:
+        inbox = self.context.Queue()
+        heartbeat = self.context.Value('d', 0.0, lock=False)
+        process = self.context.Process(
+            target=run_worker,
+            args=(name, self.ring.nodes, inbox, self.outbox, heartbeat, name == self.shard_name(0)),
+            name=f"smartbot-{name}",
+            daemon=True,
+        )
+        process.start()
+        shard = Shard(name, process, inbox, heartbeat, time.time(), restarts)
+        self.shards[name] = shard
+        return shard
+
+    def route(self, chat_id, update: Dict[str, Any]) -> Optional[str]:
+        """Кладет обновление в очередь процесса-владельца чата"""
+        if chat_id is None or not self.ring.nodes:
+            self.stats['unroutable'] += 1
+            return None
+        name = self.ring.node_for(str(chat_id))
+        shard = self.shards[name]
+        shard.inbox.put(('update', update))
+        shard.routed += 1
+        self.stats['routed'] += 1
+        return name
+
+    def rebalance(self, workers: int):
+        """Меняет число процессов; чаты переезжают вместе с буферами"""
+        workers = max(1, workers)
+        active = [name for name, shard in self.shards.items() if not shard.draining]
+        wanted = [self.shard_name(index) for index in range(workers)]
+        self.ring = HashRing(wanted, self.vnodes)
+        for name in wanted:
+            if name not in self.shards:
+                self._spawn(name)
+        for name in active:
+            shard = self.shards[name]
+            shard.inbox.put(('ring', self.ring.nodes))
+            if name not in wanted:
+                # Процесс отдаст все свои чаты и завершится
+                shard.draining = True
+                shard.inbox.put(('stop',))
+        self.workers = workers
+        self.stats['rebalances'] += 1
+        logger.info(f"🔀 Перераспределение: {workers} обработчиков")
+
+    def _restart(self, shard: Shard, reason: str):
+        logger.warning(f"⚠️ Обработчик {shard.name} {reason}, перезапуск")
+        if shard.process.is_alive():
+            shard.process.terminate()
+            shard.process.join(5)
+        # Недоставленные обновления переносим в очередь нового процесса (если очередь цела)
+        pending = []
+        while True:
+            try:
+                pending.append(shard.inbox.get_nowait())
+            except (queue.Empty, OSError, EOFError):
+                break
+        replacement = self._spawn(shard.name, shard.restarts + 1)
+        # Экспоненциальная пауза при частых падениях: до нее процесс не проверяется повторно
+        replacement.restart_at = time.time() + min(2 ** replacement.restarts, 60)
+        for item in pending:
+            replacement.inbox.put(item)
+        self.stats['restarts'] += 1
+
+    def check_health(self):
+        """Перезапускает упавшие и зависшие процессы"""
+        now = time.time()
+        for name, shard in list(self.shards.items()):
+            if shard.draining:
+                if not shard.process.is_alive():
+                    shard.process.join()
+                    del self.shards[name]
+                continue
+            if now < shard.restart_at:
+                continue
+            if not shard.process.is_alive():
+                reason = f"завершился с кодом {shard.process.exitcode}"
+            elif shard.heartbeat.value == 0.0:
+                if now - shard.started_at <= self.startup_timeout:
+                    continue
+                reason = f"не запустился за {self.startup_timeout:.0f}с"
+            elif now - shard.heartbeat.value > self.health_timeout:
+                reason = f"не отвечает {now - shard.heartbeat.value:.0f}с"
+            else:
+                continue
+            self._restart(shard, reason)
+
+    async def _forward_handoffs(self):
+        # Очередь читается в потоке, а кольцо и процессы - только в event loop,
+        # где их меняет rebalance()
+        while True:
+            try:
+                kind, chat_id, state = await asyncio.to_thread(self.outbox.get, True, 1.0)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            if kind == 'handoff' and state:
+                self.shards[self.ring.node_for(chat_id)].inbox.put(('adopt', chat_id, state))
+                self.stats['handoffs'] += 1
+
+    async def _health_loop(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.health_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.check_health()
+
+    async def _poll_updates(self):
+        """Прием обновлений long polling (аналог start_polling с drop_pending_updates)"""
+        from telegram import Bot
+
+        bot = Bot(config.telegram_bot_token)
+        async with bot:
+            pending = await bot.get_updates(offset=-1, timeout=0)
+            offset = pending[-1].update_id + 1 if pending else None
+            while not self._stopping.is_set():
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=10, allowed_updates=["message"])
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка получения обновлений: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    offset = update.update_id + 1
+                    chat = update.effective_chat
+                    self.route(chat.id if chat else None, update.to_dict())
+
+    async def _webhook_updates(self):
+        """Прием обновлений вебхуком: JSON не превращается в объекты Update в этом процессе"""
+        from telegram import Bot
+        from http_server import http_server, create_webhook_ingress, webhook_url
+
+        async def deliver(update: Dict[str, Any]):
+            chat = (update.get('message') or {}).get('chat') or {}
+            self.route(chat.get('id'), update)
+
+        ingress = create_webhook_ingress(deliver)
+        ingress.attach(http_server)
+        ingress.start()
+        await http_server.start()
+        try:
+            async with Bot(config.telegram_bot_token) as bot:
+                await bot.set_webhook(
+                    url=webhook_url(),
+                    secret_token=ingress.secret,
+                    allowed_updates=["message"],
+                    drop_pending_updates=True,
+                    max_connections=config.webhook_max_connections,
+                )
+            await self._stopping.wait()
+        finally:
+            await http_server.stop()
+            await ingress.stop()
+
+    async def run(self):
+        """Запускает обработчики и прием обновлений до сигнала остановки"""
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self._stopping.set)
+        # SIGUSR1 / SIGUSR2 - добавить / убрать обработчик
+        loop.add_signal_handler(signal.SIGUSR1, lambda: self.rebalance(self.workers + 1))
+        loop.add_signal_handler(signal.SIGUSR2, lambda: self.rebalance(self.workers - 1))
+
+        # Миграции и пересчет статистики - один раз до запуска обработчиков
+        from models import db_manager
+        await db_manager.init_models()
+        await db_manager.close()
+
+        self.ring = HashRing([self.shard_name(index) for index in range(self.workers)], self.vnodes)
+        for name in self.ring.nodes:
+            self._spawn(name)
+        logger.info(f"🧩 Супервизор (pid {os.getpid()}): {self.workers} обработчиков")
+
+        forwarder = asyncio.create_task(self._forward_handoffs())
+        health = asyncio.create_task(self._health_loop())
+        ingress = asyncio.create_task(self._webhook_updates() if config.webhook_url else self._poll_updates())
+        await self._stopping.wait()
+        if not config.webhook_url:
+            # Вебхук сам дожидается передачи принятых обновлений, long polling прерываем
+            ingress.cancel()
+        await asyncio.gather(ingress, health, return_exceptions=True)
+        await self.stop()
+        await forwarder
+
+    async def stop(self, timeout: float = 30.0):
+        """Останавливает обработчики, дожидаясь сброса их очередей"""
+        self._stopping.set()
+        for shard in self.shards.values():
+            shard.inbox.put(('stop',))
+        deadline = time.time() + timeout
+        for shard in self.shards.values():
+            await asyncio.to_thread(shard.process.join, max(0.0, deadline - time.time()))
+            if shard.process.is_alive():
+                logger.warning(f"⚠️ Обработчик {shard.name} не остановился, завершаем принудительно")
+                shard.process.terminate()
+        logger.info(f"✅ Супервизор остановлен: {self.stats}")
+
+
+def run_supervisor(workers: int = None):
+    """Многопроцессный запуск (run_all.py --shards)"""
+    workers = workers or config.shard_workers or os.cpu_count() or 1
+    supervisor = ShardSupervisor(
+        workers,
+        vnodes=config.shard_vnodes,
+        health_interval=config.shard_health_interval,
+        health_timeout=config.shard_health_timeout,
+    )
+    asyncio.run(supervisor.run())
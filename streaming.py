@@ -0,0 +1,226 @@
+"""
+Потоковая выдача ответов: инкрементальный парсер JSON и прогрессивные правки сообщения
+"""
+import asyncio
+import re
+import time
+from typing import Optional
+from loguru import logger
+
+from metrics import telegram_errors_total, telegram_seconds
+
+
+_SHOULD_RESPOND = re.compile(r'"should_respond"\s*:\s*(true|false)')
+_RESPONSE_START = re.compile(r'"response"\s*:\s*(")?')
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class IncrementalResponseParser:
+    """
+    Достает `should_respond` и `response` из еще не завершенного JSON.
+
+    Модель отвечает объектом с полями detected_topic, sentiment,
+    should_respond, response; парсер получает его кусками и как можно
+    раньше сообщает решение и уже сгенерированный текст ответа.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.should_respond: Optional[bool] = None
+        self.response_text = ""
+        self.response_done = False
+        self.response_null = False
+        self._response_pos: Optional[int] = None
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Добавляет кусок ответа модели.
+
+        Returns:
+            True, если текст ответа вырос
+        """
+        self.buffer += chunk
+
+        if self.should_respond is None:
+            match = _SHOULD_RESPOND.search(self.buffer)
+            if match:
+                self.should_respond = match.group(1) == 'true'
+
+        if self._response_pos is None and not self.response_null:
+            match = _RESPONSE_START.search(self.buffer)
+            if match:
+                if match.group(1):
+                    self._response_pos = match.end()
+                elif self.buffer[match.end():match.end() + 1]:
+                    # response: null или другое не-строковое значение
+                    self.response_null = True
+
+        if self._response_pos is None or self.response_done:
+            return False
+        return self._decode_string()
+
+    def _decode_string(self) -> bool:
+        """Декодирует доступную часть JSON строки, не трогая неполные escape'ы"""
+        buffer = self.buffer
+        pos = self._response_pos
+        decoded = []
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                self.response_done = True
+                pos += 1
+                break
+            if char != '\\':
+                decoded.append(char)
+                pos += 1
+                continue
+            if pos + 1 >= len(buffer):
+                break
+            escape = buffer[pos + 1]
+            if escape == 'u':
+                if pos + 6 > len(buffer):
+                    break
+                try:
+                    decoded.append(chr(int(buffer[pos + 2:pos + 6], 16)))
+                except ValueError:
+                    pass
+                pos += 6
+            else:
+                decoded.append(_ESCAPES.get(escape, escape))
+                pos += 2
+
+        self._response_pos = pos
+        if decoded:
+            self.response_text += "".join(decoded)
+            return True
+        return False
+
+    @property
+    def visible_text(self) -> Optional[str]:
+        """Текст, который уже можно показать пользователю"""
+        if self.should_respond and self.response_text.strip():
+            return self.response_text
+        return None
+
+
+class StreamingReply:
+    """
+    Ответ в Telegram, который отправляется рано и дописывается правками.
+
+    `update()` не блокирует обработчик: он лишь запоминает последний текст,
+    а фоновая задача отправляет сообщение и правит его не чаще, чем раз
+    в `edit_interval` секунд, чтобы укладываться в лимиты Telegram.
+    """
+
+    def __init__(self, message, edit_interval: float = 1.5, min_chars: int = 20, cursor: str = " ▌", limiter=None):
+        self.message = message
+        self.limiter = limiter  # SendQueue: правки расходуют те же лимиты, что и ответы
+        self.edit_interval = edit_interval
+        self.min_chars = min_chars
+        self.cursor = cursor
+        self.sent_message = None
+        self.created_at = time.monotonic()
+        self.time_to_first_token: Optional[float] = None
+        self._latest: Optional[str] = None
+        self._shown: Optional[str] = None
+        self._last_shown_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def started(self) -> bool:
+        return self.sent_message is not None
+
+    @property
+    def engaged(self) -> bool:
+        """Потоковая отправка запущена: сообщение уже отправлено или отправляется"""
+        return self._task is not None
+
+    def update(self, text: str):
+        """Сообщает новый промежуточный текст ответа"""
+        if self._closing.is_set() or not text:
+            return
+        self._latest = text
+        if self._task is None:
+            if len(text) < self.min_chars:
+                return
+            self._task = asyncio.create_task(self._flusher())
+        self._wakeup.set()
+
+    async def _flusher(self):
+        while not self._closing.is_set():
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closing.is_set():
+                break
+            await self._show(self._latest + self.cursor)
+            try:
+                await asyncio.wait_for(self._closing.wait(), self.edit_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _show(self, text: str):
+        if text == self._shown:
+            return
+        method = "reply_text" if self.sent_message is None else "edit_text"
+        try:
+            if self.limiter is not None:
+                await self.limiter.acquire(str(self.message.chat_id))
+            started = time.perf_counter()
+            if self.sent_message is None:
+                self.sent_message = await self.message.reply_text(text)
+                telegram_seconds.labels(method).observe(time.perf_counter() - started)
+                self.time_to_first_token = time.monotonic() - self.created_at
+                logger.info(f"⏱️ Первый текст ответа через {self.time_to_first_token * 1000:.0f} мс")
+            else:
+                await self.sent_message.edit_text(text)
+                telegram_seconds.labels(method).observe(time.perf_counter() - started)
+            self._shown = text
+            self._last_shown_at = time.monotonic()
+        except Exception as e:
+            telegram_errors_total.labels(method, type(e).__name__).inc()
+            logger.warning(f"⚠️ Не удалось обновить потоковый ответ: {e}")
+
+    async def finish(self, text: str) -> bool:
+        """
+        Дописывает отправленное сообщение окончательным текстом
+
+        Returns:
+            False, если сообщение так и не было отправлено - ответ нужно отправить обычным путем
+        """
+        await self._stop()
+        if self.sent_message is None:
+            return False
+        await self._settle(text)
+        return True
+
+    async def cancel(self) -> Optional[str]:
+        """
+        Останавливает правки, когда окончательного ответа не будет.
+
+        Уже отправленное сообщение не удаляется: пользователи могли его
+        прочитать, поэтому оно фиксируется с показанным текстом без курсора.
+
+        Returns:
+            Текст, оставшийся в чате, или None, если ничего не отправлялось
+        """
+        await self._stop()
+        if self.sent_message is None or not self._latest:
+            return None
+        await self._settle(self._latest)
+        return self._latest
+
+    async def _settle(self, text: str):
+        # Последняя правка тоже соблюдает интервал
+        delay = self._last_shown_at + self.edit_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._show(text)
+
+    async def _stop(self):
+        self._closing.set()
+        self._wakeup.set()
+        if self._task is not None:
+            # Дожидаемся текущей отправки, чтобы не потерять ссылку на сообщение
+            await self._task
@@ -0,0 +1,314 @@
+"""
+Разбор структурированных (JSON) ответов LLM
+"""
+import json
+import math
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_FENCE = re.compile(r'```[A-Za-z]*\s*(.*?)(?:```|$)', re.S)
+_LITERALS = {'true': 'true', 'false': 'false', 'null': 'null', 'True': 'true', 'False': 'false', 'None': 'null'}
+_STRING_ESCAPES = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+_TRUE_WORDS = frozenset({'true', 'yes', 'да', '1'})
+_FALSE_WORDS = frozenset({'false', 'no', 'нет', '0', 'null', 'none', ''})
+_SENTIMENT_LABELS = {'positive': 1.0, 'neutral': 0.0, 'negative': -1.0}
+_SENTENCE_END = re.compile(r'[.!?…]+["»)]*(?=\s|$)')
+DEFAULT_TOPIC = "общение"
+
+
+class StructuredOutputError(ValueError):
+    """Ответ LLM не удалось привести к AIResult"""
+
+
+def loads(text: str) -> Any:
+    """json.loads через orjson, если он установлен"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def extract_json_object(text: str) -> Optional[str]:
+    """
+    Первый объект {...} в тексте с учетом вложенности и строк
+
+    Незакрытый объект (ответ оборван по max_tokens) возвращается до конца
+    текста - его достроит repair_json.
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    depth, in_string, escaped = 0, False, False
+    for pos in range(start, len(text)):
+        char = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+    return text[start:]
+
+
+def _next_significant(text: str, pos: int) -> str:
+    while pos < len(text) and text[pos].isspace():
+        pos += 1
+    return text[pos] if pos < len(text) else ''
+
+
+def repair_json(text: str) -> str:
+    """Исправляет типичные ошибки JSON от LLM за один проход"""
+    return _repair(text)[0]
+
+
+def _repair(text: str) -> Tuple[str, bool]:
+    """
+    Исправленный JSON и признак, что пришлось закрыть оборванную строку
+
+    Одинарные кавычки, переводы строк и неэкранированные кавычки внутри
+    строк, ключи без кавычек, True/False/None, висячие запятые, а также
+    оборванный конец: незакрытые строка, объект и массив закрываются.
+    Закрытая строка означает, что текст значения обрезан на полуслове.
+    """
+    out = []
+    closers = []
+    cut = False
+    pos, length = 0, len(text)
+    while pos < length:
+        char = text[pos]
+        if char == '"' or char == "'":
+            parts = ['"']
+            pos += 1
+            closed = False
+            while pos < length:
+                char_in = text[pos]
+                if char_in == '\\':
+                    if pos + 1 >= length:
+                        pos += 1
+                        break
+                    escape = text[pos + 1]
+                    parts.append("'" if escape == "'" else '\\' + escape)
+                    pos += 2
+                    continue
+                if char_in == char:
+                    # Кавычка внутри текста, если за ней не идет продолжение JSON
+                    if _next_significant(text, pos + 1) in ',}]:':
+                        pos += 1
+                        closed = True
+                        break
+                    parts.append('\\"')
+                elif char_in == '"':
+                    parts.append('\\"')
+                else:
+                    parts.append(_STRING_ESCAPES.get(char_in, char_in))
+                pos += 1
+            cut = cut or not closed
+            parts.append('"')
+            out.append(''.join(parts))
+            continue
+        if char == '{' or char == '[':
+            closers.append('}' if char == '{' else ']')
+        elif char == '}' or char == ']':
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ',':
+                out.pop()
+            if closers:
+                closers.pop()
+        elif char.isalpha() or char == '_':
+            end = pos
+            while end < length and (text[end].isalnum() or text[end] == '_'):
+                end += 1
+            word = text[pos:end]
+            if end == length:
+                # Литерал, оборванный на полуслове
+                word = next((literal for literal in ('true', 'false', 'null') if literal.startswith(word)), word)
+            if word in _LITERALS:
+                out.append(_LITERALS[word])
+            elif _next_significant(text, end) == ':':
+                out.append('"' + word + '"')
+            else:
+                out.append(word)
+            pos = end
+            continue
+        out.append(char)
+        pos += 1
+
+    # Оборванный конец: висячая запятая или ключ без значения
+    while out and (out[-1].isspace() or out[-1] == ','):
+        out.pop()
+    if out and out[-1] == ':':
+        out.append('null')
+    elif closers and closers[-1] == '}' and out and out[-1].startswith('"'):
+        previous = next((chunk for chunk in reversed(out[:-1]) if not chunk.isspace()), '')
+        if previous in ('{', ','):
+            out.append(': null')
+    out.extend(reversed(closers))
+    return ''.join(out), cut
+
+
+def _as_bool(value: Any) -> Optional[bool]:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return bool(value)
+    if isinstance(value, str):
+        word = value.strip().lower()
+        if word in _TRUE_WORDS:
+            return True
+        if word in _FALSE_WORDS:
+            return False
+    return None
+
+
+def _as_sentiment(value: Any) -> float:
+    if isinstance(value, bool) or value is None:
+        return 0.0
+    if isinstance(value, str):
+        label = value.strip().lower()
+        if label in _SENTIMENT_LABELS:
+            return _SENTIMENT_LABELS[label]
+        try:
+            value = float(label)
+        except ValueError:
+            return 0.0
+    if not isinstance(value, (int, float)) or math.isnan(value):
+        return 0.0
+    return max(-1.0, min(1.0, float(value)))
+
+
+def _complete_sentences(text: str) -> Optional[str]:
+    """Текст до конца последнего полного предложения; None - полных предложений нет"""
+    ends = list(_SENTENCE_END.finditer(text))
+    return (text[:ends[-1].end()].strip() or None) if ends else None
+
+
+@dataclass
+class AIResult:
+    """Решение модели по контексту в том виде, в каком его читает BotService"""
+    detected_topic: str = DEFAULT_TOPIC
+    sentiment: float = 0.0
+    should_respond: bool = False
+    response: Optional[str] = None
+    truncated: bool = False  # Ответ оборван по max_tokens: не кэшируется
+
+
+    @classmethod
+    def from_data(cls, data: Any) -> 'AIResult':
+        """Проверяет и приводит типы полей; лишние поля отбрасываются"""
+        if not isinstance(data, dict):
+            raise StructuredOutputError(f"ожидался объект, получен {type(data).__name__}")
+        if not {'should_respond', 'response'} & data.keys():
+            raise StructuredOutputError("нет полей should_respond и response")
+        response = data.get('response')
+        if isinstance(response, (dict, list)) or response is None:
+            response = None
+        else:
+            response = str(response).strip() or None
+            if response is not None and response.lower() == 'null':
+                response = None
+        should_respond = _as_bool(data.get('should_respond'))
+        if should_respond is None:
+            should_respond = response is not None
+        topic = data.get('detected_topic')
+        topic = str(topic).strip()[:255] if isinstance(topic, (str, int, float)) and not isinstance(topic, bool) else ''
+        return cls(topic or DEFAULT_TOPIC, _as_sentiment(data.get('sentiment')), should_respond, response)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "detected_topic": self.detected_topic,
+            "sentiment": self.sentiment,
+            "should_respond": self.should_respond,
+            "response": self.response
+        }
+
+
+class StructuredOutputParser:
+    """
+    Терпимый разбор JSON ответа модели в AIResult.
+
+    Сначала строгий разбор всего текста (быстрый путь для корректных
+    ответов), затем - первый сбалансированный объект внутри markdown
+    блока или прозы, затем - он же после repair_json. Счетчики в `stats`
+    показывают, сколько оплаченных ответов спас ремонт и сколько
+    потеряно.
+    """
+
+    def __init__(self):
+        self.stats = {'parsed': 0, 'repaired': 0, 'truncated': 0, 'failed': 0}
+
+    @property
+    def failure_rate(self) -> float:
+        total = self.stats['parsed'] + self.stats['failed']
+        return self.stats['failed'] / total if total else 0.0
+
+    def _decode(self, content: str) -> Tuple[Any, bool, bool]:
+        """Данные, признак ремонта и признак оборванной строки"""
+        try:
+            return loads(content), False, False
+        except ValueError:
+            pass
+        fenced = _FENCE.search(content)
+        candidate = extract_json_object(fenced.group(1) if fenced else content)
+        if candidate is None:
+            raise StructuredOutputError("в ответе нет JSON объекта")
+        try:
+            return loads(candidate), True, False
+        except ValueError:
+            pass
+        repaired, cut = _repair(candidate)
+        try:
+            return json.loads(repaired, strict=False), True, cut
+        except ValueError as e:
+            raise StructuredOutputError(f"JSON не восстановлен: {e}") from None
+
+    def parse(self, content: str, truncated: bool = False) -> AIResult:
+        """
+        Разбирает ответ модели; StructuredOutputError - ответ потерян
+
+        truncated - провайдер оборвал ответ по max_tokens (finish_reason
+        "length"). Такой результат помечается и не кэшируется; если ремонт
+        закрыл оборванную строку, ответ обрезается до последнего полного
+        предложения, а без полного предложения считается потерянным.
+        """
+        try:
+            data, repaired, cut = self._decode(content or "")
+            result = AIResult.from_data(data)
+            if truncated or cut:
+                self.stats['truncated'] += 1
+                result.truncated = True
+            if cut and result.response:
+                result.response = _complete_sentences(result.response)
+                if result.response is None:
+                    raise StructuredOutputError("ответ оборван на полуслове")
+        except StructuredOutputError as e:
+            self.stats['failed'] += 1
+            logger.warning(
+                f"🧩 Ответ LLM не разобран ({e}), доля потерь {self.failure_rate:.1%}: {(content or '')[:200]!r}"
+            )
+            raise
+        self.stats['parsed'] += 1
+        if repaired:
+            self.stats['repaired'] += 1
+            logger.info("🩹 JSON ответа LLM восстановлен")
+        return result
+
+
+# Глобальный экземпляр разборщика ответов
+output_parser = StructuredOutputParser()
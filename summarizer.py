@@ -0,0 +1,146 @@
+"""
+Скользящее резюме обсуждения в чатах
+"""
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from ai_service import ai_service
+from config import config
+from message_buffer import MessageBuffer
+from prompt_builder import estimate_tokens, truncate_to_tokens
+
+# complete(system_prompt, user_prompt, timeout) -> текст ответа модели
+CompleteFn = Callable[[str, str, float], Awaitable[str]]
+
+SUMMARY_SYSTEM = """
+Ты ведешь краткое резюме обсуждения в групповом чате.
+Тебе дают текущее резюме и новые сообщения. Верни обновленное резюме:
+о чем говорят, кто что предлагает, какие вопросы остались без ответа.
+Пиши на русском языке, сжато, без вступлений и без JSON.
+"""
+SUMMARY_USER = "Текущее резюме:\n{summary}\n\nНовые сообщения:\n{messages}\n"
+BOT_PREFIX = "Бот: "
+
+
+class ChatSummarizer:
+    """
+    Фоновое обновление резюме чатов.
+
+    После каждых `every` новых сообщений чата резюме пересобирается
+    из прежнего резюме и этих сообщений одним запросом к LLM. Запрос
+    выполняется отдельной задачей с низшим приоритетом пула и не
+    задерживает ответы; резюме хранится в ChatBuffer и вместе с ним
+    попадает в снимки, выгрузку в БД и передачу между процессами.
+    """
+
+    def __init__(
+        self,
+        buffer: MessageBuffer,
+        complete: CompleteFn,
+        every: int = 10,
+        max_tokens: int = 200,
+        input_tokens: int = 1200,
+        timeout: float = 60.0,
+    ):
+        self.buffer = buffer
+        self.complete = complete
+        self.every = every
+        self.max_tokens = max_tokens          # Предел длины резюме
+        self.input_tokens = input_tokens      # Предел новых сообщений в одном запросе
+        self.timeout = timeout
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # После неудачи следующая попытка - не раньше чем через every сообщений
+        self._retry_at: Dict[str, int] = {}
+        self.stats = {
+            'refreshed': 0,
+            'failed': 0,
+            'lost_messages': 0,
+        }
+
+    def note(self, chat_id: str) -> Optional[asyncio.Task]:
+        """Проверяет, пора ли обновить резюме чата, и запускает обновление в фоне"""
+        chat = self.buffer.chats.get(chat_id)
+        if chat is None or chat_id in self._tasks:
+            return None
+        # Сообщения, вытесненные из буфера до обновления, в резюме уже не попадут
+        if chat.unsummarized < self._retry_at.get(chat_id, min(self.every, chat.capacity)):
+            return None
+        task = asyncio.create_task(self.refresh(chat_id))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+        return task
+
+    def _new_messages(self, chat_id: str) -> List[str]:
+        chat = self.buffer.chats[chat_id]
+        records = list(chat.records())
+        count = min(chat.unsummarized, len(records))
+        if chat.unsummarized > count:
+            self.stats['lost_messages'] += chat.unsummarized - count
+        lines: List[str] = []
+        used = 0
+        # Если все не помещается, в запрос идут самые свежие сообщения
+        for text, _, is_bot in reversed(records[len(records) - count:]):
+            line = "- " + (BOT_PREFIX if is_bot else "") + truncate_to_tokens(text, self.input_tokens // 4)
+            tokens = estimate_tokens(line)
+            if lines and used + tokens > self.input_tokens:
+                break
+            lines.append(line)
+            used += tokens
+        lines.reverse()
+        return lines
+
+    async def refresh(self, chat_id: str) -> Optional[str]:
+        """Пересобирает резюме чата по накопившимся сообщениям"""
+        chat = self.buffer.chats.get(chat_id)
+        if chat is None or not chat.unsummarized:
+            return None
+        covered = chat.unsummarized
+        user_prompt = SUMMARY_USER.format(
+            summary=chat.summary or "пока нет",
+            messages="\n".join(self._new_messages(chat_id)),
+        )
+        try:
+            summary = await self.complete(SUMMARY_SYSTEM, user_prompt, self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Сообщения остаются несведенными и попадут в следующую попытку
+            logger.warning(f"⚠️ Не удалось обновить резюме чата {chat_id}: {e}")
+            summary = None
+        summary = truncate_to_tokens((summary or "").strip(), self.max_tokens)
+        if not summary:
+            self.stats['failed'] += 1
+            self._retry_at[chat_id] = covered + self.every
+            return None
+        self._retry_at.pop(chat_id, None)
+        self.buffer.set_summary(chat_id, summary, covered)
+        self.stats['refreshed'] += 1
+        logger.info(f"📝 Резюме чата {chat_id} обновлено ({covered} сообщений, ~{estimate_tokens(summary)} токенов)")
+        return summary
+
+    async def stop(self):
+        """Отменяет незавершенные обновления резюме"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def create_summarizer(buffer: MessageBuffer) -> Optional[ChatSummarizer]:
+    """Создает резюмирование по настройкам (None - выключено)"""
+    if not config.summary_every:
+        return None
+
+    async def complete(system_prompt: str, user_prompt: str, timeout: float) -> str:
+        return await ai_service.complete(system_prompt, user_prompt, timeout, max_tokens=config.summary_max_tokens)
+
+    return ChatSummarizer(
+        buffer,
+        complete,
+        every=config.summary_every,
+        max_tokens=config.summary_max_tokens,
+        input_tokens=config.summary_input_tokens,
+        timeout=config.summary_timeout,
+    )